@@ -0,0 +1,106 @@
+import os
+import sys
+import time
+import logging
+import argparse
+from collections import defaultdict
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader, Subset
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from gameformer.inference_engine import BACKENDS, GameFormerInferenceEngine, compare_outputs, set_worker_threads
+from gameformer.predictor import GameFormer
+from gameformer.train_utils import DrivingData, level_k_loss, motion_metrics
+
+
+METRICS = ['plannerADE', 'plannerFDE', 'plannerAHE', 'plannerFHE', 'predictorADE', 'predictorFDE']
+
+
+def ground_truth_metrics(outputs, ego_future, neighbors_future):
+    level_k_outputs, ego_plan = outputs
+    neighbors_future_valid = torch.ne(neighbors_future[..., :2], 0)
+    _, results = level_k_loss(level_k_outputs, ego_future, neighbors_future, neighbors_future_valid)
+
+    return motion_metrics(ego_plan, results[:, 1:], ego_future, neighbors_future, neighbors_future_valid)
+
+
+def evaluate(model, engine, data_loader):
+    """
+    ADE / FDE against the ground truth of the eager model and of the engine, and the deviation of the engine
+    from the eager model, on the same samples.
+    """
+    eager_metrics, engine_metrics, deviations = [], [], defaultdict(list)
+    runtimes = {'eager': [], 'engine': []}
+    for batch in tqdm(data_loader):
+        inputs = {
+            'ego_agent_past': batch[0],
+            'neighbor_agents_past': batch[1],
+            'map_lanes': batch[2],
+            'map_crosswalks': batch[3],
+            'route_lanes': batch[4]
+        }
+        ego_future, neighbors_future = batch[5], batch[6]
+
+        start = time.perf_counter()
+        with torch.no_grad():
+            eager_outputs = model(inputs)
+        runtimes['eager'].append(time.perf_counter() - start)
+        start = time.perf_counter()
+        engine_outputs = engine(inputs)
+        runtimes['engine'].append(time.perf_counter() - start)
+
+        with torch.no_grad():
+            eager_metrics.append(ground_truth_metrics(eager_outputs, ego_future, neighbors_future))
+            engine_metrics.append(ground_truth_metrics(engine_outputs, ego_future, neighbors_future))
+        for key, value in compare_outputs(eager_outputs, engine_outputs).items():
+            deviations[key].append(value)
+
+    return {
+        'eager': dict(zip(METRICS, np.mean(eager_metrics, axis=0))),
+        'engine': dict(zip(METRICS, np.mean(engine_metrics, axis=0))),
+        # mean of the per sample deviations, max for the scores
+        'deviation': {key: float(np.max(values) if key == 'score_max_abs_diff' else np.mean(values))
+                      for key, values in deviations.items()},
+        # the first engine call compiles, it is not counted
+        'runtime_ms': {name: 1000 * float(np.median(values[1:] or values)) for name, values in runtimes.items()},
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Accuracy of the GameFormer cpu inference engine against the eager model')
+    parser.add_argument('--model_path', type=str, required=True, help='GameFormer(3, 2, 6, 20) checkpoint')
+    parser.add_argument('--valid_set', type=str, required=True, help='processed json or directory of npz files')
+    parser.add_argument('--backend', type=str, default='torchscript', choices=BACKENDS)
+    parser.add_argument('--quantize', action='store_true')
+    parser.add_argument('--num_samples', type=int, default=1000)
+    parser.add_argument('--num_threads', type=int, default=1)
+    parser.add_argument('--max_plan_ade', type=float, default=0.2,
+                        help='[m] exit with an error when the engine plan deviates more from the eager plan')
+    args = parser.parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    set_worker_threads(args.num_threads)
+
+    model = GameFormer(3, 2, 6, 20)
+    model.load_state_dict(torch.load(args.model_path, map_location='cpu'))
+    model.eval()
+    # the per signature check of the engine is reported below instead of falling back to eager
+    engine = GameFormerInferenceEngine(model, args.backend, args.quantize, max_plan_ade=float('inf'))
+
+    valid_set = args.valid_set if args.valid_set.endswith('.json') else args.valid_set + '/*.npz'
+    dataset = DrivingData(valid_set, 20)
+    dataset = Subset(dataset, range(min(args.num_samples, len(dataset))))
+    # batch size 1 as in simulation
+    results = evaluate(model, engine, DataLoader(dataset, batch_size=1, shuffle=False))
+
+    print(f"{'':<10}" + ''.join(f'{metric:>14}' for metric in METRICS))
+    for name in ['eager', 'engine']:
+        print(f'{name:<10}' + ''.join(f'{results[name][metric]:>14.4f}' for metric in METRICS))
+    print('engine vs eager: ' + ', '.join(f'{key} {value:.4f}' for key, value in results['deviation'].items()))
+    print('median runtime: ' + ', '.join(f'{name} {value:.2f} ms' for name, value in results['runtime_ms'].items()))
+
+    if results['deviation']['plan_ade'] > args.max_plan_ade:
+        sys.exit(f"plan ADE against the eager model {results['deviation']['plan_ade']:.4f} m > {args.max_plan_ade} m")
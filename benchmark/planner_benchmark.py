@@ -0,0 +1,304 @@
+import os
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import platform
+import tracemalloc
+from collections import defaultdict
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.replay import load_replays
+from gameformer.planner import Planner as GameFormerPlanner
+from gameformer.predictor import GameFormer
+from llama2.planner.llama4drive_planner import LLAMA4DrivePlanner
+from nuplan.planning.simulation.planner.planner_report import StagedPlannerReport
+from nuplan.planning.simulation.trajectory.trajectory_sampling import TrajectorySampling
+from nuplan_garage.planning.simulation.planner.pdm_planner.pdm_hybrid_planner import PDMHybridPlanner
+from nuplan_garage.planning.simulation.planner.pdm_planner.proposal.batch_idm_policy import BatchIDMPolicy
+from nuplan_garage.planning.training.modeling.models.pdm_offset_model import PDMOffsetModel
+
+
+PLANNERS = ['gameformer', 'llama4drive', 'pdm_hybrid']
+PERCENTILES = [50, 95, 99]
+# compared against the baseline, lower is better
+COMPARED_METRICS = ['p50_ms', 'p95_ms']
+
+# a few MB llama with the layout of the real one, enough to exercise tokenization, map splicing and decoding
+TINY_LLAMA_CONFIG = {
+    'hidden_size': 128,
+    'intermediate_size': 344,
+    'num_hidden_layers': 2,
+    'num_attention_heads': 4,
+    'max_position_embeddings': 2048,
+    'rms_norm_eps': 1e-6,
+}
+
+
+class RandomInitGameFormerPlanner(GameFormerPlanner):
+    """
+    GameFormer planner with a randomly initialised model, so that it runs without the released checkpoint.
+    """
+    def _load_model(self, checkpoint_path):
+        model = GameFormer(3, 2, 6, 20)
+        model.to(self._device)
+        model.eval()
+
+        return model
+
+
+def build_pdm_hybrid_planner():
+    # parameters of nuplan/planning/script/config/simulation/planner/llama4drive_lora_ins_wo_stop_refine.yaml
+    model = PDMOffsetModel(
+        trajectory_sampling=TrajectorySampling(num_poses=16, interval_length=0.5),
+        history_sampling=TrajectorySampling(num_poses=10, interval_length=0.2),
+        planner=None,
+        centerline_samples=120,
+        centerline_interval=1.0,
+        hidden_dim=512,
+    )
+    return PDMHybridPlanner(
+        trajectory_sampling=TrajectorySampling(num_poses=80, interval_length=0.1),
+        proposal_sampling=TrajectorySampling(num_poses=40, interval_length=0.1),
+        idm_policies=BatchIDMPolicy(
+            fallback_target_velocity=15.0,
+            speed_limit_fraction=[0.2, 0.4, 0.6, 0.8, 1.0],
+            min_gap_to_lead_agent=1.0,
+            headway_time=1.5,
+            accel_max=1.5,
+            decel_max=3.0,
+        ),
+        lateral_offsets=[-1.0, 1.0],
+        map_radius=50,
+        model=model,
+        correction_horizon=2.0,
+        use_better_anchor=False,
+        checkpoint_path=None,
+    )
+
+
+def build_planner(name, replay, args):
+    if name == 'gameformer':
+        return RandomInitGameFormerPlanner(device='cpu', use_lane_store=args.lane_store,
+                                           inference_backend=args.gameformer_backend, quantize=args.quantize)
+    if name == 'pdm_hybrid':
+        return build_pdm_hybrid_planner()
+    if name == 'llama4drive':
+        model_cfg = {
+            'adapter_fusion': True,
+            'enable_lora': False,
+            'random_init_config': TINY_LLAMA_CONFIG,
+        }
+        return LLAMA4DrivePlanner(
+            scenario=replay,
+            sub_planner=build_pdm_hybrid_planner() if args.pdm_scorer else None,
+            enable_pdm_scorer_in_multirefpath=args.pdm_scorer,
+            ins_mode='None',
+            ins_wo_stop=True,
+            finetune_model_path=args.tokenizer_path,
+            short_ins=30,
+            llm_inf_step=args.llm_inf_step,
+            use_lane_store=args.lane_store,
+            model_cfg=model_cfg,
+        )
+    raise ValueError(f'Unknown planner {name}, should be in {PLANNERS}')
+
+
+def latency_stats(runtimes):
+    runtimes_ms = 1000 * np.asarray(runtimes, dtype=np.float64)
+    stats = {'num_samples': len(runtimes_ms), 'mean_ms': float(np.mean(runtimes_ms)), 'max_ms': float(np.max(runtimes_ms))}
+    for percentile, value in zip(PERCENTILES, np.percentile(runtimes_ms, PERCENTILES)):
+        stats[f'p{percentile}_ms'] = float(value)
+    return stats
+
+
+def run_planner(name, replays, args):
+    """
+    Replay every tick of every replay through a fresh planner per replay, as the simulation does per scenario.
+    The first args.warmup ticks of each replay are not measured.
+    """
+    latencies = []
+    stage_runtimes = defaultdict(list)
+    for replay in replays:
+        planner = build_planner(name, replay, args)
+        planner.initialize(replay.planner_initialization())
+        # the history buffers are built up front so that they are not timed
+        planner_inputs = list(replay.planner_inputs())
+        for tick, planner_input in enumerate(planner_inputs):
+            if tick == args.warmup:
+                # drop what the planner recorded during the warm up ticks
+                planner.generate_planner_report(clear_stats=True)
+            start = time.perf_counter()
+            planner.compute_trajectory(planner_input)
+            if tick >= args.warmup:
+                latencies.append(time.perf_counter() - start)
+
+        report = planner.generate_planner_report(clear_stats=True)
+        if isinstance(report, StagedPlannerReport):
+            for stage, runtimes in report.stage_runtimes.items():
+                stage_runtimes[stage] += runtimes
+
+    if len(latencies) == 0:
+        raise ValueError(f'No measured ticks, the replays have at most {args.warmup} ticks')
+    return {
+        'num_ticks': len(latencies),
+        'throughput_hz': len(latencies) / float(np.sum(latencies)),
+        'end_to_end': latency_stats(latencies),
+        'stages': {stage: latency_stats(runtimes) for stage, runtimes in sorted(stage_runtimes.items()) if len(runtimes) > 0},
+    }
+
+
+def trace_allocations(name, replays, args):
+    """
+    Python heap allocations per tick, in a separate pass since tracemalloc slows everything down.
+    Memory allocated by torch / numpy kernels outside of the python allocator is not seen.
+    """
+    peaks, retained = [], []
+    tracemalloc.start()
+    try:
+        for replay in replays:
+            planner = build_planner(name, replay, args)
+            planner.initialize(replay.planner_initialization())
+            for tick, planner_input in enumerate(replay.planner_inputs()):
+                before, _ = tracemalloc.get_traced_memory()
+                tracemalloc.reset_peak()
+                planner.compute_trajectory(planner_input)
+                after, peak = tracemalloc.get_traced_memory()
+                if tick >= args.warmup:
+                    peaks.append(peak - before)
+                    retained.append(after - before)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'peak_kb_mean': float(np.mean(peaks)) / 1024,
+        'peak_kb_max': float(np.max(peaks)) / 1024,
+        'retained_kb_per_tick': float(np.mean(retained)) / 1024,
+    }
+
+
+def compare_to_baseline(results, baseline, tolerance, min_delta_ms):
+    """
+    :return: list of regression messages, a latency regresses when it is both tolerance (relative)
+        and min_delta_ms (absolute) slower than the baseline.
+    """
+    regressions = []
+    for name, planner_results in results['planners'].items():
+        if name not in baseline['planners']:
+            continue
+        planner_baseline = baseline['planners'][name]
+        entries = [('end_to_end', planner_results['end_to_end'], planner_baseline['end_to_end'])]
+        entries += [(stage, stats, planner_baseline['stages'][stage])
+                    for stage, stats in planner_results['stages'].items() if stage in planner_baseline['stages']]
+        for entry, stats, baseline_stats in entries:
+            for metric in COMPARED_METRICS:
+                current, previous = stats[metric], baseline_stats[metric]
+                if current > previous * (1 + tolerance) and current - previous > min_delta_ms:
+                    regressions.append(f'{name} {entry} {metric}: {previous:.2f} -> {current:.2f} ms '
+                                       f'(+{100 * (current / previous - 1):.0f}%)')
+
+        current, previous = planner_results['throughput_hz'], planner_baseline['throughput_hz']
+        if current * (1 + tolerance) < previous:
+            regressions.append(f'{name} throughput: {previous:.2f} -> {current:.2f} Hz')
+
+    return regressions
+
+
+def print_results(results):
+    for name, planner_results in results['planners'].items():
+        print(f"\n{name}: {planner_results['num_ticks']} ticks, {planner_results['throughput_hz']:.2f} ticks/s")
+        rows = [('end_to_end', planner_results['end_to_end'])] + list(planner_results['stages'].items())
+        print(f"{'stage':<24}{'mean':>10}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}  [ms]")
+        for stage, stats in rows:
+            print(f"{stage:<24}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+                  f"{stats['p99_ms']:>10.2f}{stats['max_ms']:>10.2f}")
+        if 'allocations' in planner_results:
+            allocations = planner_results['allocations']
+            print(f"python heap per tick: peak {allocations['peak_kb_mean']:.1f} KB (max {allocations['peak_kb_max']:.1f} KB), "
+                  f"retained {allocations['retained_kb_per_tick']:.1f} KB")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Planner tick benchmark on recorded scenario replays')
+    parser.add_argument('--replay_dir', type=str, required=True, help='replays recorded by benchmark/record_replays.py or written by benchmark/synthetic_replay.py')
+    parser.add_argument('--planners', type=str, nargs='+', default=PLANNERS, choices=PLANNERS)
+    parser.add_argument('--tokenizer_path', type=str, default=None, help='llama tokenizer with the <map> tokens, required by llama4drive')
+    parser.add_argument('--max_replays', type=int, default=None)
+    parser.add_argument('--warmup', type=int, default=3, help='ticks per replay not measured')
+    parser.add_argument('--threads', type=int, default=1, help='torch intra-op threads')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--llm_inf_step', type=int, default=1)
+    parser.add_argument('--pdm_scorer', action='store_true', help='run llama4drive with the pdm scorer over multiple ref paths')
+    parser.add_argument('--lane_store', action='store_true')
+    parser.add_argument('--gameformer_backend', type=str, default=None, choices=['eager', 'torchscript', 'export'],
+                        help='run gameformer through the cpu inference engine')
+    parser.add_argument('--quantize', action='store_true', help='dynamic int8 quantization of gameformer')
+    parser.add_argument('--allocations', action='store_true', help='also trace python heap allocations per tick')
+    parser.add_argument('--output', type=str, default=None, help='json file to write the results to')
+    parser.add_argument('--baseline', type=str, default=None, help='json results to compare against')
+    parser.add_argument('--save_baseline', action='store_true', help='write the results to --baseline instead of comparing')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative slow down reported as a regression')
+    parser.add_argument('--min_delta_ms', type=float, default=0.5, help='absolute slow down reported as a regression')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    torch.set_num_threads(args.threads)
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    random.seed(args.seed)
+
+    replays = load_replays(args.replay_dir)[:args.max_replays]
+    if len(replays) == 0:
+        raise ValueError(f'No replays found in {args.replay_dir}')
+    planners = args.planners
+    if 'llama4drive' in planners and args.tokenizer_path is None:
+        logging.warning('llama4drive needs --tokenizer_path, skipped')
+        planners = [name for name in planners if name != 'llama4drive']
+
+    results = {
+        'meta': {
+            'num_replays': len(replays),
+            'warmup': args.warmup,
+            'threads': args.threads,
+            'python': platform.python_version(),
+            'torch': torch.__version__,
+            'machine': platform.machine(),
+        },
+        'planners': {},
+    }
+    with torch.no_grad():
+        for name in planners:
+            print(f'Benchmarking {name} on {len(replays)} replays')
+            results['planners'][name] = run_planner(name, replays, args)
+            if args.allocations:
+                results['planners'][name]['allocations'] = trace_allocations(name, replays, args)
+    print_results(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        if args.save_baseline:
+            with open(args.baseline, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'\nSaved baseline to {args.baseline}')
+        else:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)
+            regressions = compare_to_baseline(results, baseline, args.tolerance, args.min_delta_ms)
+            if len(regressions) > 0:
+                print('\nRegressions against the baseline:')
+                for regression in regressions:
+                    print(f'  {regression}')
+                sys.exit(1)
+            print('\nNo regression against the baseline')
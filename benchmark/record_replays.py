@@ -0,0 +1,39 @@
+import os
+import sys
+import argparse
+
+from tqdm import tqdm
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.replay import record_replay, save_replay
+from data_generation.utils import get_filter_parameters
+from llama2.utils.common_utils import get_scenario_map
+from nuplan.planning.utils.multithreading.worker_parallel import SingleMachineParallelExecutor
+from nuplan.planning.scenario_builder.scenario_filter import ScenarioFilter
+from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_builder import NuPlanScenarioBuilder
+from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_utils import ScenarioMapping
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Record scenario replays for the planner benchmark')
+    parser.add_argument('--data_path', type=str, help='path to raw data')
+    parser.add_argument('--map_path', type=str, help='path to map data')
+    parser.add_argument('--save_path', type=str, help='path to save the replays')
+    parser.add_argument('--scenarios_per_type', type=int, default=1, help='number of scenarios per type')
+    parser.add_argument('--total_scenarios', type=int, default=None, help='limit total number of scenarios')
+    parser.add_argument('--num_ticks', type=int, default=50, help='number of ticks recorded per scenario')
+    parser.add_argument('--map_radius', type=float, default=200.0, help='[m] map patch radius around the ego trajectory')
+    args = parser.parse_args()
+
+    map_version = "nuplan-maps-v1.0"
+    scenario_mapping = ScenarioMapping(scenario_map=get_scenario_map(), subsample_ratio_override=0.5)
+    builder = NuPlanScenarioBuilder(args.data_path, args.map_path, None, None, map_version, scenario_mapping=scenario_mapping)
+    scenario_filter = ScenarioFilter(*get_filter_parameters(args.scenarios_per_type, args.total_scenarios, False))
+    worker = SingleMachineParallelExecutor(use_process_pool=True)
+    scenarios = builder.get_scenarios(scenario_filter, worker)
+    print(f"Total number of scenarios: {len(scenarios)}")
+
+    for scenario in tqdm(scenarios):
+        replay = record_replay(scenario, num_ticks=args.num_ticks, map_radius=args.map_radius)
+        save_replay(replay, args.save_path)
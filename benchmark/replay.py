@@ -0,0 +1,258 @@
+import os
+import glob
+import pickle
+import logging
+from dataclasses import dataclass, field
+from typing import Dict, List
+
+import numpy as np
+from shapely.geometry import box
+from shapely.ops import unary_union
+
+from nuplan.common.actor_state.ego_state import EgoState
+from nuplan.common.maps.nuplan_map.nuplan_map import NuPlanMap
+from nuplan.database.maps_db.imapsdb import IMapsDB
+from nuplan.planning.simulation.history.simulation_history_buffer import SimulationHistoryBuffer
+from nuplan.planning.simulation.observation.observation_type import DetectionsTracks
+from nuplan.planning.simulation.planner.abstract_planner import PlannerInitialization, PlannerInput
+from nuplan.planning.simulation.simulation_time_controller.simulation_iteration import SimulationIteration
+
+
+# layers referenced by id from other layers, cropped by whole roadblocks / roadblock connectors
+ROADBLOCK_LAYER = 'lane_groups_polygons'
+ROADBLOCK_CONNECTOR_LAYER = 'lane_group_connectors'
+LANE_LAYER = 'lanes_polygons'
+LANE_CONNECTOR_LAYER = 'lane_connectors'
+LANE_CONNECTOR_POLYGON_LAYER = 'gen_lane_connectors_scaled_width_polygons'
+# layers only queried by location, cropped to the region covered by the kept roadblocks
+SPATIAL_LAYERS = [
+    'baseline_paths', 'boundaries', 'intersections', 'stop_polygons', 'crosswalks', 'walkways', 'carpark_areas',
+    'road_segments', 'generic_drivable_areas',
+]
+
+
+class PatchMapsDB(IMapsDB):
+    """
+    In-memory maps db holding a cropped copy of the vector layers of one map.
+    NuPlanMap pickles as (maps_db, map_name), so a NuPlanMap on top of it is a small self-contained fixture map.
+    """
+    def __init__(self, map_name, vector_layers, map_version=''):
+        self._map_name = map_name
+        self._vector_layers = vector_layers
+        self._map_version = map_version
+
+    def load_layer(self, location, layer_name):
+        raise NotImplementedError(f'Raster layers are not stored in map patches, requested {layer_name}')
+
+    def layer_names(self, location):
+        return []
+
+    def load_vector_layer(self, location, layer_name):
+        assert location == self._map_name, f'Map patch of {self._map_name} has no layers of {location}'
+        return self._vector_layers[layer_name].copy()
+
+    def vector_layer_names(self, location):
+        return list(self._vector_layers.keys())
+
+    def purge_cache(self):
+        pass
+
+    def get_version(self, location):
+        return self._map_version
+
+    def get_map_version(self):
+        return self._map_version
+
+
+def _int_ids(values):
+    return values.to_numpy().astype(np.int64)
+
+
+def crop_map(map_api, region, route_roadblock_ids):
+    """
+    Crop the vector layers of map_api to the roadblocks and roadblock connectors intersecting region, plus the route.
+    Lane graph references stay consistent: every kept connector also keeps the roadblocks it connects.
+    :param region: shapely geometry in global frame.
+    :return: NuPlanMap on a PatchMapsDB.
+    """
+    layers = {}
+    for layer_name in [ROADBLOCK_LAYER, ROADBLOCK_CONNECTOR_LAYER, LANE_LAYER, LANE_CONNECTOR_LAYER,
+                       LANE_CONNECTOR_POLYGON_LAYER] + SPATIAL_LAYERS:
+        layers[layer_name] = map_api._load_vector_map_layer(layer_name)
+
+    route_ids = set(int(roadblock_id) for roadblock_id in route_roadblock_ids)
+    roadblocks, connectors = layers[ROADBLOCK_LAYER], layers[ROADBLOCK_CONNECTOR_LAYER]
+    roadblock_ids = set(_int_ids(roadblocks['fid'][roadblocks.intersects(region)])) | \
+        (route_ids & set(_int_ids(roadblocks['fid'])))
+    connector_mask = connectors.intersects(region).to_numpy() | np.isin(_int_ids(connectors['fid']), list(route_ids))
+    connectors = connectors[connector_mask]
+    roadblock_ids |= set(_int_ids(connectors['from_lane_group_fid'])) | set(_int_ids(connectors['to_lane_group_fid']))
+    connector_ids = set(_int_ids(connectors['fid']))
+
+    cropped = {
+        ROADBLOCK_LAYER: roadblocks[np.isin(_int_ids(roadblocks['fid']), list(roadblock_ids))],
+        ROADBLOCK_CONNECTOR_LAYER: connectors,
+    }
+    lanes = layers[LANE_LAYER]
+    cropped[LANE_LAYER] = lanes[np.isin(_int_ids(lanes['lane_group_fid']), list(roadblock_ids))]
+    lane_connectors = layers[LANE_CONNECTOR_LAYER]
+    cropped[LANE_CONNECTOR_LAYER] = lane_connectors[
+        np.isin(_int_ids(lane_connectors['lane_group_connector_fid']), list(connector_ids))]
+    lane_connector_polygons = layers[LANE_CONNECTOR_POLYGON_LAYER]
+    cropped[LANE_CONNECTOR_POLYGON_LAYER] = lane_connector_polygons[
+        np.isin(_int_ids(lane_connector_polygons['lane_connector_fid']), _int_ids(cropped[LANE_CONNECTOR_LAYER]['fid']))]
+
+    # the kept roadblocks may reach beyond region along the route
+    kept = unary_union(list(cropped[ROADBLOCK_LAYER].geometry) + list(cropped[ROADBLOCK_CONNECTOR_LAYER].geometry) + [region])
+    spatial_region = box(*kept.bounds).buffer(10.0)
+    for layer_name in SPATIAL_LAYERS:
+        layer = layers[layer_name]
+        cropped[layer_name] = layer[layer.intersects(spatial_region)]
+
+    logging.info(f'Cropped {map_api.map_name} to {len(cropped[LANE_LAYER])} lanes, '
+                 f'{len(cropped[LANE_CONNECTOR_LAYER])} lane connectors')
+    return NuPlanMap(PatchMapsDB(map_api.map_name, cropped), map_api.map_name)
+
+
+@dataclass
+class ScenarioReplay:
+    """
+    Recorded open-loop replay of a scenario: the expert ego states and tracked objects of the first ticks,
+    the traffic lights per tick and a map patch around the ego.
+    It answers the few scenario queries of the planners (expert future, route, mission goal), so it is also
+    passed as the scenario of the planners and of the planner inputs.
+    """
+    scenario_name: str
+    scenario_type: str
+    log_name: str
+    token: str
+    database_interval: float
+    map_api: NuPlanMap
+    route_roadblock_ids: List[str]
+    mission_goal: object
+    buffer_size: int
+    num_past: int  # number of states before the first tick
+    iterations: List[SimulationIteration]
+    ego_states: List[EgoState]  # past, one per tick, then the expert future after the last tick
+    observations: List[DetectionsTracks]  # past and one per tick
+    traffic_light_data: List[list]  # one list per tick
+    metadata: Dict[str, object] = field(default_factory=dict)
+
+    @property
+    def num_ticks(self):
+        return len(self.iterations)
+
+    @property
+    def initial_ego_state(self):
+        return self.ego_states[self.num_past]
+
+    def get_route_roadblock_ids(self):
+        return self.route_roadblock_ids
+
+    def get_mission_goal(self):
+        return self.mission_goal
+
+    def get_number_of_iterations(self):
+        return self.num_ticks
+
+    def get_ego_state_at_iteration(self, iteration):
+        return self.ego_states[self.num_past + iteration]
+
+    def get_traffic_light_status_at_iteration(self, iteration):
+        return iter(self.traffic_light_data[iteration])
+
+    def get_ego_future_trajectory(self, iteration, time_horizon, num_samples=None):
+        """
+        Expert states after iteration, num_samples of them spread evenly over time_horizon
+        (every recorded state if num_samples is None), clipped to the end of the recording.
+        """
+        step = time_horizon / num_samples if num_samples else self.database_interval
+        num_samples = num_samples or int(round(time_horizon / self.database_interval))
+        current = self.num_past + iteration
+        offsets = np.round((np.arange(num_samples) + 1) * step / self.database_interval).astype(np.int64)
+        indices = np.minimum(current + offsets, len(self.ego_states) - 1)
+        return [self.ego_states[i] for i in indices]
+
+    def planner_initialization(self):
+        return PlannerInitialization(
+            route_roadblock_ids=self.route_roadblock_ids,
+            mission_goal=self.mission_goal,
+            map_api=self.map_api,
+        )
+
+    def planner_inputs(self):
+        """
+        PlannerInputs of the ticks, with the history buffer the simulation would hold when replaying the log.
+        """
+        for tick, iteration in enumerate(self.iterations):
+            end = self.num_past + tick + 1
+            history = SimulationHistoryBuffer.initialize_from_list(
+                buffer_size=self.buffer_size,
+                ego_states=self.ego_states[:end],
+                observations=self.observations[:end],
+                sample_interval=self.database_interval,
+            )
+            yield PlannerInput(
+                iteration=iteration,
+                history=history,
+                traffic_light_data=list(self.traffic_light_data[tick]),
+                scenario=self,
+            )
+
+
+def record_replay(scenario, num_ticks=50, map_radius=200.0, history_duration=2.0, future_horizon=15.0):
+    """
+    Record the first num_ticks ticks of a scenario for replaying it without the nuplan database.
+    :param map_radius: [m] the map patch covers the ego trajectory buffered by map_radius, plus the route.
+    :param history_duration: [s] history buffer duration, as simulation_history_buffer_duration of the simulation.
+    :param future_horizon: [s] expert future kept after the last tick, for the planners that look it up.
+    """
+    interval = scenario.database_interval
+    num_ticks = min(num_ticks, scenario.get_number_of_iterations())
+    # same buffer as Simulation.initialize: the past of iteration 0 and the state at iteration 0
+    buffer_size = int((history_duration + interval) / interval) + 1
+    buffer_duration = buffer_size * interval
+    past_ego_states = list(scenario.get_ego_past_trajectory(iteration=0, time_horizon=buffer_duration, num_samples=buffer_size))
+    past_observations = list(scenario.get_past_tracked_objects(iteration=0, time_horizon=buffer_duration, num_samples=buffer_size))
+
+    ego_states = past_ego_states + [scenario.get_ego_state_at_iteration(i) for i in range(num_ticks)]
+    observations = past_observations + [scenario.get_tracked_objects_at_iteration(i) for i in range(num_ticks)]
+    ego_states += list(scenario.get_ego_future_trajectory(iteration=num_ticks - 1, time_horizon=future_horizon))
+
+    route_roadblock_ids = scenario.get_route_roadblock_ids()
+    ego_path = [(state.rear_axle.x, state.rear_axle.y) for state in ego_states]
+    region = box(*np.min(ego_path, axis=0), *np.max(ego_path, axis=0)).buffer(map_radius)
+
+    return ScenarioReplay(
+        scenario_name=scenario.scenario_name,
+        scenario_type=scenario.scenario_type,
+        log_name=scenario.log_name,
+        token=scenario.token,
+        database_interval=interval,
+        map_api=crop_map(scenario.map_api, region, route_roadblock_ids),
+        route_roadblock_ids=route_roadblock_ids,
+        mission_goal=scenario.get_mission_goal(),
+        buffer_size=buffer_size,
+        num_past=len(past_ego_states),
+        iterations=[SimulationIteration(scenario.get_time_point(i), i) for i in range(num_ticks)],
+        ego_states=ego_states,
+        observations=observations,
+        traffic_light_data=[list(scenario.get_traffic_light_status_at_iteration(i)) for i in range(num_ticks)],
+        metadata={'map_radius': map_radius},
+    )
+
+
+def save_replay(replay, replay_dir):
+    os.makedirs(replay_dir, exist_ok=True)
+    path = os.path.join(replay_dir, f'{replay.log_name}_{replay.token}.pkl')
+    with open(path, 'wb') as f:
+        pickle.dump(replay, f, protocol=pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def load_replays(replay_dir):
+    replays = []
+    for path in sorted(glob.glob(os.path.join(replay_dir, '*.pkl'))):
+        with open(path, 'rb') as f:
+            replays.append(pickle.load(f))
+    return replays
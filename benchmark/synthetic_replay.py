@@ -0,0 +1,213 @@
+import os
+import sys
+import argparse
+
+import numpy as np
+import geopandas as gpd
+from shapely.geometry import LineString, box
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark.replay import PatchMapsDB, ScenarioReplay, save_replay
+from nuplan.common.actor_state.agent import Agent
+from nuplan.common.actor_state.ego_state import EgoState
+from nuplan.common.actor_state.oriented_box import OrientedBox
+from nuplan.common.actor_state.scene_object import SceneObjectMetadata
+from nuplan.common.actor_state.state_representation import StateSE2, StateVector2D, TimePoint
+from nuplan.common.actor_state.static_object import StaticObject
+from nuplan.common.actor_state.tracked_objects import TrackedObjects
+from nuplan.common.actor_state.tracked_objects_types import TrackedObjectType
+from nuplan.common.actor_state.vehicle_parameters import get_pacifica_parameters
+from nuplan.common.maps.maps_datatypes import TrafficLightStatusData, TrafficLightStatusType
+from nuplan.common.maps.nuplan_map.nuplan_map import NuPlanMap
+from nuplan.planning.simulation.observation.observation_type import DetectionsTracks
+from nuplan.planning.simulation.simulation_time_controller.simulation_iteration import SimulationIteration
+
+
+MAP_NAME = 'synthetic_straight_road'
+LANE_WIDTH = 3.5  # [m]
+SPEED_LIMIT = 15.0  # [m/s]
+ROADBLOCK_LENGTH, CONNECTOR_LENGTH = 50.0, 10.0  # [m]
+# id offsets of the map objects
+ROADBLOCK_ID, CONNECTOR_ID, LANE_ID, LANE_CONNECTOR_ID, BOUNDARY_ID, INTERSECTION_ID = 1000, 2000, 10000, 20000, 30000, 40000
+
+
+def _layer(rows, columns):
+    """GeoDataFrame indexed by the string fid, as GPKGMapsDB loads the layers"""
+    layer = gpd.GeoDataFrame(rows, columns=columns + ['geometry'], geometry='geometry')
+    layer['fid'] = layer['fid'].astype(str)
+    return layer.set_index(layer['fid'].to_numpy())
+
+
+def _strip(x_start, x_end, y_left, y_right):
+    return box(x_start, y_right, x_end, y_left)
+
+
+def straight_road_layers(num_roadblocks=6, num_lanes=2):
+    """
+    Vector layers of a straight road along +x: roadblocks of num_lanes lanes joined by roadblock connectors (small
+    intersections), lane 0 on the left (y = 0 to -LANE_WIDTH). Only the columns read by NuPlanMap are filled.
+    :return: dict of layer name -> GeoDataFrame, list of the route roadblock ids.
+    """
+    rows = {name: [] for name in [
+        'lane_groups_polygons', 'lane_group_connectors', 'lanes_polygons', 'lane_connectors',
+        'gen_lane_connectors_scaled_width_polygons', 'baseline_paths', 'boundaries', 'intersections', 'road_segments',
+    ]}
+    assert num_lanes < 10, 'The boundary ids hold up to 9 lanes'
+    route_roadblock_ids = []
+    width = num_lanes * LANE_WIDTH
+    step = ROADBLOCK_LENGTH + CONNECTOR_LENGTH
+    for i in range(num_roadblocks):
+        x_start, x_end = i * step, i * step + ROADBLOCK_LENGTH
+        roadblock_id = ROADBLOCK_ID + i
+        route_roadblock_ids.append(str(roadblock_id))
+        rows['lane_groups_polygons'].append([roadblock_id, _strip(x_start, x_end, 0, -width)])
+        rows['road_segments'].append([roadblock_id, _strip(x_start, x_end, 0, -width)])
+        for k in range(num_lanes + 1):
+            rows['boundaries'].append([BOUNDARY_ID + 20 * i + k, LineString([(x_start, -k * LANE_WIDTH), (x_end, -k * LANE_WIDTH)])])
+        for j in range(num_lanes):
+            lane_id = LANE_ID + 10 * i + j
+            y = -(j + 0.5) * LANE_WIDTH
+            rows['lanes_polygons'].append([lane_id, lane_id, roadblock_id, j, BOUNDARY_ID + 20 * i + j, BOUNDARY_ID + 20 * i + j + 1,
+                                           SPEED_LIMIT, _strip(x_start, x_end, -j * LANE_WIDTH, -(j + 1) * LANE_WIDTH)])
+            rows['baseline_paths'].append([lane_id, lane_id, np.nan, LineString([(x_start, y), (x_end, y)])])
+
+        if i == num_roadblocks - 1:
+            break
+        # connector to the next roadblock
+        x_start, x_end = x_end, x_end + CONNECTOR_LENGTH
+        connector_id = CONNECTOR_ID + i
+        route_roadblock_ids.append(str(connector_id))
+        rows['lane_group_connectors'].append([connector_id, roadblock_id, roadblock_id + 1, INTERSECTION_ID + i,
+                                              _strip(x_start, x_end, 0, -width)])
+        rows['intersections'].append([INTERSECTION_ID + i, _strip(x_start, x_end, 0, -width)])
+        for k in range(num_lanes + 1):
+            rows['boundaries'].append([BOUNDARY_ID + 20 * i + 10 + k,
+                                       LineString([(x_start, -k * LANE_WIDTH), (x_end, -k * LANE_WIDTH)])])
+        for j in range(num_lanes):
+            lane_connector_id = LANE_CONNECTOR_ID + 10 * i + j
+            y = -(j + 0.5) * LANE_WIDTH
+            baseline = LineString([(x_start, y), (x_end, y)])
+            rows['lane_connectors'].append([lane_connector_id, LANE_ID + 10 * i + j, LANE_ID + 10 * (i + 1) + j,
+                                            connector_id, SPEED_LIMIT, '', baseline])
+            rows['gen_lane_connectors_scaled_width_polygons'].append([
+                lane_connector_id, lane_connector_id, BOUNDARY_ID + 20 * i + 10 + j, BOUNDARY_ID + 20 * i + 10 + j + 1,
+                _strip(x_start, x_end, -j * LANE_WIDTH, -(j + 1) * LANE_WIDTH)])
+            rows['baseline_paths'].append([lane_connector_id, np.nan, lane_connector_id, baseline])
+
+    layers = {
+        'lane_groups_polygons': _layer(rows['lane_groups_polygons'], ['fid']),
+        'lane_group_connectors': _layer(rows['lane_group_connectors'],
+                                        ['fid', 'from_lane_group_fid', 'to_lane_group_fid', 'intersection_fid']),
+        'lanes_polygons': _layer(rows['lanes_polygons'], ['fid', 'lane_fid', 'lane_group_fid', 'lane_index',
+                                                          'left_boundary_fid', 'right_boundary_fid', 'speed_limit_mps']),
+        'lane_connectors': _layer(rows['lane_connectors'], ['fid', 'exit_lane_fid', 'entry_lane_fid', 'lane_group_connector_fid',
+                                                            'speed_limit_mps', 'traffic_light_stop_line_fids']),
+        'gen_lane_connectors_scaled_width_polygons': _layer(rows['gen_lane_connectors_scaled_width_polygons'],
+                                                            ['fid', 'lane_connector_fid', 'left_boundary_fid', 'right_boundary_fid']),
+        'baseline_paths': _layer(rows['baseline_paths'], ['fid', 'lane_fid', 'lane_connector_fid']),
+        'boundaries': _layer(rows['boundaries'], ['fid']),
+        'intersections': _layer(rows['intersections'], ['fid']),
+        'road_segments': _layer(rows['road_segments'], ['fid']),
+        'stop_polygons': _layer([], ['fid', 'stop_polygon_type_fid']),
+    }
+    for layer_name in ['crosswalks', 'walkways', 'carpark_areas', 'generic_drivable_areas']:
+        layers[layer_name] = _layer([], ['fid'])
+
+    return layers, route_roadblock_ids
+
+
+def _ego_state(x, y, speed, time_us):
+    return EgoState.build_from_rear_axle(
+        StateSE2(x, y, 0.0),
+        rear_axle_velocity_2d=StateVector2D(speed, 0.0),
+        rear_axle_acceleration_2d=StateVector2D(0.0, 0.0),
+        tire_steering_angle=0.0,
+        time_point=TimePoint(time_us),
+        vehicle_parameters=get_pacifica_parameters(),
+    )
+
+
+def _detections(agents, time_s, time_us):
+    """
+    :param agents: list of (type, x0, y, speed, length, width), moving along +x.
+    """
+    objects = []
+    for track_id, (object_type, x0, y, speed, length, width) in enumerate(agents):
+        oriented_box = OrientedBox(StateSE2(x0 + speed * time_s, y, 0.0), length, width, 1.5)
+        metadata = SceneObjectMetadata(time_us, f'{time_us}_{track_id}', track_id, f'track_{track_id}')
+        if object_type in [TrackedObjectType.VEHICLE, TrackedObjectType.PEDESTRIAN, TrackedObjectType.BICYCLE]:
+            objects.append(Agent(object_type, oriented_box, StateVector2D(speed, 0.0), metadata))
+        else:
+            objects.append(StaticObject(object_type, oriented_box, metadata))
+    return DetectionsTracks(TrackedObjects(objects))
+
+
+def build_synthetic_replay(num_ticks=20, num_roadblocks=6, num_lanes=2, speed=8.0, num_vehicles=6, seed=0,
+                           database_interval=0.1, history_duration=2.0, future_horizon=15.0):
+    """
+    Replay of the ego driving at constant speed in lane 0 of a synthetic straight road, among vehicles in every lane,
+    a pedestrian on the side of the road and a cone, with green lights on the first lane connectors.
+    It exercises the same planner code paths as the recorded replays, without the nuplan database and maps.
+    """
+    rng = np.random.default_rng(seed)
+    layers, route_roadblock_ids = straight_road_layers(num_roadblocks, num_lanes)
+    map_api = NuPlanMap(PatchMapsDB(MAP_NAME, layers), MAP_NAME)
+
+    buffer_size = int((history_duration + database_interval) / database_interval) + 1
+    num_future = int(round(future_horizon / database_interval))
+    num_states = buffer_size + num_ticks + num_future
+    start_x, ego_y = 10.0, -0.5 * LANE_WIDTH
+    road_length = num_roadblocks * (ROADBLOCK_LENGTH + CONNECTOR_LENGTH) - CONNECTOR_LENGTH
+    assert start_x + speed * num_states * database_interval < road_length, 'The road is too short for the replay'
+
+    agents = [(TrackedObjectType.VEHICLE, start_x + rng.uniform(10, 60), -(rng.integers(num_lanes) + 0.5) * LANE_WIDTH,
+               rng.uniform(0.5, 1.2) * speed, 4.8, 2.0) for _ in range(num_vehicles)]
+    agents.append((TrackedObjectType.PEDESTRIAN, start_x + 30.0, 2.0, 1.2, 0.6, 0.6))
+    agents.append((TrackedObjectType.TRAFFIC_CONE, start_x + 80.0, -num_lanes * LANE_WIDTH - 0.5, 0.0, 0.5, 0.5))
+
+    start_us = 1_600_000_000_000_000
+    ego_states, observations = [], []
+    for step in range(num_states):
+        time_s = step * database_interval
+        time_us = start_us + int(round(time_s * 1e6))
+        ego_states.append(_ego_state(start_x + speed * time_s, ego_y, speed, time_us))
+        if step < buffer_size + num_ticks:
+            observations.append(_detections(agents, time_s, time_us))
+
+    iterations = [SimulationIteration(ego_states[buffer_size + tick].time_point, tick) for tick in range(num_ticks)]
+    lane_connector_ids = [LANE_CONNECTOR_ID + j for j in range(num_lanes)]
+    traffic_light_data = [
+        [TrafficLightStatusData(TrafficLightStatusType.GREEN, lane_connector_id, iteration.time_point.time_us)
+         for lane_connector_id in lane_connector_ids]
+        for iteration in iterations
+    ]
+
+    return ScenarioReplay(
+        scenario_name=f'{MAP_NAME}_{seed}',
+        scenario_type=MAP_NAME,
+        log_name='synthetic',
+        token=f'{MAP_NAME}_{seed}',
+        database_interval=database_interval,
+        map_api=map_api,
+        route_roadblock_ids=route_roadblock_ids,
+        mission_goal=StateSE2(road_length - 10.0, ego_y, 0.0),
+        buffer_size=buffer_size,
+        num_past=buffer_size,
+        iterations=iterations,
+        ego_states=ego_states,
+        observations=observations,
+        traffic_light_data=traffic_light_data,
+        metadata={'synthetic': True, 'seed': seed},
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write synthetic scenario replays for the planner benchmark')
+    parser.add_argument('--save_path', type=str, required=True, help='path to save the replays')
+    parser.add_argument('--num_replays', type=int, default=2)
+    parser.add_argument('--num_ticks', type=int, default=20, help='number of ticks per replay')
+    args = parser.parse_args()
+
+    for seed in range(args.num_replays):
+        print(save_replay(build_synthetic_replay(num_ticks=args.num_ticks, seed=seed), args.save_path))
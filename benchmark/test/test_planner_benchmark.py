@@ -0,0 +1,109 @@
+import copy
+import pickle
+import unittest
+from types import SimpleNamespace
+
+from nuplan.common.actor_state.state_representation import Point2D
+from nuplan.common.maps.maps_datatypes import SemanticMapLayer
+
+from benchmark.planner_benchmark import compare_to_baseline, run_planner
+from benchmark.synthetic_replay import build_synthetic_replay
+
+
+def make_stats(p50_ms, p95_ms):
+    return {'num_samples': 10, 'mean_ms': p50_ms, 'max_ms': p95_ms, 'p50_ms': p50_ms, 'p95_ms': p95_ms, 'p99_ms': p95_ms}
+
+
+def make_results(p50_ms, p95_ms, throughput_hz, stages=None):
+    return {'planners': {'gameformer': {
+        'num_ticks': 10,
+        'throughput_hz': throughput_hz,
+        'end_to_end': make_stats(p50_ms, p95_ms),
+        'stages': {stage: make_stats(*latencies) for stage, latencies in (stages or {}).items()},
+    }}}
+
+
+class TestCompareToBaseline(unittest.TestCase):
+    """Test the regression check of the planner benchmark"""
+
+    def setUp(self):
+        self.baseline = make_results(10.0, 20.0, 50.0, stages={'planning': (5.0, 8.0)})
+
+    def _compare(self, results):
+        return compare_to_baseline(results, self.baseline, tolerance=0.1, min_delta_ms=0.5)
+
+    def test_no_regression(self):
+        self.assertEqual(self._compare(copy.deepcopy(self.baseline)), [])
+        # faster everywhere
+        self.assertEqual(self._compare(make_results(5.0, 10.0, 100.0, stages={'planning': (1.0, 2.0)})), [])
+
+    def test_relative_threshold(self):
+        """A slow down above min_delta_ms but within tolerance is not a regression"""
+        self.assertEqual(self._compare(make_results(10.9, 21.9, 50.0, stages={'planning': (5.4, 8.7)})), [])
+
+    def test_absolute_threshold(self):
+        """A slow down above tolerance but within min_delta_ms is not a regression"""
+        baseline = make_results(1.0, 2.0, 50.0)
+        self.assertEqual(compare_to_baseline(make_results(1.4, 2.4, 50.0), baseline, tolerance=0.1, min_delta_ms=0.5), [])
+        regressions = compare_to_baseline(make_results(1.6, 2.4, 50.0), baseline, tolerance=0.1, min_delta_ms=0.5)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('gameformer end_to_end p50_ms'))
+
+    def test_regressions(self):
+        """A slow down above both thresholds is reported per stage and metric"""
+        regressions = self._compare(make_results(12.0, 20.0, 50.0, stages={'planning': (5.0, 10.0)}))
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(regressions[0].startswith('gameformer end_to_end p50_ms'))
+        self.assertTrue(regressions[1].startswith('gameformer planning p95_ms'))
+
+    def test_throughput(self):
+        """Throughput regresses when it drops by more than tolerance"""
+        self.assertEqual(self._compare(make_results(10.0, 20.0, 46.0, stages={'planning': (5.0, 8.0)})), [])
+        regressions = self._compare(make_results(10.0, 20.0, 45.0, stages={'planning': (5.0, 8.0)}))
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith('gameformer throughput'))
+
+    def test_missing_entries(self):
+        """Planners and stages not in the baseline are not compared"""
+        results = make_results(100.0, 200.0, 1.0, stages={'planning': (5.0, 8.0), 'new_stage': (50.0, 80.0)})
+        results['planners']['pdm_hybrid'] = copy.deepcopy(results['planners']['gameformer'])
+        regressions = self._compare(results)
+        self.assertTrue(all(regression.startswith('gameformer') for regression in regressions))
+        self.assertFalse(any('new_stage' in regression for regression in regressions))
+
+
+class TestSyntheticReplay(unittest.TestCase):
+    """Test the synthetic replay fixture of the benchmark"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.replay = build_synthetic_replay(num_ticks=5)
+
+    def test_replay(self):
+        replay = pickle.loads(pickle.dumps(self.replay))
+        self.assertEqual(replay.num_ticks, 5)
+        self.assertEqual(len(list(replay.planner_inputs())), 5)
+        self.assertEqual(len(replay.ego_states) - replay.num_past - replay.num_ticks,
+                         len(replay.get_ego_future_trajectory(replay.num_ticks - 1, 15.0)))
+
+        # the ego drives on the route
+        map_api = replay.planner_initialization().map_api
+        ego_state = replay.initial_ego_state
+        point = Point2D(ego_state.rear_axle.x, ego_state.rear_axle.y)
+        roadblock = map_api.get_one_map_object(point, SemanticMapLayer.ROADBLOCK)
+        self.assertIn(roadblock.id, replay.route_roadblock_ids)
+        lane = map_api.get_one_map_object(point, SemanticMapLayer.LANE)
+        self.assertEqual(lane.index, 0)
+        self.assertEqual(len(roadblock.outgoing_edges), 1)
+        self.assertEqual([edge.id for edge in lane.outgoing_edges[0].outgoing_edges], [str(int(lane.id) + 10)])
+
+    def test_gameformer_benchmark(self):
+        """The benchmark runs on the synthetic replay"""
+        args = SimpleNamespace(warmup=2, lane_store=False, gameformer_backend=None, quantize=False)
+        results = run_planner('gameformer', [self.replay], args)
+        self.assertEqual(results['num_ticks'], 3)
+        self.assertGreater(results['throughput_hz'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
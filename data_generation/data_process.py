@@ -1,13 +1,21 @@
 import os
+import glob
 import json
+import socket
 import argparse
+import threading
 from tqdm import tqdm
 import pickle
 from llama2.utils.common_utils import *
 from llama2.utils.data_utils import *
 from gameformer.data_utils import *
+from data_generation.scenario_cache import ScenarioCache
+from gameformer.sample_store import SampleStoreWriter
 import matplotlib.pyplot as plt
 from nuplan.planning.utils.multithreading.worker_parallel import SingleMachineParallelExecutor
+from nuplan.planning.utils.multithreading.worker_pool import Task
+from nuplan.planning.utils.multithreading.worker_ray import RayDistributed
+from nuplan.planning.utils.multithreading.worker_sequential import Sequential
 from nuplan.planning.scenario_builder.scenario_filter import ScenarioFilter
 from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_builder import NuPlanScenarioBuilder
 from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_utils import ScenarioMapping
@@ -25,8 +33,10 @@ class DirectionDecision:
     
 # define data processor
 class DataProcessor(object):
-    def __init__(self, scenarios):
+    def __init__(self, scenarios, bulk_extraction=True):
         self._scenarios = scenarios
+        # load each scenario once with ScenarioCache instead of querying the db for every frame
+        self._bulk_extraction = bulk_extraction
 
         self.past_time_horizon = 2 # [seconds] 向前回溯时间长度
         self.num_past_poses = 10 * self.past_time_horizon # 回溯轨迹点数，采样率为 10 HZ
@@ -198,9 +208,115 @@ class DataProcessor(object):
         plt.gca().set_aspect('equal')
         plt.tight_layout() # 自动调整子图参数，使各元素不会重叠
 
+    def load_scenario(self, scenario):
+        if not self._bulk_extraction:
+            return scenario
+        return ScenarioCache(scenario, past_time_horizon=self.past_time_horizon, future_time_horizon=self.future_time_horizon)
+
     def save_to_disk(self, dir, data):
         np.savez(f"{dir}/np_data/{data['map_name']}_{data['token']}_{data['iter']}.npz", **data)
 
+    def process_frame(self, scenario, iter, save_dir, debug=False, store_writer=None):
+        """
+        Build the sample of one frame of scenario and save its npz to save_dir/np_data.
+        :param store_writer: SampleStoreWriter appending the sample to a shard of the sample store instead of the npz.
+        :return: prompt data of the sample, None when the ego is not on a lane.
+        """
+        map_name = scenario._map_name
+        token = scenario.token
+        self.scenario = scenario
+        self.map_api = scenario.map_api  
+        self.current_ego_state = scenario.get_ego_state_at_iteration(iter)      
+
+        # get agent (ego and neighbor) past tracks
+        ego_agent_past, time_stamps_past = self.get_ego_agent(iteration=iter)
+        neighbor_agents_past, neighbor_agents_types = self.get_neighbor_agents(iteration=iter)
+        ego_agent_past, neighbor_agents_past, neighbor_indices = \
+            agent_past_process(ego_agent_past, time_stamps_past, neighbor_agents_past, neighbor_agents_types, self.num_agents)
+
+        # get vector set map
+        vector_map = self.get_map(iteration=iter)
+
+        # get agent future tracks
+        ego_agent_future = self.get_ego_agent_future(iteration=iter) # 返回未来的相对轨迹点
+        instruction, prompt = self.get_instruction(ego_agent_future, return_prompt=True) # 返回 命令-距离列表和指令列表
+        neighbor_agents_future = self.get_neighbor_agents_future(neighbor_indices, iteration=iter) # 返回指定索引 neighbor_indices 对应 agent 的未来轨迹
+        
+        # for ego_v_a_predictor
+        # current_ego_state = scenario.get_ego_state_at_iteration(iter)
+        # 从 current_ego_state 中分别提取后轴线速度和加速度，再拼接为 current_v_a
+        current_ego_state = self.current_ego_state
+        cur_v = current_ego_state.dynamic_car_state.rear_axle_velocity_2d 
+        current_v = np.array([cur_v.x, cur_v.y])
+        cur_a = current_ego_state.dynamic_car_state.rear_axle_acceleration_2d
+        current_a = np.array([cur_a.x, cur_a.y])
+        current_v_a = np.array([cur_v.x, cur_v.y, cur_a.x, cur_a.y])
+        
+        # neighbour_lane
+        current_lane = find_current_lane(self.map_api, current_ego_state.car_footprint.center)
+        if current_lane is None:
+            return None
+        neighbour_lane_id = current_lane.adjacent_edges
+        # 用 1,0 表示左/右侧各自是否存在相邻车道
+        left_lane = np.array([1]) if neighbour_lane_id[0] is not None else np.array([0])
+        right_lane = np.array([1]) if neighbour_lane_id[1] is not None else np.array([0])
+        neighbour_lane = np.array([left_lane, right_lane])
+        
+        # acceleration_classification 加减速判断
+        # 用当前速度向量 current_v 与 0.5s 后加速度向量内积判断 
+        # 正值且明显 --> 加速，负值且明显 --> 减速，否则：保持速度
+        ego_future_state = scenario.get_ego_future_trajectory(iter, time_horizon=0.5, num_samples=1)
+        future_acc = [s.dynamic_car_state.rear_axle_acceleration_2d.array for s in ego_future_state][0]
+        dot_product = current_v[0] * future_acc[0] + current_v[1] * future_acc[1]
+        if dot_product>0.1:
+            acc_classification = np.array([1,0,0]) #acc
+        elif dot_product<-0.1:
+            acc_classification = np.array([0,1,0]) #dec
+        else:
+            acc_classification = np.array([0,0,1]) #keep
+        
+        # lane_change
+        # 在给定 5s, 50 个采样点的未来轨迹，检测是否发生变道，用 [1]/[0] 标记 “变道” 或 “未变道”
+        ego_future_state_long_horizon = scenario.get_ego_future_trajectory(iter, time_horizon=5, num_samples=50)
+        ego_future_state_long_horizon = [s for s in ego_future_state_long_horizon]
+        lane_change_data = find_lane_change(ego_future_state_long_horizon, self.map_api) # list of LaneChangeData, include duration, start lane, final lane...
+        if len(lane_change_data)==0:
+            lane_change = np.array([0]) # not change
+        else:
+            lane_change = np.array([1]) # change
+    
+        # traffic light
+        # current_lane = find_current_lane(map_api, current_ego_state.car_footprint.center)
+        # 返回解释：
+        # traffic_light_for_lanes : 针对左右车道的 one-hot 灯色编码
+        # ego_lane_flag : 自车当前车道是否有信号灯
+        # distance : 自车到信号灯的距离
+        traffic_light_ls = scenario.get_traffic_light_status_at_iteration(iter)
+        traffic_light_for_lanes, ego_lane_flag, distance = encode_traffic_light(current_lane, traffic_light_ls, current_ego_state.car_footprint.center) # traffic_light_for_lanes is one hot vector
+
+        # gather data
+        data = {"map_name": map_name, "token": token, "ego_agent_past": ego_agent_past, "ego_agent_future": ego_agent_future,
+                "neighbor_agents_past": neighbor_agents_past, "neighbor_agents_future": neighbor_agents_future, "instruction": instruction, "iter": iter,
+                "ego_v_a": current_v_a, "neighbour_lane": neighbour_lane, "acc_classification": acc_classification, "lane_change": lane_change, "traffic_light": traffic_light_for_lanes, "ego_lane_flag": ego_lane_flag}
+        data.update(vector_map)
+
+        # visualization
+        if debug:
+            self.plot_scenario(data)
+        # save to disk
+        prompt_data = {}
+        prompt_data['input'] = f"Role: You are now an autonomous driving driver, and I will provide you with the environment information including Ego Car Information, Agents Information and Map Information.\n\nEnvironment: <map>\n\nNevigation instructions: {prompt}\n\nYou need to fully understand environmental information, discover important information in the environment, and predict future actions.\n\nFinal Answer:\n\n"
+        prompt_data['target'] = ''
+        # prompt_data['map_info'] = f"{save_dir}/map/{map_name}_{token}_{iter}.npz"
+        prompt_data['map_info'] = f"{save_dir}/np_data/{data['map_name']}_{data['token']}_{data['iter']}.npz"
+        if not debug:
+            if store_writer is not None:
+                prompt_data['map_info'] = store_writer.append(data)
+            else:
+                self.save_to_disk(save_dir, data)
+
+        return prompt_data
+
     # debug :
     def work(self, save_dir, debug=False, start_s=None):
         prompt_data_ls = []
@@ -210,105 +326,140 @@ class DataProcessor(object):
         # 遍历每个场景 ii 为编号，共 save_iter = 100 个
         for ii, scenario in enumerate(scenario_ls):
             print(f"Processing scenario: {ii}/{len(scenario_ls)}", flush=True) 
+            scenario = self.load_scenario(scenario)
             # 遍历该场景中每个时刻（帧）
             for iter in tqdm(range(len(scenario._lidarpc_tokens))):
                 # if iter%80!=0:
                 #     continue
-                map_name = scenario._map_name
-                token = scenario.token
-                self.scenario = scenario
-                self.map_api = scenario.map_api  
-                self.current_ego_state = scenario.get_ego_state_at_iteration(iter)      
-
-                # get agent (ego and neighbor) past tracks
-                ego_agent_past, time_stamps_past = self.get_ego_agent(iteration=iter)
-                neighbor_agents_past, neighbor_agents_types = self.get_neighbor_agents(iteration=iter)
-                ego_agent_past, neighbor_agents_past, neighbor_indices = \
-                    agent_past_process(ego_agent_past, time_stamps_past, neighbor_agents_past, neighbor_agents_types, self.num_agents)
-
-                # get vector set map
-                vector_map = self.get_map(iteration=iter)
-
-                # get agent future tracks
-                ego_agent_future = self.get_ego_agent_future(iteration=iter) # 返回未来的相对轨迹点
-                instruction, prompt = self.get_instruction(ego_agent_future, return_prompt=True) # 返回 命令-距离列表和指令列表
-                neighbor_agents_future = self.get_neighbor_agents_future(neighbor_indices, iteration=iter) # 返回指定索引 neighbor_indices 对应 agent 的未来轨迹
-                
-                # for ego_v_a_predictor
-                # current_ego_state = scenario.get_ego_state_at_iteration(iter)
-                # 从 current_ego_state 中分别提取后轴线速度和加速度，再拼接为 current_v_a
-                current_ego_state = self.current_ego_state
-                cur_v = current_ego_state.dynamic_car_state.rear_axle_velocity_2d 
-                current_v = np.array([cur_v.x, cur_v.y])
-                cur_a = current_ego_state.dynamic_car_state.rear_axle_acceleration_2d
-                current_a = np.array([cur_a.x, cur_a.y])
-                current_v_a = np.array([cur_v.x, cur_v.y, cur_a.x, cur_a.y])
-                
-                # neighbour_lane
-                current_lane = find_current_lane(self.map_api, current_ego_state.car_footprint.center)
-                if current_lane is None:
-                    continue
-                neighbour_lane_id = current_lane.adjacent_edges
-                # 用 1,0 表示左/右侧各自是否存在相邻车道
-                left_lane = np.array([1]) if neighbour_lane_id[0] is not None else np.array([0])
-                right_lane = np.array([1]) if neighbour_lane_id[1] is not None else np.array([0])
-                neighbour_lane = np.array([left_lane, right_lane])
-                
-                # acceleration_classification 加减速判断
-                # 用当前速度向量 current_v 与 0.5s 后加速度向量内积判断 
-                # 正值且明显 --> 加速，负值且明显 --> 减速，否则：保持速度
-                ego_future_state = scenario.get_ego_future_trajectory(iter, time_horizon=0.5, num_samples=1)
-                future_acc = [s.dynamic_car_state.rear_axle_acceleration_2d.array for s in ego_future_state][0]
-                dot_product = current_v[0] * future_acc[0] + current_v[1] * future_acc[1]
-                if dot_product>0.1:
-                    acc_classification = np.array([1,0,0]) #acc
-                elif dot_product<-0.1:
-                    acc_classification = np.array([0,1,0]) #dec
-                else:
-                    acc_classification = np.array([0,0,1]) #keep
-                
-                # lane_change
-                # 在给定 5s, 50 个采样点的未来轨迹，检测是否发生变道，用 [1]/[0] 标记 “变道” 或 “未变道”
-                ego_future_state_long_horizon = scenario.get_ego_future_trajectory(iter, time_horizon=5, num_samples=50)
-                ego_future_state_long_horizon = [s for s in ego_future_state_long_horizon]
-                lane_change_data = find_lane_change(ego_future_state_long_horizon, self.map_api) # list of LaneChangeData, include duration, start lane, final lane...
-                if len(lane_change_data)==0:
-                    lane_change = np.array([0]) # not change
-                else:
-                    lane_change = np.array([1]) # change
-            
-                # traffic light
-                # current_lane = find_current_lane(map_api, current_ego_state.car_footprint.center)
-                # 返回解释：
-                # traffic_light_for_lanes : 针对左右车道的 one-hot 灯色编码
-                # ego_lane_flag : 自车当前车道是否有信号灯
-                # distance : 自车到信号灯的距离
-                traffic_light_ls = scenario.get_traffic_light_status_at_iteration(iter)
-                traffic_light_for_lanes, ego_lane_flag, distance = encode_traffic_light(current_lane, traffic_light_ls, current_ego_state.car_footprint.center) # traffic_light_for_lanes is one hot vector
-
-                # gather data
-                data = {"map_name": map_name, "token": token, "ego_agent_past": ego_agent_past, "ego_agent_future": ego_agent_future,
-                        "neighbor_agents_past": neighbor_agents_past, "neighbor_agents_future": neighbor_agents_future, "instruction": instruction, "iter": iter,
-                        "ego_v_a": current_v_a, "neighbour_lane": neighbour_lane, "acc_classification": acc_classification, "lane_change": lane_change, "traffic_light": traffic_light_for_lanes, "ego_lane_flag": ego_lane_flag}
-                data.update(vector_map)
-
-                # visualization
-                if debug:
-                    self.plot_scenario(data)
-                # save to disk
-                prompt_data = {}
-                prompt_data['input'] = f"Role: You are now an autonomous driving driver, and I will provide you with the environment information including Ego Car Information, Agents Information and Map Information.\n\nEnvironment: <map>\n\nNevigation instructions: {prompt}\n\nYou need to fully understand environmental information, discover important information in the environment, and predict future actions.\n\nFinal Answer:\n\n"
-                prompt_data['target'] = ''
-                # prompt_data['map_info'] = f"{save_dir}/map/{map_name}_{token}_{iter}.npz"
-                prompt_data['map_info'] = f"{save_dir}/np_data/{data['map_name']}_{data['token']}_{data['iter']}.npz"
-                prompt_data_ls.append(prompt_data)
-                if not debug:
-                    self.save_to_disk(save_dir, data)
+                prompt_data = self.process_frame(scenario, iter, save_dir, debug)
+                if prompt_data is not None:
+                    prompt_data_ls.append(prompt_data)
             
         if not debug:
-            with open(f"{save_dir}/jsons/{data['map_name']}_part_{start_s}.json", 'w') as f:
+            with open(f"{save_dir}/jsons/{scenario_ls[-1]._map_name}_part_{start_s}.json", 'w') as f:
                 json.dump(prompt_data_ls, f, indent=2)
-            
+
+SHARD_DIR = 'shards'
+STORE_DIR = 'store'
+STORAGES = ['npz', 'columnar']
+
+
+def shard_name():
+    # one shard per worker process / thread, appended by it only
+    return f"{socket.gethostname()}_{os.getpid()}_{threading.get_ident()}"
+
+
+def _ends_with_newline(path):
+    if os.path.getsize(path) == 0:
+        return True
+    with open(path, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b'\n'
+
+
+def load_manifest(save_dir):
+    """
+    Read the shards of save_dir. Each shard line records one completed frame: its scenario token, iteration and
+    prompt data (None for skipped frames), written after the frame npz.
+    :return: dict of (token, iteration) -> prompt data.
+    """
+    manifest = {}
+    for shard_path in sorted(glob.glob(f"{save_dir}/{SHARD_DIR}/*.jsonl")):
+        with open(shard_path, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    # line cut by a worker killed while writing it
+                    continue
+                manifest[(entry['token'], entry['iter'])] = entry['prompt_data']
+
+    return manifest
+
+
+def process_scenarios(scenarios, pending_iters, save_dir, bulk_extraction=True, storage='npz'):
+    """
+    Worker task: process the pending iterations of scenarios and record them in the shard of the worker.
+    With the columnar storage, the samples go to the sample store shard of the same name in save_dir/store.
+    :return: number of processed frames.
+    """
+    processor = DataProcessor(scenarios, bulk_extraction)
+    os.makedirs(f"{save_dir}/{SHARD_DIR}", exist_ok=True)
+    store_writer = SampleStoreWriter(f"{save_dir}/{STORE_DIR}", shard_name()) if storage == 'columnar' else None
+    num_frames = 0
+    shard_path = f"{save_dir}/{SHARD_DIR}/{shard_name()}.jsonl"
+    with open(shard_path, 'a') as shard:
+        if not _ends_with_newline(shard_path):
+            # end the line cut by a killed run of the same worker, load_manifest skips it
+            shard.write('\n')
+        for scenario, iters in zip(scenarios, pending_iters):
+            scenario = processor.load_scenario(scenario)
+            for iter in iters:
+                prompt_data = processor.process_frame(scenario, iter, save_dir, store_writer=store_writer)
+                shard.write(json.dumps({'token': scenario.token, 'iter': iter, 'prompt_data': prompt_data}) + '\n')
+                shard.flush()
+                num_frames += 1
+    if store_writer is not None:
+        store_writer.close()
+
+    return num_frames
+
+
+def merge_shards(save_dir, index_name):
+    """
+    Merge the shards of save_dir into one json index, ordered by scenario token and iteration.
+    """
+    manifest = load_manifest(save_dir)
+    prompt_data_ls = [manifest[key] for key in sorted(manifest) if manifest[key] is not None]
+    index_path = f"{save_dir}/{index_name}"
+    with open(index_path, 'w') as f:
+        json.dump(prompt_data_ls, f, indent=2)
+    print(f"Merged {len(prompt_data_ls)} samples of {len(manifest)} frames into {index_path}")
+
+    return index_path
+
+
+def build_worker(worker, num_workers=None):
+    if worker == 'sequential':
+        return Sequential()
+    if worker == 'single_machine_thread_pool':
+        return SingleMachineParallelExecutor(use_process_pool=False, max_workers=num_workers)
+    if worker == 'single_machine_process_pool':
+        return SingleMachineParallelExecutor(use_process_pool=True, max_workers=num_workers)
+    if worker == 'ray_distributed':
+        return RayDistributed(threads_per_node=num_workers)
+    raise ValueError(f"Unknown worker {worker}")
+
+
+def process_dataset(scenarios, save_dir, worker, scenarios_per_task=1, index_name='data_index.json', bulk_extraction=True,
+                    storage='npz'):
+    """
+    Process all frames of scenarios on worker, skipping the frames already recorded in the shards of save_dir,
+    then merge the shards into save_dir/index_name. Killed runs are resumed by running again.
+    :param storage: 'npz', one npz file per sample in save_dir/np_data, or 'columnar', the memory mapped sample store
+        in save_dir/store (see gameformer/sample_store.py).
+    """
+    if storage not in STORAGES:
+        raise ValueError(f"Unknown storage {storage}, should be in {STORAGES}")
+    manifest = load_manifest(save_dir)
+    pending_scenarios, pending_iters = [], []
+    for scenario in scenarios:
+        iters = [iter for iter in range(len(scenario._lidarpc_tokens)) if (scenario.token, iter) not in manifest]
+        if len(iters) > 0:
+            pending_scenarios.append(scenario)
+            pending_iters.append(iters)
+    print(f"{len(manifest)} frames done, {sum(len(iters) for iters in pending_iters)} frames of "
+          f"{len(pending_scenarios)} scenarios to process")
+
+    if len(pending_scenarios) > 0:
+        scenario_chunks = [pending_scenarios[i:i+scenarios_per_task] for i in range(0, len(pending_scenarios), scenarios_per_task)]
+        iter_chunks = [pending_iters[i:i+scenarios_per_task] for i in range(0, len(pending_iters), scenarios_per_task)]
+        num_frames = worker.map(Task(fn=process_scenarios), scenario_chunks, iter_chunks, save_dir, bulk_extraction,
+                                storage, verbose=True)
+        print(f"Processed {sum(num_frames)} frames")
+
+    return merge_shards(save_dir, index_name)
+
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Data Processing')
@@ -322,6 +473,14 @@ if __name__ == "__main__":
     parser.add_argument('--debug', action="store_true", help='if visualize the data output', default=False)
     parser.add_argument('--start_s', type=int, default=None, help='scenario start to process')
     parser.add_argument('--scenario_cache', '-c', type=str, default=None, help='cache')
+    parser.add_argument('--worker', type=str, default=None, help='process all scenarios on a worker pool instead of the start_s slice: '
+                        'sequential, single_machine_thread_pool, single_machine_process_pool or ray_distributed')
+    parser.add_argument('--num_workers', type=int, default=None, help='worker threads / processes per node')
+    parser.add_argument('--scenarios_per_task', type=int, default=1, help='scenarios per worker task')
+    parser.add_argument('--index_name', type=str, default='data_index.json', help='merged json index in save_path')
+    parser.add_argument('--per_frame_queries', action='store_true', help='query the db for every frame instead of once per scenario')
+    parser.add_argument('--storage', type=str, default='npz', choices=STORAGES, help='sample format of the worker pool: '
+                        'one npz per sample in np_data, or the memory mapped columnar store in store')
     args = parser.parse_args()
 
     # create save folder
@@ -353,5 +512,9 @@ if __name__ == "__main__":
     # process data
 
     
-    processor = DataProcessor(scenarios)
-    processor.work(args.save_path, debug=args.debug, start_s=args.start_s)
+    if args.worker is not None:
+        process_dataset(scenarios, args.save_path, build_worker(args.worker, args.num_workers),
+                        args.scenarios_per_task, args.index_name, not args.per_frame_queries, args.storage)
+    else:
+        processor = DataProcessor(scenarios, not args.per_frame_queries)
+        processor.work(args.save_path, debug=args.debug, start_s=args.start_s)
@@ -0,0 +1,151 @@
+from collections import defaultdict
+
+import numpy as np
+
+from nuplan.common.actor_state.ego_state import EgoState
+from nuplan.common.actor_state.state_representation import StateSE2, StateVector2D, TimePoint
+from nuplan.common.actor_state.tracked_objects import TrackedObjects
+from nuplan.common.actor_state.vehicle_parameters import get_pacifica_parameters
+from nuplan.database.nuplan_db.nuplan_scenario_queries import (
+    get_ego_poses_around_sensor_tokens_from_db,
+    get_tracked_objects_within_time_interval_from_db,
+    get_traffic_light_status_within_time_interval_from_db,
+)
+from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_utils import get_lidarpc_sensor_data
+from nuplan.planning.scenario_builder.scenario_utils import sample_indices_with_time_horizon
+from nuplan.planning.simulation.observation.observation_type import DetectionsTracks
+
+
+class ScenarioCache:
+    """
+    NuPlanScenario wrapper answering the per-frame queries of data generation from memory.
+    The ego poses of every lidar_pc from past_time_horizon before the first iteration to future_time_horizon after
+    the last one are loaded with one query into packed arrays, and the tracked objects and traffic lights of that
+    time span with one query each. Past / future windows are then sliced by row, sampled as NuPlanScenario samples
+    them from the db. Queries beyond the loaded horizons, or with future trajectories of the agents,
+    go to the wrapped scenario.
+    """
+    def __init__(self, scenario, past_time_horizon=2.0, future_time_horizon=8.0):
+        self._scenario = scenario
+        self._row_interval = scenario._database_row_interval
+        self._num_past_rows = int(past_time_horizon / self._row_interval) + 1
+        self._num_future_rows = int(future_time_horizon / self._row_interval) + 1
+
+        lidarpc_tokens = scenario._lidarpc_tokens
+        rows = list(get_ego_poses_around_sensor_tokens_from_db(
+            scenario._log_file, get_lidarpc_sensor_data(), lidarpc_tokens[0], lidarpc_tokens[-1],
+            self._num_past_rows, self._num_future_rows,
+        ))
+        row_index = {row[0]: idx for idx, row in enumerate(rows)}
+        self._iteration_rows = np.array([row_index[token] for token in lidarpc_tokens], dtype=np.int64)
+        self._timestamps = np.array([row[1] for row in rows], dtype=np.int64)
+        # x, y, heading, vx, vy, acceleration_x, acceleration_y
+        self._ego_poses = np.array([row[2:] for row in rows], dtype=np.float64).reshape(-1, 7)
+        # the query stops at the log boundaries, rows past them do not exist in the db either
+        self._first_row_is_log_start = self._iteration_rows[0] < self._num_past_rows
+        self._last_row_is_log_end = len(rows) - 1 - self._iteration_rows[-1] < self._num_future_rows
+
+        row_of_timestamp = {timestamp: idx for idx, timestamp in enumerate(self._timestamps.tolist())}
+        start_timestamp, end_timestamp = int(self._timestamps[0]), int(self._timestamps[-1])
+        self._tracked_objects = [[] for _ in rows]
+        for tracked_object in get_tracked_objects_within_time_interval_from_db(scenario._log_file, start_timestamp, end_timestamp):
+            row = row_of_timestamp.get(tracked_object.metadata.timestamp_us)
+            if row is not None:
+                self._tracked_objects[row].append(tracked_object)
+        self._traffic_lights = defaultdict(list)
+        for traffic_light in get_traffic_light_status_within_time_interval_from_db(scenario._log_file, start_timestamp, end_timestamp):
+            self._traffic_lights[traffic_light.timestamp].append(traffic_light)
+        self._detections = {}
+
+    def __getattr__(self, name):
+        # everything else is answered by the scenario
+        if name == '_scenario':
+            raise AttributeError(name)
+        return getattr(self._scenario, name)
+
+    def _sampled_rows(self, iteration, time_horizon, num_samples, future):
+        """
+        Rows of the samples, ascending, as get_sampled_ego_states_from_db returns them.
+        :return: None when the samples reach beyond the loaded rows.
+        """
+        num_samples = num_samples if num_samples else int(time_horizon / self._scenario.database_interval)
+        indices = np.array(sample_indices_with_time_horizon(num_samples, time_horizon, self._row_interval), dtype=np.int64)
+        row = self._iteration_rows[iteration]
+        if future:
+            rows = row + indices
+            if rows.max() >= len(self._timestamps) and not self._last_row_is_log_end:
+                return None
+            rows = rows[rows < len(self._timestamps)]
+        else:
+            rows = row - indices
+            if rows.min() < 0 and not self._first_row_is_log_start:
+                return None
+            rows = rows[rows >= 0]
+
+        return np.sort(rows)
+
+    def _ego_state(self, row):
+        x, y, heading, vx, vy, ax, ay = self._ego_poses[row]
+        return EgoState.build_from_rear_axle(
+            StateSE2(x, y, heading),
+            tire_steering_angle=0.0,
+            vehicle_parameters=get_pacifica_parameters(),
+            time_point=TimePoint(int(self._timestamps[row])),
+            rear_axle_velocity_2d=StateVector2D(vx, y=vy),
+            rear_axle_acceleration_2d=StateVector2D(x=ax, y=ay),
+        )
+
+    def _detections_tracks(self, row):
+        if row not in self._detections:
+            self._detections[row] = DetectionsTracks(TrackedObjects(self._tracked_objects[row]))
+        return self._detections[row]
+
+    def get_time_point(self, iteration):
+        return TimePoint(int(self._timestamps[self._iteration_rows[iteration]]))
+
+    def get_ego_state_at_iteration(self, iteration):
+        return self._ego_state(self._iteration_rows[iteration])
+
+    def get_tracked_objects_at_iteration(self, iteration, future_trajectory_sampling=None):
+        if future_trajectory_sampling is not None:
+            return self._scenario.get_tracked_objects_at_iteration(iteration, future_trajectory_sampling)
+        return self._detections_tracks(self._iteration_rows[iteration])
+
+    def get_traffic_light_status_at_iteration(self, iteration):
+        return iter(self._traffic_lights[int(self._timestamps[self._iteration_rows[iteration]])])
+
+    def get_ego_past_trajectory(self, iteration, time_horizon, num_samples=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=False)
+        if rows is None:
+            return self._scenario.get_ego_past_trajectory(iteration, time_horizon, num_samples)
+        return (self._ego_state(row) for row in rows)
+
+    def get_ego_future_trajectory(self, iteration, time_horizon, num_samples=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=True)
+        if rows is None:
+            return self._scenario.get_ego_future_trajectory(iteration, time_horizon, num_samples)
+        return (self._ego_state(row) for row in rows)
+
+    def get_past_timestamps(self, iteration, time_horizon, num_samples=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=False)
+        if rows is None:
+            return self._scenario.get_past_timestamps(iteration, time_horizon, num_samples)
+        return (TimePoint(int(self._timestamps[row])) for row in rows)
+
+    def get_future_timestamps(self, iteration, time_horizon, num_samples=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=True)
+        if rows is None:
+            return self._scenario.get_future_timestamps(iteration, time_horizon, num_samples)
+        return (TimePoint(int(self._timestamps[row])) for row in rows)
+
+    def get_past_tracked_objects(self, iteration, time_horizon, num_samples=None, future_trajectory_sampling=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=False)
+        if rows is None or future_trajectory_sampling is not None:
+            return self._scenario.get_past_tracked_objects(iteration, time_horizon, num_samples, future_trajectory_sampling)
+        return (self._detections_tracks(row) for row in rows)
+
+    def get_future_tracked_objects(self, iteration, time_horizon, num_samples=None, future_trajectory_sampling=None):
+        rows = self._sampled_rows(iteration, time_horizon, num_samples, future=True)
+        if rows is None or future_trajectory_sampling is not None:
+            return self._scenario.get_future_tracked_objects(iteration, time_horizon, num_samples, future_trajectory_sampling)
+        return (self._detections_tracks(row) for row in rows)
@@ -0,0 +1,110 @@
+import glob
+import json
+import os
+import tempfile
+import unittest
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from nuplan.planning.utils.multithreading.worker_sequential import Sequential
+
+from data_generation.data_process import SHARD_DIR, DataProcessor, load_manifest, merge_shards, process_dataset
+
+
+def make_scenario(token, num_iterations):
+    return SimpleNamespace(token=token, _lidarpc_tokens=[f'{token}_{iter}' for iter in range(num_iterations)])
+
+
+class StubProcessFrame:
+    """DataProcessor.process_frame stand-in recording the processed frames, frames with iter % 3 == 2 are skipped"""
+
+    def __init__(self):
+        self.frames = []
+
+    def __call__(self, processor, scenario, iter, save_dir, debug=False, store_writer=None):
+        self.frames.append((scenario.token, iter))
+        if iter % 3 == 2:
+            return None
+        return {'token': scenario.token, 'iter': iter, 'map_info': f'{save_dir}/np_data/{scenario.token}_{iter}.npz'}
+
+
+class TestProcessDataset(unittest.TestCase):
+    """Test the resume logic of the worker pool data generation"""
+
+    def setUp(self):
+        temp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temp_dir.cleanup)
+        self.save_dir = temp_dir.name
+        self.scenarios = [make_scenario('b', 4), make_scenario('a', 5), make_scenario('c', 3)]
+        self.all_frames = sorted((s.token, iter) for s in self.scenarios for iter in range(len(s._lidarpc_tokens)))
+        self.process_frame = StubProcessFrame()
+        patchers = [
+            patch.object(DataProcessor, 'process_frame', autospec=True, side_effect=self.process_frame),
+            patch.object(DataProcessor, 'load_scenario', autospec=True, side_effect=lambda processor, scenario: scenario),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def _process(self):
+        index_path = process_dataset(self.scenarios, self.save_dir, Sequential(), scenarios_per_task=2)
+        with open(index_path, 'r') as f:
+            return json.load(f)
+
+    def _shard_paths(self):
+        return sorted(glob.glob(f"{self.save_dir}/{SHARD_DIR}/*.jsonl"))
+
+    def test_run_twice(self):
+        """The second run processes nothing and merges the same index"""
+        index = self._process()
+        self.assertEqual(sorted(self.process_frame.frames), self.all_frames)
+        # ordered by token and iteration, skipped frames left out
+        self.assertEqual([(entry['token'], entry['iter']) for entry in index],
+                         [frame for frame in self.all_frames if frame[1] % 3 != 2])
+
+        self.process_frame.frames.clear()
+        self.assertEqual(self._process(), index)
+        self.assertEqual(self.process_frame.frames, [])
+
+    def test_skipped_frames(self):
+        """Skipped frames are recorded as None, so that they are not processed again"""
+        self._process()
+        manifest = load_manifest(self.save_dir)
+        self.assertEqual(sorted(manifest), self.all_frames)
+        self.assertEqual(sorted(key for key, prompt_data in manifest.items() if prompt_data is None),
+                         [frame for frame in self.all_frames if frame[1] % 3 == 2])
+
+    def test_truncated_line(self):
+        """A frame whose shard line was cut by a killed worker is processed again"""
+        index = self._process()
+        shard_path = self._shard_paths()[0]
+        with open(shard_path, 'r') as f:
+            lines = f.readlines()
+        last_frame = tuple(json.loads(lines[-1])[k] for k in ['token', 'iter'])
+        with open(shard_path, 'w') as f:
+            f.writelines(lines[:-1])
+            f.write(lines[-1][:len(lines[-1]) // 2])
+        self.assertNotIn(last_frame, load_manifest(self.save_dir))
+
+        self.process_frame.frames.clear()
+        self.assertEqual(self._process(), index)
+        self.assertEqual(self.process_frame.frames, [last_frame])
+
+    def test_merge_shards(self):
+        """Frames of several shards are merged, a frame recorded twice counts once"""
+        os.makedirs(f"{self.save_dir}/{SHARD_DIR}")
+        shards = {
+            'host_1': [('b', 0, {'token': 'b', 'iter': 0}), ('a', 1, None)],
+            'host_2': [('a', 0, {'token': 'a', 'iter': 0}), ('b', 0, {'token': 'b', 'iter': 0})],
+        }
+        for name, frames in shards.items():
+            with open(f"{self.save_dir}/{SHARD_DIR}/{name}.jsonl", 'w') as f:
+                for token, iter, prompt_data in frames:
+                    f.write(json.dumps({'token': token, 'iter': iter, 'prompt_data': prompt_data}) + '\n')
+
+        with open(merge_shards(self.save_dir, 'merged.json'), 'r') as f:
+            self.assertEqual(json.load(f), [{'token': 'a', 'iter': 0}, {'token': 'b', 'iter': 0}])
+
+
+if __name__ == '__main__':
+    unittest.main()
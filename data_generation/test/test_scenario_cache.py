@@ -0,0 +1,144 @@
+import unittest
+
+from nuplan.common.actor_state.vehicle_parameters import get_pacifica_parameters
+from nuplan.database.nuplan_db.nuplan_db_utils import get_lidarpc_sensor_data
+from nuplan.database.nuplan_db.nuplan_scenario_queries import (
+    get_end_sensor_time_from_db,
+    get_sampled_sensor_tokens_in_time_window_from_db,
+    get_sensor_data_token_timestamp_from_db,
+    get_sensor_token_by_index_from_db,
+    get_sensor_token_map_name_from_db,
+)
+from nuplan.database.tests.test_utils_nuplan_db import NUPLAN_DB_FILES
+from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario import NuPlanScenario
+from nuplan.planning.scenario_builder.nuplan_db.nuplan_scenario_utils import DEFAULT_SCENARIO_NAME, ScenarioExtractionInfo
+from nuplan.planning.scenario_builder.nuplan_db.test.nuplan_scenario_test_utils import (
+    DEFAULT_LIDARPC_INDEX,
+    NUPLAN_DATA_ROOT,
+    NUPLAN_MAP_VERSION,
+    NUPLAN_MAPS_ROOT,
+    NUPLAN_SENSOR_ROOT,
+)
+
+from data_generation.scenario_cache import ScenarioCache
+
+
+LOAD_PATH = NUPLAN_DB_FILES[4]
+# the horizons of DataProcessor
+PAST_TIME_HORIZON = 2
+FUTURE_TIME_HORIZON = 8
+# (time_horizon, num_samples) of the past / future queries of DataProcessor
+PAST_QUERIES = [(2, 20)]
+FUTURE_QUERIES = [(8, 80), (0.5, 1), (5, 50)]
+
+
+def build_scenario(token):
+    """20 s multi-sample scenario at 2 Hz, shorter when it reaches the end of the log"""
+    sensor_source = get_lidarpc_sensor_data()
+    return NuPlanScenario(
+        data_root=NUPLAN_DATA_ROOT,
+        log_file_load_path=LOAD_PATH,
+        initial_lidar_token=token,
+        initial_lidar_timestamp=get_sensor_data_token_timestamp_from_db(LOAD_PATH, sensor_source, token),
+        scenario_type=DEFAULT_SCENARIO_NAME,
+        map_root=NUPLAN_MAPS_ROOT,
+        map_version=NUPLAN_MAP_VERSION,
+        map_name=get_sensor_token_map_name_from_db(LOAD_PATH, sensor_source, token),
+        scenario_extraction_info=ScenarioExtractionInfo(subsample_ratio=0.1),
+        ego_vehicle_parameters=get_pacifica_parameters(),
+        sensor_root=NUPLAN_SENSOR_ROOT,
+    )
+
+
+def ego_state_values(ego_state):
+    return (
+        ego_state.time_point.time_us,
+        ego_state.rear_axle.x,
+        ego_state.rear_axle.y,
+        ego_state.rear_axle.heading,
+        ego_state.dynamic_car_state.rear_axle_velocity_2d.x,
+        ego_state.dynamic_car_state.rear_axle_velocity_2d.y,
+        ego_state.dynamic_car_state.rear_axle_acceleration_2d.x,
+        ego_state.dynamic_car_state.rear_axle_acceleration_2d.y,
+    )
+
+
+def tracked_objects_values(detections):
+    return sorted(
+        (obj.track_token, obj.tracked_object_type.name, obj.center.x, obj.center.y, obj.center.heading,
+         obj.velocity.x, obj.velocity.y, obj.box.length, obj.box.width)
+        for obj in detections.tracked_objects
+    )
+
+
+def traffic_lights_values(traffic_lights):
+    return sorted((tl.lane_connector_id, tl.status.name, tl.timestamp) for tl in traffic_lights)
+
+
+class TestScenarioCache(unittest.TestCase):
+    """Test that ScenarioCache answers the queries of data generation as the wrapped scenario"""
+
+    def _assert_ego_states_equal(self, cached, expected):
+        cached, expected = [ego_state_values(s) for s in cached], [ego_state_values(s) for s in expected]
+        self.assertEqual(len(cached), len(expected))
+        for cached_state, expected_state in zip(cached, expected):
+            self.assertEqual(cached_state[0], expected_state[0])
+            for cached_value, expected_value in zip(cached_state[1:], expected_state[1:]):
+                self.assertAlmostEqual(cached_value, expected_value, places=6)
+
+    def _assert_scenario_matches(self, scenario):
+        cache = ScenarioCache(scenario, past_time_horizon=PAST_TIME_HORIZON, future_time_horizon=FUTURE_TIME_HORIZON)
+        num_iterations = scenario.get_number_of_iterations()
+        self.assertGreater(num_iterations, 2)
+        iterations = sorted({0, 1, num_iterations // 2, num_iterations - 2, num_iterations - 1})
+
+        for iteration in iterations:
+            with self.subTest(iteration=iteration):
+                self.assertEqual(cache.get_time_point(iteration), scenario.get_time_point(iteration))
+                self._assert_ego_states_equal([cache.get_ego_state_at_iteration(iteration)],
+                                              [scenario.get_ego_state_at_iteration(iteration)])
+                self.assertEqual(tracked_objects_values(cache.get_tracked_objects_at_iteration(iteration).tracked_objects),
+                                 tracked_objects_values(scenario.get_tracked_objects_at_iteration(iteration).tracked_objects))
+                self.assertEqual(traffic_lights_values(cache.get_traffic_light_status_at_iteration(iteration)),
+                                 traffic_lights_values(scenario.get_traffic_light_status_at_iteration(iteration)))
+
+                for time_horizon, num_samples in PAST_QUERIES:
+                    self._assert_ego_states_equal(
+                        list(cache.get_ego_past_trajectory(iteration, time_horizon, num_samples)),
+                        list(scenario.get_ego_past_trajectory(iteration, time_horizon, num_samples)))
+                    self.assertEqual(list(cache.get_past_timestamps(iteration, time_horizon, num_samples)),
+                                     list(scenario.get_past_timestamps(iteration, time_horizon, num_samples)))
+                    self.assertEqual(
+                        [tracked_objects_values(d.tracked_objects) for d in cache.get_past_tracked_objects(iteration, time_horizon, num_samples)],
+                        [tracked_objects_values(d.tracked_objects) for d in scenario.get_past_tracked_objects(iteration, time_horizon, num_samples)])
+
+                for time_horizon, num_samples in FUTURE_QUERIES:
+                    self._assert_ego_states_equal(
+                        list(cache.get_ego_future_trajectory(iteration, time_horizon, num_samples)),
+                        list(scenario.get_ego_future_trajectory(iteration, time_horizon, num_samples)))
+                    self.assertEqual(list(cache.get_future_timestamps(iteration, time_horizon, num_samples)),
+                                     list(scenario.get_future_timestamps(iteration, time_horizon, num_samples)))
+                    self.assertEqual(
+                        [tracked_objects_values(d.tracked_objects) for d in cache.get_future_tracked_objects(iteration, time_horizon, num_samples)],
+                        [tracked_objects_values(d.tracked_objects) for d in scenario.get_future_tracked_objects(iteration, time_horizon, num_samples)])
+
+    def test_middle_of_log(self):
+        token = get_sensor_token_by_index_from_db(LOAD_PATH, get_lidarpc_sensor_data(), DEFAULT_LIDARPC_INDEX)
+        self._assert_scenario_matches(build_scenario(token))
+
+    def test_start_of_log(self):
+        """The past windows of the first iterations are cut by the start of the log"""
+        token = get_sensor_token_by_index_from_db(LOAD_PATH, get_lidarpc_sensor_data(), 0)
+        self._assert_scenario_matches(build_scenario(token))
+
+    def test_end_of_log(self):
+        """The future windows of the last iterations are cut by the end of the log"""
+        sensor_source = get_lidarpc_sensor_data()
+        end_timestamp = get_end_sensor_time_from_db(LOAD_PATH, sensor_source)
+        tokens = list(get_sampled_sensor_tokens_in_time_window_from_db(
+            LOAD_PATH, sensor_source, end_timestamp - 10 * 1000000, end_timestamp, 1))
+        self._assert_scenario_matches(build_scenario(tokens[0]))
+
+
+if __name__ == '__main__':
+    unittest.main()
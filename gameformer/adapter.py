@@ -7,42 +7,50 @@ except:
 from nuplan.planning.metrics.utils.expert_comparisons import principal_value
 
 
+PROJECTION_NEIGHBORS = 4 # path points compared per projected point
+
+
 def occupancy_adpter(predictions, scores, neighbors, ref_path):
     best_mode = np.argmax(scores.cpu().numpy(), axis=-1)
     predictions = predictions.cpu().numpy()
     neighbors = neighbors.cpu().numpy()
     
-    best_predictions = [predictions[i, best_mode[i], :, :2] for i in range(predictions.shape[0])]
-    prediction_F = [transform_to_Frenet(a, ref_path) for a in best_predictions]    
+    # project all agents and timesteps at once, (agents, T*10, 2)
+    best_predictions = predictions[np.arange(predictions.shape[0]), best_mode, :T*10, :2]
+    prediction_F = transform_to_Frenet(best_predictions, ref_path)
     len_path = ref_path.shape[0]
     if len_path < MAX_LEN * 10:
         ref_path = np.append(ref_path, np.repeat(ref_path[np.newaxis, -1], MAX_LEN*10-len(ref_path), axis=0), axis=0)
     
     time_occupancy = np.stack(T * 10 * [ref_path[:, -1]], axis=0) # (timestep, path_len)
 
-    for t in range(T * 10):
-        for n, a in enumerate(prediction_F):
-            if neighbors[n][0] == 0:
-                continue
-
-            if a[0][0] <= 0:
-                continue
-            
-            # intersect threshold
-            aw = neighbors[n][7]
-            threshold = aw * 0.5 + WIDTH * 0.5 + 0.3
-
-            # project to the path
-            if a[t][0] > 0 and np.abs(a[t][1]) < threshold:
-                al = neighbors[n][6]
-                backward = 0.5 * al + 3
-                forward = 0.5 * al
-                os = np.clip(a[t][0] - backward, 0, MAX_LEN)
-                oe = np.clip(a[t][0] + forward, 0, MAX_LEN)
-                time_occupancy[t][int(os*10):int(oe*10)] = 1
-
-        if len_path < MAX_LEN * 10:
-            time_occupancy[t][len_path:] = 1
+    # intersect threshold
+    aw = neighbors[:, 7]
+    threshold = aw * 0.5 + WIDTH * 0.5 + 0.3
+    valid_agent = (neighbors[:, 0] != 0) & (prediction_F[:, 0, 0] > 0)
+
+    # project to the path
+    s, l = prediction_F[..., 0], prediction_F[..., 1]
+    occupied = valid_agent[:, None] & (s > 0) & (np.abs(l) < threshold[:, None]) # (agents, timestep)
+    al = neighbors[:, 6]
+    backward = 0.5 * al + 3
+    forward = 0.5 * al
+    os = np.clip(s - backward[:, None], 0, MAX_LEN)
+    oe = np.clip(s + forward[:, None], 0, MAX_LEN)
+
+    # rasterize the [os, oe) intervals with a difference array over the path
+    agent_idx, t_idx = np.nonzero(occupied)
+    start = (os[agent_idx, t_idx] * 10).astype(np.int64)
+    end = (oe[agent_idx, t_idx] * 10).astype(np.int64)
+    non_empty = start < end
+    diff = np.zeros((T * 10, time_occupancy.shape[1] + 1), dtype=np.int64)
+    np.add.at(diff, (t_idx[non_empty], start[non_empty]), 1)
+    np.add.at(diff, (t_idx[non_empty], end[non_empty]), -1)
+    covered = np.cumsum(diff, axis=-1)[:, :-1] > 0
+    time_occupancy[covered] = 1
+
+    if len_path < MAX_LEN * 10:
+        time_occupancy[:, len_path:] = 1
 
     time_occupancy = np.reshape(time_occupancy, (T*10, -1, 10))
     time_occupancy = np.max(time_occupancy, axis=-1)
@@ -50,20 +58,48 @@ def occupancy_adpter(predictions, scores, neighbors, ref_path):
     return time_occupancy
 
 
+def project_to_path(points, ref_path):
+    """
+    Index of the closest ref path point for each of points (..., 2), the first one of the points at the same
+    distance (e.g. the padding at the end of the path), as the argmin over the full distance matrix gives.
+    """
+    path_points = ref_path[:, :2].astype(np.float64)
+    query_points = points.reshape(-1, 2).astype(np.float64)
+    unique_points, first_idx = np.unique(path_points, axis=0, return_index=True)
+    k = min(PROJECTION_NEIGHBORS, len(unique_points))
+    _, nearest = scipy.spatial.cKDTree(unique_points).query(query_points, k=list(range(1, k+1)))
+
+    # distances as cdist computes them, the first index among the neighbors tied at the minimum one
+    distance = np.sqrt(np.sum((query_points[:, None] - unique_points[nearest]) ** 2, axis=-1))
+    min_distance = np.min(distance, axis=-1, keepdims=True)
+    tied_idx = np.where(distance == min_distance, first_idx[nearest], len(path_points))
+    frenet_idx = np.min(tied_idx, axis=-1)
+
+    # more points than the neighbors queried may be tied (up to rounding), fall back to the full distance matrix
+    ambiguous = (distance[:, -1] <= min_distance[:, 0] * (1 + 1e-9) + 1e-12) & (k < len(unique_points))
+    if np.any(ambiguous):
+        distance_to_ref_path = scipy.spatial.distance.cdist(query_points[ambiguous], path_points)
+        frenet_idx[ambiguous] = np.argmin(distance_to_ref_path, axis=-1)
+
+    return frenet_idx.reshape(points.shape[:-1])
+
+
 def transform_to_Frenet(traj, ref_path):
-    distance_to_ref_path = scipy.spatial.distance.cdist(traj[:, :2], ref_path[:, :2])
-    frenet_idx = np.argmin(distance_to_ref_path, axis=-1)
+    """
+    :param traj: (..., 2) or (..., 3) with heading
+    """
+    frenet_idx = project_to_path(traj[..., :2], ref_path)
     ref_points = ref_path[frenet_idx]
     interval = 0.1
 
     frenet_s = interval * frenet_idx
-    e = np.sign((traj[:, 1] - ref_points[:, 1]) * np.cos(ref_points[:, 2]) - (traj[:, 0] - ref_points[:, 0]) * np.sin(ref_points[:, 2]))
-    frenet_l = np.linalg.norm(traj[:, :2] - ref_points[:, :2], axis=-1) * e 
+    e = np.sign((traj[..., 1] - ref_points[..., 1]) * np.cos(ref_points[..., 2]) - (traj[..., 0] - ref_points[..., 0]) * np.sin(ref_points[..., 2]))
+    frenet_l = np.linalg.norm(traj[..., :2] - ref_points[..., :2], axis=-1) * e 
 
     if traj.shape[-1] == 3:
-        frenet_h = principal_value(ref_points[:, 2] - traj[:, 2])
-        frenet_traj = np.column_stack([frenet_s, frenet_l, frenet_h])
+        frenet_h = principal_value(ref_points[..., 2] - traj[..., 2])
+        frenet_traj = np.stack([frenet_s, frenet_l, frenet_h], axis=-1)
     else:
-        frenet_traj = np.column_stack([frenet_s, frenet_l])
+        frenet_traj = np.stack([frenet_s, frenet_l], axis=-1)
 
     return frenet_traj
@@ -0,0 +1,70 @@
+import torch
+
+from nuplan.common.actor_state.tracked_objects_types import TrackedObjectType
+from nuplan.common.geometry.torch_geometry import global_state_se2_tensor_to_local
+from nuplan.planning.training.preprocessing.utils.agents_preprocessing import AgentInternalIndex, EgoInternalIndex
+
+
+def global_velocity_to_local(velocity, anchor_heading):
+    velocity_x = velocity[:, 0] * torch.cos(anchor_heading) + velocity[:, 1] * torch.sin(anchor_heading)
+    velocity_y = velocity[:, 1] * torch.cos(anchor_heading) - velocity[:, 0] * torch.sin(anchor_heading)
+
+    return torch.stack([velocity_x, velocity_y], dim=-1)
+
+
+def convert_absolute_quantities_to_relative(agent_state, ego_state, agent_type='ego'):
+    """
+    Converts the agent' poses and relative velocities from absolute to ego-relative coordinates.
+    :param agent_state: The agent states to convert, in the AgentInternalIndex schema.
+    :param ego_state: The ego state to convert, in the EgoInternalIndex schema.
+    :return: The converted states, in AgentInternalIndex schema.
+    """
+    ego_pose = torch.tensor(
+        [
+            float(ego_state[EgoInternalIndex.x()].item()),
+            float(ego_state[EgoInternalIndex.y()].item()),
+            float(ego_state[EgoInternalIndex.heading()].item()),
+        ],
+        dtype=torch.float64,
+    )
+
+    if agent_type == 'ego':
+        agent_global_poses = agent_state[:, [EgoInternalIndex.x(), EgoInternalIndex.y(), EgoInternalIndex.heading()]]
+        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
+        agent_state[:, EgoInternalIndex.x()] = transformed_poses[:, 0].float()
+        agent_state[:, EgoInternalIndex.y()] = transformed_poses[:, 1].float()
+        agent_state[:, EgoInternalIndex.heading()] = transformed_poses[:, 2].float()
+    else:
+        agent_global_poses = agent_state[:, [AgentInternalIndex.x(), AgentInternalIndex.y(), AgentInternalIndex.heading()]]
+        agent_global_velocities = agent_state[:, [AgentInternalIndex.vx(), AgentInternalIndex.vy()]]
+        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
+        transformed_velocities = global_velocity_to_local(agent_global_velocities, ego_pose[-1])
+        agent_state[:, AgentInternalIndex.x()] = transformed_poses[:, 0].float()
+        agent_state[:, AgentInternalIndex.y()] = transformed_poses[:, 1].float()
+        agent_state[:, AgentInternalIndex.heading()] = transformed_poses[:, 2].float()
+        agent_state[:, AgentInternalIndex.vx()] = transformed_velocities[:, 0].float()
+        agent_state[:, AgentInternalIndex.vy()] = transformed_velocities[:, 1].float()
+
+    return agent_state
+
+
+def convert_agent_frames_to_relative(agent_frames, ego_state):
+    """
+    convert_absolute_quantities_to_relative(..., 'agent') of every frame in a single batched transform.
+    :param agent_frames: list of [num_agents (may vary per frame), AgentInternalIndex.dim()] tensors, left unchanged.
+    :return: list of the converted frames.
+    """
+    num_agents = [len(frame) for frame in agent_frames]
+    agent_states = convert_absolute_quantities_to_relative(torch.cat(agent_frames, dim=0).clone(), ego_state, 'agent')
+
+    return list(torch.split(agent_states, num_agents, dim=0))
+
+
+def agent_types_to_one_hot(agent_types):
+    """
+    [1, 0, 0] vehicle, [0, 1, 0] pedestrian, [0, 0, 1] bicycle
+    """
+    type_idx = [0 if agent_type == TrackedObjectType.VEHICLE else 1 if agent_type == TrackedObjectType.PEDESTRIAN else 2
+                for agent_type in agent_types]
+
+    return torch.eye(3, dtype=torch.float32)[torch.tensor(type_idx, dtype=torch.long)]
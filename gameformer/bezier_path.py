@@ -28,6 +28,28 @@ def calc_4points_bezier_path(sx, sy, syaw, ex, ey, eyaw, offset, n_points=100):
     return path, control_points
 
 
+def calc_4points_bezier_paths(sx, sy, syaw, ex, ey, eyaw, offset, n_points=100):
+    """
+    calc_4points_bezier_path from one start to M end states at once.
+
+    :param ex, ey, eyaw: (numpy array) of shape (M,)
+    :return: (numpy array) paths of shape (M, n_points, 2)
+    """
+    ex, ey, eyaw = np.asarray(ex), np.asarray(ey), np.asarray(eyaw)
+    dist = np.hypot(sx - ex, sy - ey) / offset
+    control_points = np.stack(
+        [np.stack([np.full_like(ex, sx), np.full_like(ey, sy)], axis=-1),
+         np.stack([sx + dist * np.cos(syaw), sy + dist * np.sin(syaw)], axis=-1),
+         np.stack([ex - dist * np.cos(eyaw), ey - dist * np.sin(eyaw)], axis=-1),
+         np.stack([ex, ey], axis=-1)], axis=1) # (M, 4, 2)
+
+    t = np.linspace(0, 1, n_points)
+    n = control_points.shape[1] - 1
+    basis = np.stack([bernstein_poly(n, i, t) for i in range(n + 1)], axis=-1) # (n_points, 4)
+
+    return np.sum(basis[None, :, :, None] * control_points[:, None, :, :], axis=2)
+
+
 def calc_bezier_path(control_points, n_points=100):
     """
     Compute bezier path (trajectory) given control points.
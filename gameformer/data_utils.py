@@ -27,6 +27,12 @@ from nuplan.common.actor_state.state_representation import Point2D, StateSE2
 from nuplan.common.geometry.torch_geometry import vector_set_coordinates_to_local_frame
 from nuplan.planning.training.preprocessing.feature_builders.vector_builder_utils import *
 from nuplan.planning.training.preprocessing.utils.vector_preprocessing import interpolate_points
+try:
+    from map_utils import *
+    from agent_utils import *
+except:
+    from .map_utils import *
+    from .agent_utils import *
 
 
 def _extract_agent_tensor(tracked_objects, track_token_ids, object_types):
@@ -83,49 +89,6 @@ def sampled_tracked_objects_to_tensor_list(past_tracked_objects):
     return output, output_types
 
 
-def global_velocity_to_local(velocity, anchor_heading):
-    velocity_x = velocity[:, 0] * torch.cos(anchor_heading) + velocity[:, 1] * torch.sin(anchor_heading)
-    velocity_y = velocity[:, 1] * torch.cos(anchor_heading) - velocity[:, 0] * torch.sin(anchor_heading)
-
-    return torch.stack([velocity_x, velocity_y], dim=-1)
-
-
-def convert_absolute_quantities_to_relative(agent_state, ego_state, agent_type='ego'):
-    """
-    Converts the agent' poses and relative velocities from absolute to ego-relative coordinates.
-    :param agent_state: The agent states to convert, in the AgentInternalIndex schema.
-    :param ego_state: The ego state to convert, in the EgoInternalIndex schema.
-    :return: The converted states, in AgentInternalIndex schema.
-    """
-    ego_pose = torch.tensor(
-        [
-            float(ego_state[EgoInternalIndex.x()].item()),
-            float(ego_state[EgoInternalIndex.y()].item()),
-            float(ego_state[EgoInternalIndex.heading()].item()),
-        ],
-        dtype=torch.float64,
-    )
-
-    if agent_type == 'ego':
-        agent_global_poses = agent_state[:, [EgoInternalIndex.x(), EgoInternalIndex.y(), EgoInternalIndex.heading()]]
-        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
-        agent_state[:, EgoInternalIndex.x()] = transformed_poses[:, 0].float()
-        agent_state[:, EgoInternalIndex.y()] = transformed_poses[:, 1].float()
-        agent_state[:, EgoInternalIndex.heading()] = transformed_poses[:, 2].float()
-    else:
-        agent_global_poses = agent_state[:, [AgentInternalIndex.x(), AgentInternalIndex.y(), AgentInternalIndex.heading()]]
-        agent_global_velocities = agent_state[:, [AgentInternalIndex.vx(), AgentInternalIndex.vy()]]
-        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
-        transformed_velocities = global_velocity_to_local(agent_global_velocities, ego_pose[-1])
-        agent_state[:, AgentInternalIndex.x()] = transformed_poses[:, 0].float()
-        agent_state[:, AgentInternalIndex.y()] = transformed_poses[:, 1].float()
-        agent_state[:, AgentInternalIndex.heading()] = transformed_poses[:, 2].float()
-        agent_state[:, AgentInternalIndex.vx()] = transformed_velocities[:, 0].float()
-        agent_state[:, AgentInternalIndex.vy()] = transformed_velocities[:, 1].float()
-
-    return agent_state
-
-
 def agent_past_process(past_ego_states, past_time_stamps, past_tracked_objects, tracked_objects_types, num_agents):
     """
     This function process the data from the raw agent data.
@@ -160,14 +123,11 @@ def agent_past_process(past_ego_states, past_time_stamps, past_tracked_objects,
         # Return zero tensor when there are no agents in the scene
         agents_tensor = torch.zeros((len(agent_history), 0, agents_states_dim)).float()
     else:
-        local_coords_agent_states = []
         padded_agent_states = pad_agent_states(agent_history, reverse=True)
-
-        for agent_state in padded_agent_states:
-            local_coords_agent_states.append(convert_absolute_quantities_to_relative(agent_state, anchor_ego_state, 'agent'))
+        local_coords_agent_states = convert_agent_frames_to_relative(padded_agent_states, anchor_ego_state)
     
         # Calculate yaw rate
-        yaw_rate_horizon = compute_yaw_rate_from_state_tensors(padded_agent_states, time_stamps)
+        yaw_rate_horizon = compute_yaw_rate_from_state_tensors(local_coords_agent_states, time_stamps)
     
         agents_tensor = pack_agents_tensor(local_coords_agent_states, yaw_rate_horizon)
 
@@ -179,23 +139,18 @@ def agent_past_process(past_ego_states, past_time_stamps, past_tracked_objects,
         The num_agents is padded or trimmed to fit the predefined number of agents across.
         The num_frames includes both present and past frames.
     '''
-    agents = np.zeros(shape=(num_agents, agents_tensor.shape[0], agents_tensor.shape[-1]+3), dtype=np.float32)
+    agents = torch.zeros((num_agents, agents_tensor.shape[0], agents_tensor.shape[-1]+3), dtype=torch.float32)
 
     # sort agents according to distance to ego
     distance_to_ego = torch.norm(agents_tensor[-1, :, :2], dim=-1)
-    indices = list(torch.argsort(distance_to_ego).numpy())[:num_agents]
+    indices = torch.argsort(distance_to_ego)[:num_agents]
 
     # fill agent features into the array
-    for i, j in enumerate(indices):
-        agents[i, :, :agents_tensor.shape[-1]] = agents_tensor[:, j, :agents_tensor.shape[-1]].numpy()
-        if agent_types[j] == TrackedObjectType.VEHICLE:
-            agents[i, :, agents_tensor.shape[-1]:] = [1, 0, 0]
-        elif agent_types[j] == TrackedObjectType.PEDESTRIAN:
-            agents[i, :, agents_tensor.shape[-1]:] = [0, 1, 0]
-        else:
-            agents[i, :, agents_tensor.shape[-1]:] = [0, 0, 1]
+    agents[:len(indices), :, :agents_tensor.shape[-1]] = agents_tensor[:, indices].transpose(0, 1)
+    if len(indices) > 0:
+        agents[:len(indices), :, agents_tensor.shape[-1]:] = agent_types_to_one_hot([agent_types[i] for i in indices.tolist()])[:, None]
 
-    return ego_tensor.numpy().astype(np.float32), agents, indices
+    return ego_tensor.numpy().astype(np.float32), agents.numpy(), indices.tolist()
 
 
 def agent_future_process(anchor_ego_state, future_tracked_objects, num_agents, agent_index):
@@ -206,15 +161,13 @@ def agent_future_process(anchor_ego_state, future_tracked_objects, num_agents, a
                                      anchor_ego_state.dynamic_car_state.rear_axle_acceleration_2d.y])
     
     agent_future = filter_agents_tensor(future_tracked_objects)
-    local_coords_agent_states = []
-    for agent_state in agent_future:
-        local_coords_agent_states.append(convert_absolute_quantities_to_relative(agent_state, anchor_ego_state, 'agent'))
+    local_coords_agent_states = convert_agent_frames_to_relative(agent_future, anchor_ego_state)
     padded_agent_states = pad_agent_states_with_zeros(local_coords_agent_states)
 
     # fill agent features into the array
     agent_futures = np.zeros(shape=(num_agents, padded_agent_states.shape[0]-1, 3), dtype=np.float32)
-    for i, j in enumerate(agent_index):
-        agent_futures[i] = padded_agent_states[1:, j, [AgentInternalIndex.x(), AgentInternalIndex.y(), AgentInternalIndex.heading()]].numpy()
+    agent_index = torch.as_tensor(agent_index, dtype=torch.long)
+    agent_futures[:len(agent_index)] = padded_agent_states[1:, agent_index][..., [AgentInternalIndex.x(), AgentInternalIndex.y(), AgentInternalIndex.heading()]].transpose(0, 1).numpy()
 
     return agent_futures
 
@@ -226,11 +179,10 @@ def pad_agent_states_with_zeros(agent_trajectories):
     pad_agent_trajectories = torch.zeros((len(agent_trajectories), key_frame.shape[0], key_frame.shape[1]), dtype=torch.float32)
     for idx in range(len(agent_trajectories)):
         frame = agent_trajectories[idx]
-        mapped_rows = frame[:, track_id_idx]
-
-        for row_idx in range(key_frame.shape[0]):
-            if row_idx in mapped_rows:
-                pad_agent_trajectories[idx, row_idx] = frame[frame[:, track_id_idx]==row_idx]
+        # rows are placed at their track id, ids outside the key frame are dropped
+        track_ids = frame[:, track_id_idx]
+        mapped = (track_ids >= 0) & (track_ids < key_frame.shape[0]) & (track_ids == track_ids.floor())
+        pad_agent_trajectories[idx, track_ids[mapped].long()] = frame[mapped]
 
     return pad_agent_trajectories
 
@@ -259,36 +211,12 @@ def convert_feature_layer_to_fixed_size(ego_pose, feature_coords, feature_tl_dat
     if feature_tl_data is not None and len(feature_coords) != len(feature_tl_data):
         raise ValueError(f"Size between feature coords and traffic light data inconsistent: {len(feature_coords)}, {len(feature_tl_data)}")
 
-    # trim or zero-pad elements to maintain fixed size
-    coords_tensor = torch.zeros((max_elements, max_points, 2), dtype=torch.float32)
-    avails_tensor = torch.zeros((max_elements, max_points), dtype=torch.bool)
-    tl_data_tensor = (
-        torch.zeros((max_elements, max_points, traffic_light_encoding_dim), dtype=torch.float32)
-        if feature_tl_data is not None else None
-    )
-
-    # get elements according to the mean distance to the ego pose
-    mapping = {}
-    for i, e in enumerate(feature_coords):
-        dist = torch.norm(e - ego_pose[None, :2], dim=-1).min()
-        mapping[i] = dist
-
-    mapping = sorted(mapping.items(), key=lambda item: item[1])
-    sorted_elements = mapping[:max_elements]
-
-    # pad or trim waypoints in a map element
-    for idx, element_idx in enumerate(sorted_elements):
-        element_coords = feature_coords[element_idx[0]]
-    
-        # interpolate to maintain fixed size if the number of points is not enough
-        element_coords = interpolate_points(element_coords, max_points, interpolation=interpolation)
-        coords_tensor[idx] = element_coords
-        avails_tensor[idx] = True  # specify real vs zero-padded data
-
-        if tl_data_tensor is not None and feature_tl_data is not None:
-            tl_data_tensor[idx] = feature_tl_data[element_idx[0]]
+    coords, lengths = pack_polylines(feature_coords)
+    if feature_tl_data is not None:
+        feature_tl_data = torch.stack(feature_tl_data) if len(feature_tl_data) > 0 else torch.zeros((0, traffic_light_encoding_dim))
 
-    return coords_tensor, tl_data_tensor, avails_tensor
+    return convert_packed_feature_layer_to_fixed_size(ego_pose, coords, lengths, feature_tl_data, max_elements, max_points,
+                                                      traffic_light_encoding_dim, interpolation)
 
 
 def get_neighbor_vector_set_map(
@@ -366,25 +294,18 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
     :return: dict of the map elements.
     """
 
-    # convert data to tensor list
+    # pack each layer into one padded tensor
     anchor_state_tensor = torch.tensor([anchor_state.x, anchor_state.y, anchor_state.heading], dtype=torch.float32)
     list_tensor_data = {}
 
     for feature_name, feature_coords in coords.items():
-        list_feature_coords = []
-
-        # Pack coords into tensor list
-        for element_coords in feature_coords.to_vector():
-            list_feature_coords.append(torch.tensor(element_coords, dtype=torch.float32))
-        list_tensor_data[f"coords.{feature_name}"] = list_feature_coords
+        list_tensor_data[f"coords.{feature_name}"] = pack_polylines(feature_coords.to_vector())
 
-        # Pack traffic light data into tensor list if it exists
+        # Pack traffic light data into a tensor if it exists
         if feature_name in traffic_light_data:
-            list_feature_tl_data = []
-
-            for element_tl_data in traffic_light_data[feature_name].to_vector():
-                list_feature_tl_data.append(torch.tensor(element_tl_data, dtype=torch.float32))
-            list_tensor_data[f"traffic_light_data.{feature_name}"] = list_feature_tl_data
+            list_tensor_data[f"traffic_light_data.{feature_name}"] = torch.tensor(
+                traffic_light_data[feature_name].to_vector(), dtype=torch.float32
+            ).reshape(-1, LaneSegmentTrafficLightData.encoding_dim())
 
     """
     Vector set map data structure, including:
@@ -402,7 +323,7 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
 
     for feature_name in map_features:
         if f"coords.{feature_name}" in list_tensor_data:
-            feature_coords = list_tensor_data[f"coords.{feature_name}"]
+            feature_coords, feature_lengths = list_tensor_data[f"coords.{feature_name}"]
 
             feature_tl_data = (
                 list_tensor_data[f"traffic_light_data.{feature_name}"]
@@ -410,9 +331,10 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
                 else None
             )
 
-            coords, tl_data, avails = convert_feature_layer_to_fixed_size(
+            coords, tl_data, avails = convert_packed_feature_layer_to_fixed_size(
                     anchor_state_tensor,
                     feature_coords,
+                    feature_lengths,
                     feature_tl_data,
                     max_elements[feature_name],
                     max_points[feature_name],
@@ -470,18 +392,14 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
 
 
 def polyline_process(polylines, avails, traffic_light=None):
-    dim = 3 if traffic_light is None else 7
-    new_polylines = np.zeros(shape=(polylines.shape[0], polylines.shape[1], dim), dtype=np.float32)
-
-    for i in range(polylines.shape[0]):
-        if avails[i][0]: 
-            polyline = polylines[i]
-            polyline_heading = wrap_to_pi(np.arctan2(polyline[1:, 1]-polyline[:-1, 1], polyline[1:, 0]-polyline[:-1, 0]))
-            polyline_heading = np.insert(polyline_heading, -1, polyline_heading[-1])[:, np.newaxis]
-            if traffic_light is None:
-                new_polylines[i] = np.concatenate([polyline, polyline_heading], axis=-1)
-            else:
-                new_polylines[i] = np.concatenate([polyline, polyline_heading, traffic_light[i]], axis=-1)  
+    # headings of all polylines at once, zeroed for the padded elements
+    polyline_heading = wrap_to_pi(np.arctan2(polylines[:, 1:, 1]-polylines[:, :-1, 1], polylines[:, 1:, 0]-polylines[:, :-1, 0]))
+    polyline_heading = np.concatenate([polyline_heading, polyline_heading[:, -1:]], axis=1)[..., np.newaxis]
+    if traffic_light is None:
+        new_polylines = np.concatenate([polylines, polyline_heading], axis=-1).astype(np.float32)
+    else:
+        new_polylines = np.concatenate([polylines, polyline_heading, traffic_light], axis=-1).astype(np.float32)
+    new_polylines[~avails[:, 0]] = 0
 
     return new_polylines
 
@@ -0,0 +1,229 @@
+import os
+import copy
+import logging
+import threading
+
+import torch
+import torch.nn as nn
+
+
+BACKENDS = ['eager', 'torchscript', 'export']
+
+# one engine per checkpoint and configuration, shared by all planners of the process
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def resolve_num_threads(num_threads=None, num_workers=None):
+    """
+    Thread count policy of a CPU simulation worker: num_threads when given, else the cores split evenly
+    between the num_workers worker processes of the node, else None (torch default, all cores).
+    """
+    if num_threads is not None and num_threads > 0:
+        return int(num_threads)
+    if num_workers is not None and num_workers > 0:
+        return max(1, (os.cpu_count() or 1) // int(num_workers))
+    return None
+
+
+def set_worker_threads(num_threads=None, num_workers=None):
+    """
+    Apply the thread count policy to torch. The intra-op pool is per process, so the planners simulated
+    by the threads of one worker process share it.
+    :return: number of intra-op threads in use.
+    """
+    num_threads = resolve_num_threads(num_threads, num_workers)
+    if num_threads is None:
+        return torch.get_num_threads()
+
+    torch.set_num_threads(num_threads)
+    try:
+        # the worker processes run in parallel already, inter-op parallelism only oversubscribes the cores
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        # can only be set once, before any inter-op parallel work of the process
+        pass
+    logging.info(f'Using {num_threads} torch threads')
+
+    return num_threads
+
+
+def quantize_gameformer(model):
+    """
+    Dynamic int8 quantization of the nn.Linear / nn.LSTM layers of a float GameFormer, CPU only.
+    The layers of the fusion nn.TransformerEncoder keep float weights, its fused inference kernel needs them.
+    :return: quantized copy of model.
+    """
+    qconfig_spec = {
+        name: torch.quantization.default_dynamic_qconfig
+        for name, module in model.named_modules()
+        if type(module) in (nn.Linear, nn.LSTM) and '.fusion_encoder.' not in f'.{name}.'
+    }
+    model = copy.deepcopy(model).cpu().eval()
+
+    return torch.quantization.quantize_dynamic(model, qconfig_spec=qconfig_spec, dtype=torch.qint8)
+
+
+def _input_signature(inputs):
+    return tuple((key, tuple(value.shape), value.dtype) for key, value in sorted(inputs.items()))
+
+
+def compare_outputs(reference, candidate):
+    """
+    Deviation of candidate GameFormer outputs from reference ones, both (decoder_outputs, plan).
+    ADE / FDE are the mean L2 distances [m] over all and over the final timesteps of the ego plan and of the
+    final level predictions of all modes.
+    """
+    reference_predictions, reference_plan = reference
+    candidate_predictions, candidate_plan = candidate
+    K = len(reference_predictions) // 2 - 1
+
+    plan_distance = torch.norm(candidate_plan[..., :2] - reference_plan[..., :2], dim=-1)
+    reference_gmm = reference_predictions[f'level_{K}_interactions']
+    candidate_gmm = candidate_predictions[f'level_{K}_interactions']
+    prediction_distance = torch.norm(candidate_gmm[..., :2] - reference_gmm[..., :2], dim=-1)
+    score_diff = candidate_predictions[f'level_{K}_scores'] - reference_predictions[f'level_{K}_scores']
+
+    return {
+        'plan_ade': plan_distance.mean().item(),
+        'plan_fde': plan_distance[..., -1].mean().item(),
+        'prediction_ade': prediction_distance.mean().item(),
+        'prediction_fde': prediction_distance[..., -1].mean().item(),
+        'score_max_abs_diff': score_diff.abs().max().item(),
+    }
+
+
+class _DecoderOutputs(nn.Module):
+    """
+    Decoder with its dict output flattened to a tuple, torch.export and torch.jit.trace keep tuples of tensors.
+    """
+    def __init__(self, decoder):
+        super(_DecoderOutputs, self).__init__()
+        self.decoder = decoder
+        self.keys = [f'level_{k}_{name}' for k in range(decoder.levels + 1) for name in ['interactions', 'scores']]
+
+    def forward(self, encoder_outputs):
+        decoder_outputs, env_encoding = self.decoder(encoder_outputs)
+        return tuple(decoder_outputs[key] for key in self.keys) + (env_encoding,)
+
+
+class GameFormerInferenceEngine:
+    """
+    Inference backend of GameFormer for CPU simulation workers.
+    The Encoder, Decoder and NeuralPlanner of the model are compiled separately with TorchScript (torch.jit.trace)
+    or torch.export, optionally after dynamic int8 quantization, and run under torch.inference_mode.
+    Tracing specializes on the input shapes, so they are compiled lazily per input signature. The first
+    num_accuracy_checks inputs of each compiled signature are also run through the eager float model and compared
+    (see compare_outputs); when the plan deviates by more than max_plan_ade, or compilation fails, the engine falls
+    back to the eager modules for that signature.
+    Calling the engine returns (decoder_outputs, plan) as GameFormer.forward does.
+    """
+    def __init__(self, model, backend='torchscript', quantize=False, max_plan_ade=0.2, num_accuracy_checks=1):
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown inference backend {backend}, should be in {BACKENDS}')
+        device = next(model.parameters()).device
+        if quantize and device.type != 'cpu':
+            raise ValueError(f'Dynamic int8 quantization runs on cpu only, the model is on {device}')
+
+        self.backend = backend
+        self.quantize = quantize
+        self.max_plan_ade = max_plan_ade
+        self.num_accuracy_checks = num_accuracy_checks
+        self.eager_model = model.eval()
+        self.model = quantize_gameformer(model) if quantize else self.eager_model
+        self.accuracy = {}  # input signature -> worst compare_outputs of the compiled modules
+        self._decoder_outputs = _DecoderOutputs(self.model.decoder).eval()
+        self._compiled = {}
+        self._num_checks_left = {}  # input signature -> number of inputs still to check
+        self._lock = threading.Lock()
+
+    def _eager_modules(self):
+        return self.model.encoder, self._decoder_outputs, self.model.planner
+
+    def _compile_module(self, module, example_inputs):
+        if self.backend == 'torchscript':
+            module = torch.jit.trace(module, example_inputs, strict=False, check_trace=False)
+            return torch.jit.freeze(module)
+        return torch.export.export(module, example_inputs).module()
+
+    def _compile(self, inputs):
+        encoder, decoder, planner = self._eager_modules()
+        with torch.no_grad():
+            encoder_outputs = encoder(inputs)
+            decoder_outputs = decoder(encoder_outputs)
+            modules = (
+                self._compile_module(encoder, (inputs,)),
+                self._compile_module(decoder, (encoder_outputs,)),
+                self._compile_module(planner, (decoder_outputs[-1], encoder_outputs['route_lanes'])),
+            )
+
+        return modules
+
+    def _get_modules(self, inputs):
+        signature = _input_signature(inputs)
+        modules = self._compiled.get(signature)
+        if modules is not None and self._num_checks_left[signature] == 0:
+            return modules
+
+        with self._lock:
+            if signature not in self._compiled:
+                modules, compiled = self._eager_modules(), False
+                if self.backend != 'eager':
+                    try:
+                        modules, compiled = self._compile(inputs), True
+                    except Exception as e:
+                        logging.error(f'Compiling GameFormer with {self.backend} failed, running eager: {e}')
+                # set before the modules, which the lock-free path above looks up first
+                self._num_checks_left[signature] = self.num_accuracy_checks if compiled or self.quantize else 0
+                self._compiled[signature] = modules
+
+            if self._num_checks_left[signature] > 0:
+                self._check(signature, inputs)
+
+        return self._compiled[signature]
+
+    def _check(self, signature, inputs):
+        accuracy = compare_outputs(self._run_eager_float(inputs), self._run(self._compiled[signature], inputs))
+        self._num_checks_left[signature] -= 1
+        if signature not in self.accuracy or accuracy['plan_ade'] > self.accuracy[signature]['plan_ade']:
+            self.accuracy[signature] = accuracy
+        logging.info(f'GameFormer {self.backend} (quantize={self.quantize}) vs eager: {accuracy}')
+        if accuracy['plan_ade'] > self.max_plan_ade:
+            logging.error(f"Plan ADE {accuracy['plan_ade']:.3f} m over {self.max_plan_ade} m, "
+                          f"falling back to the eager float model")
+            self._compiled[signature] = (self.eager_model.encoder, _DecoderOutputs(self.eager_model.decoder).eval(),
+                                         self.eager_model.planner)
+            self._num_checks_left[signature] = 0
+
+    def _run(self, modules, inputs):
+        encoder, decoder, planner = modules
+        with torch.inference_mode():
+            encoder_outputs = encoder(inputs)
+            outputs = decoder(encoder_outputs)
+            plan = planner(outputs[-1], encoder_outputs['route_lanes'])
+
+        return dict(zip(self._decoder_outputs.keys, outputs[:-1])), plan
+
+    def _run_eager_float(self, inputs):
+        with torch.inference_mode():
+            return self.eager_model(inputs)
+
+    def __call__(self, inputs):
+        return self._run(self._get_modules(inputs), inputs)
+
+
+def get_inference_engine(checkpoint_path, device, backend='torchscript', quantize=False, max_plan_ade=0.2,
+                         model_builder=None, model_id=None, num_accuracy_checks=1):
+    """
+    Get the engine of a GameFormer checkpoint, built once per process and configuration.
+    :param model_builder: callable returning the float GameFormer, loaded from checkpoint_path by the caller.
+    :param model_id: identity of the model model_builder builds (e.g. the loading function), engines of the same
+        checkpoint built differently are kept apart.
+    """
+    key = (checkpoint_path, model_id, str(device), backend, quantize, max_plan_ade, num_accuracy_checks)
+    with _ENGINES_LOCK:
+        if key not in _ENGINES:
+            _ENGINES[key] = GameFormerInferenceEngine(model_builder(), backend, quantize, max_plan_ade,
+                                                      num_accuracy_checks)
+
+    return _ENGINES[key]
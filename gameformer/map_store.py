@@ -0,0 +1,183 @@
+import os
+import pickle
+import logging
+
+import numpy as np
+import torch
+import shapely
+from shapely import STRtree
+from shapely.geometry import Point, box
+
+from nuplan.common.maps.maps_datatypes import SemanticMapLayer
+from nuplan.planning.training.preprocessing.feature_builders.vector_builder_utils import (
+    LaneSegmentLaneIDs,
+    LaneSegmentTrafficLightData,
+    get_traffic_light_encoding,
+    prune_route_by_connectivity,
+)
+from nuplan.planning.training.preprocessing.utils.vector_preprocessing import interpolate_points
+
+
+LANE_LAYERS = [SemanticMapLayer.LANE, SemanticMapLayer.LANE_CONNECTOR]
+ROADBLOCK_LAYERS = [SemanticMapLayer.ROADBLOCK, SemanticMapLayer.ROADBLOCK_CONNECTOR]
+
+# one store per map and process, shared by all planners of the process
+_LANE_STORES = {}
+
+
+class LaneStore:
+    """
+    Lane and lane connector centerlines of a whole map, packed into arrays once:
+    the raw centerline points and map object polygons (used to rank elements by distance, as get_lane_centerlines
+    and convert_feature_layer_to_fixed_size do),
+    the centerlines resampled to max_points, an id -> row index and STRtrees over the lane / roadblock polygons
+    reproducing map_api.get_proximal_map_objects.
+    """
+    def __init__(self, map_api, max_points=50, interpolation_method='linear'):
+        self.map_name = map_api.map_name
+        self.max_points = max_points
+
+        lane_ids, polygons, object_polygons, centerlines = [], [], [], []
+        for layer in LANE_LAYERS:
+            layer_df = map_api._get_vector_map_layer(layer)
+            for fid, polygon in zip(layer_df['fid'], layer_df['geometry']):
+                lane = map_api.get_map_object(str(fid), layer)
+                lane_ids.append(lane.id)
+                polygons.append(polygon)
+                object_polygons.append(lane.polygon)
+                centerlines.append([[node.x, node.y] for node in lane.baseline_path.discrete_path])
+
+        self.lane_ids = lane_ids
+        self.lane_rows = {lane_id: row for row, lane_id in enumerate(lane_ids)}
+        self.lane_polygons = polygons
+        # lane connector polygons differ from their layer geometry, the map api measures distances to these ones
+        self.object_polygons = np.array(object_polygons, dtype=object)
+        self.offsets = np.cumsum([0] + [len(centerline) for centerline in centerlines]).astype(np.int64)
+        self.points = torch.tensor([point for centerline in centerlines for point in centerline], dtype=torch.float32)
+        self.resampled = torch.stack([
+            interpolate_points(self.points[self.offsets[i]:self.offsets[i+1]], max_points, interpolation=interpolation_method)
+            for i in range(len(lane_ids))
+        ]) if len(lane_ids) > 0 else torch.zeros((0, max_points, 2), dtype=torch.float32)
+
+        roadblock_ids, roadblock_polygons, roadblock_lane_rows = [], [], {}
+        for layer in ROADBLOCK_LAYERS:
+            layer_df = map_api._get_vector_map_layer(layer)
+            for fid, polygon in zip(layer_df['fid'], layer_df['geometry']):
+                roadblock = map_api.get_map_object(str(fid), layer)
+                roadblock_ids.append(roadblock.id)
+                roadblock_polygons.append(polygon)
+                roadblock_lane_rows[roadblock.id] = np.array(
+                    [self.lane_rows[edge.id] for edge in roadblock.interior_edges], dtype=np.int64)
+
+        self.roadblock_ids = roadblock_ids
+        self.roadblock_polygons = roadblock_polygons
+        self.roadblock_lane_rows = roadblock_lane_rows
+        self._build_trees()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_lane_tree', None)
+        state.pop('_roadblock_tree', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build_trees()
+
+    def _build_trees(self):
+        self._lane_tree = STRtree(self.lane_polygons)
+        self._roadblock_tree = STRtree(self.roadblock_polygons)
+
+    @staticmethod
+    def _patch(point, radius):
+        return box(point.x - radius, point.y - radius, point.x + radius, point.y + radius)
+
+    def proximal_lane_rows(self, point, radius):
+        return np.sort(self._lane_tree.query(self._patch(point, radius), predicate='intersects'))
+
+    def route_lane_rows(self, point, radius, route_roadblock_ids):
+        roadblock_idx = self._roadblock_tree.query(self._patch(point, radius), predicate='intersects')
+        roadblock_ids = {self.roadblock_ids[i] for i in roadblock_idx}
+        route_roadblock_ids = prune_route_by_connectivity(route_roadblock_ids, roadblock_ids)
+        rows = [self.roadblock_lane_rows[roadblock_id] for roadblock_id in route_roadblock_ids
+                if roadblock_id in self.roadblock_lane_rows]
+
+        return np.concatenate(rows) if len(rows) > 0 else np.zeros((0,), dtype=np.int64)
+
+    def nearest_rows(self, rows, point, anchor_xy, max_elements):
+        """
+        The max_elements rows closest to anchor_xy, by the min distance of their raw centerline points.
+        Ties keep the order of the map api, which first sorts the elements by the distance of their polygon to point.
+        """
+        if len(rows) == 0:
+            return rows
+        polygon_dist = shapely.distance(self.object_polygons[rows], Point(point.x, point.y))
+        rows = rows[np.argsort(polygon_dist, kind='stable')]
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        point_idx = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)])
+        dist = torch.norm(self.points[point_idx] - anchor_xy[None, :2], dim=-1).numpy()
+        min_dist = np.minimum.reduceat(dist, np.cumsum(ends - starts) - (ends - starts))
+
+        return rows[np.argsort(min_dist, kind='stable')[:max_elements]]
+
+    def fixed_size_features(self, point, radius, anchor_xy, route_roadblock_ids, traffic_light_status_data,
+                            max_elements):
+        """
+        Fixed size LANE and ROUTE_LANES layers in global frame, as convert_feature_layer_to_fixed_size returns them.
+        :return: dict of feature name -> (coords, traffic light data, availabilities)
+        """
+        output = {}
+        traffic_light_encoding_dim = LaneSegmentTrafficLightData.encoding_dim()
+
+        for feature_name in ['LANE', 'ROUTE_LANES']:
+            if feature_name not in max_elements:
+                continue
+            if feature_name == 'LANE':
+                rows = self.proximal_lane_rows(point, radius)
+            else:
+                rows = self.route_lane_rows(point, radius, route_roadblock_ids)
+            rows = self.nearest_rows(rows, point, anchor_xy, max_elements[feature_name])
+
+            coords = torch.zeros((max_elements[feature_name], self.max_points, 2), dtype=torch.float32)
+            avails = torch.zeros((max_elements[feature_name], self.max_points), dtype=torch.bool)
+            coords[:len(rows)] = self.resampled[rows]
+            avails[:len(rows)] = True
+
+            tl_data = None
+            if feature_name == 'LANE':
+                tl_data = torch.zeros((max_elements[feature_name], self.max_points, traffic_light_encoding_dim), dtype=torch.float32)
+                lane_ids = LaneSegmentLaneIDs([self.lane_ids[row] for row in rows])
+                encoding = get_traffic_light_encoding(lane_ids, traffic_light_status_data).to_vector()
+                if len(rows) > 0:
+                    tl_data[:len(rows)] = torch.tensor(encoding, dtype=torch.float32)[:, None]
+
+            output[feature_name] = (coords, tl_data, avails)
+
+        return output
+
+
+def get_lane_store(map_api, cache_dir=None):
+    """
+    Get the lane store of map_api, built once per process. With cache_dir it is also pickled to disk,
+    so that the other worker processes load it instead of building it again.
+    """
+    map_name = map_api.map_name
+    if map_name in _LANE_STORES:
+        return _LANE_STORES[map_name]
+
+    cache_path = os.path.join(cache_dir, f'{map_name}_lane_store.pkl') if cache_dir else None
+    if cache_path is not None and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            store = pickle.load(f)
+    else:
+        logging.info(f'Building lane store of {map_name}')
+        store = LaneStore(map_api)
+        if cache_path is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            tmp_path = f'{cache_path}.{os.getpid()}'
+            with open(tmp_path, 'wb') as f:
+                pickle.dump(store, f)
+            os.replace(tmp_path, cache_path)
+
+    _LANE_STORES[map_name] = store
+    return store
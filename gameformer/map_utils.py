@@ -0,0 +1,83 @@
+import torch
+from nuplan.planning.training.preprocessing.utils.vector_preprocessing import interpolate_points
+
+
+def pack_polylines(polylines):
+    """
+    Pack variable sized polylines into one zero-padded tensor.
+    :param polylines: list of [num_points (variable), 2] lists or tensors.
+    :return: coords [num_elements, max_num_points, 2], lengths [num_elements]
+    """
+    lengths = torch.tensor([len(polyline) for polyline in polylines], dtype=torch.long)
+    max_len = int(lengths.max()) if len(polylines) > 0 else 0
+    coords = torch.zeros((len(polylines), max_len, 2), dtype=torch.float32)
+    if len(polylines) == 0:
+        return coords, lengths
+
+    if torch.is_tensor(polylines[0]):
+        points = torch.cat(list(polylines), dim=0).float()
+    else:
+        points = torch.tensor([point for polyline in polylines for point in polyline], dtype=torch.float32)
+    element_idx = torch.repeat_interleave(torch.arange(len(polylines)), lengths)
+    point_idx = torch.arange(len(points)) - torch.repeat_interleave(torch.cumsum(lengths, 0) - lengths, lengths)
+    coords[element_idx, point_idx] = points
+
+    return coords, lengths
+
+
+def interpolate_packed_polylines(coords, lengths, max_points):
+    """
+    Batched interpolate_points(..., interpolation='linear') of packed polylines.
+    :return: [num_elements, max_points, 2]
+    """
+    # align_corners=True: output j samples the source at j * (length - 1) / (max_points - 1)
+    scale = (lengths - 1).float() / max(max_points - 1, 1)
+    real_idx = scale[:, None] * torch.arange(max_points, dtype=torch.float32)[None, :]
+    idx0 = real_idx.long()
+    idx1 = torch.minimum(idx0 + 1, (lengths - 1)[:, None])
+    weight = (real_idx - idx0.float()).clamp(0, 1)[..., None]
+
+    p0 = torch.gather(coords, 1, idx0[..., None].expand(-1, -1, 2))
+    p1 = torch.gather(coords, 1, idx1[..., None].expand(-1, -1, 2))
+
+    return (1 - weight) * p0 + weight * p1
+
+
+def convert_packed_feature_layer_to_fixed_size(ego_pose, coords, lengths, feature_tl_data, max_elements, max_points,
+                                               traffic_light_encoding_dim, interpolation):
+    """
+    convert_feature_layer_to_fixed_size on packed polylines (see pack_polylines): the max_elements elements closest
+    to the ego pose are picked with one sort over the min point distances and interpolated in one batch.
+    :param feature_tl_data: Optional [num_elements, traffic_light_encoding_dim] tensor.
+    """
+    if feature_tl_data is not None and len(coords) != len(feature_tl_data):
+        raise ValueError(f"Size between feature coords and traffic light data inconsistent: {len(coords)}, {len(feature_tl_data)}")
+
+    coords_tensor = torch.zeros((max_elements, max_points, 2), dtype=torch.float32)
+    avails_tensor = torch.zeros((max_elements, max_points), dtype=torch.bool)
+    tl_data_tensor = (
+        torch.zeros((max_elements, max_points, traffic_light_encoding_dim), dtype=torch.float32)
+        if feature_tl_data is not None else None
+    )
+    if len(coords) == 0:
+        return coords_tensor, tl_data_tensor, avails_tensor
+
+    # get elements according to the min distance to the ego pose, a stable sort keeps ties in element order
+    dist = torch.norm(coords - ego_pose[None, None, :2], dim=-1)
+    valid = torch.arange(coords.shape[1])[None, :] < lengths[:, None]
+    dist = dist.masked_fill(~valid, float('inf')).min(dim=-1).values
+    sorted_elements = torch.sort(dist, stable=True).indices[:max_elements]
+    num_elements = len(sorted_elements)
+
+    if interpolation == 'linear':
+        coords_tensor[:num_elements] = interpolate_packed_polylines(coords[sorted_elements], lengths[sorted_elements], max_points)
+    else:
+        for idx, element_idx in enumerate(sorted_elements):
+            element_coords = coords[element_idx, :lengths[element_idx]]
+            coords_tensor[idx] = interpolate_points(element_coords, max_points, interpolation=interpolation)
+    avails_tensor[:num_elements] = True
+
+    if tl_data_tensor is not None:
+        tl_data_tensor[:num_elements] = feature_tl_data[sorted_elements][:, None, :]
+
+    return coords_tensor, tl_data_tensor, avails_tensor
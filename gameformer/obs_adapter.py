@@ -9,27 +9,49 @@ from nuplan.planning.training.preprocessing.utils.vector_preprocessing import in
 from nuplan.common.geometry.torch_geometry import vector_set_coordinates_to_local_frame
 from nuplan.planning.training.preprocessing.feature_builders.vector_builder_utils import *
 from nuplan.planning.training.preprocessing.utils.agents_preprocessing import *
+try:
+    from map_utils import *
+    from agent_utils import *
+except:
+    from .map_utils import *
+    from .agent_utils import *
 
 
 def observation_adapter(history_buffer, traffic_light_data, map_api, route_roadblock_ids, device='cpu'):
+    ego_state_buffer = history_buffer.ego_state_buffer # Past ego state including the current
+    observation_buffer = history_buffer.observation_buffer # Past observations including the current
+
+    ego_agent_past = sampled_past_ego_states_to_tensor(ego_state_buffer)
+    past_tracked_objects_tensor_list, past_tracked_objects_types = sampled_tracked_objects_to_tensor_list(observation_buffer)
+    time_stamps_past = sampled_past_timestamps_to_tensor([state.time_point for state in ego_state_buffer])
+
+    return build_model_inputs(history_buffer.current_state[0], ego_agent_past, past_tracked_objects_tensor_list,
+                              past_tracked_objects_types, time_stamps_past, traffic_light_data, map_api,
+                              route_roadblock_ids, device)
+
+
+def build_model_inputs(ego_state, ego_agent_past, past_tracked_objects_tensor_list, past_tracked_objects_types,
+                       time_stamps_past, traffic_light_data, map_api, route_roadblock_ids, device='cpu', lane_store=None):
     num_agents = 20
-    past_time_steps = 21
     map_features = ['LANE', 'ROUTE_LANES', 'CROSSWALK'] # name of map features to be extracted.
     max_elements = {'LANE': 40, 'ROUTE_LANES': 10, 'CROSSWALK': 5} # maximum number of elements to extract per feature layer.
     max_points = {'LANE': 50, 'ROUTE_LANES': 50, 'CROSSWALK': 30} # maximum number of points per feature to extract per feature layer.
     radius = 10 # [m] query radius scope relative to the current pose.
     interpolation_method = 'linear'
 
-    ego_state_buffer = history_buffer.ego_state_buffer # Past ego state including the current
-    observation_buffer = history_buffer.observation_buffer # Past observations including the current
-
-    ego_agent_past = sampled_past_ego_states_to_tensor(ego_state_buffer)
-    past_tracked_objects_tensor_list, past_tracked_objects_types = sampled_tracked_objects_to_tensor_list(observation_buffer)
-    time_stamps_past = sampled_past_timestamps_to_tensor([state.time_point for state in ego_state_buffer])
-    ego_state = history_buffer.current_state[0]
     ego_coords = Point2D(ego_state.rear_axle.x, ego_state.rear_axle.y)
+    fixed_size_features = None
+    if lane_store is not None:
+        # lanes and route lanes are gathered from the precomputed store, only the rest goes through the map api
+        anchor_xy = torch.tensor([ego_state.rear_axle.x, ego_state.rear_axle.y], dtype=torch.float32)
+        fixed_size_features = lane_store.fixed_size_features(
+            ego_coords, radius, anchor_xy, route_roadblock_ids, traffic_light_data, max_elements
+        )
+        map_api_features = [feature_name for feature_name in map_features if feature_name not in fixed_size_features]
+    else:
+        map_api_features = map_features
     coords, traffic_light_data = get_neighbor_map(
-        map_api, map_features, ego_coords, radius, route_roadblock_ids, traffic_light_data
+        map_api, map_api_features, ego_coords, radius, route_roadblock_ids, traffic_light_data
     )
 
     ego_agent_past, neighbor_agents_past = agent_past_process(
@@ -37,7 +59,7 @@ def observation_adapter(history_buffer, traffic_light_data, map_api, route_roadb
     )
 
     vector_map = map_process(ego_state.rear_axle, coords, traffic_light_data, map_features, 
-                             max_elements, max_points, interpolation_method)
+                             max_elements, max_points, interpolation_method, fixed_size_features)
 
     data = {"ego_agent_past": ego_agent_past[1:], 
             "neighbor_agents_past": neighbor_agents_past[:, 1:]}
@@ -47,6 +69,56 @@ def observation_adapter(history_buffer, traffic_light_data, map_api, route_roadb
     return data
 
 
+class ObservationAdapter:
+    """
+    Stateful observation_adapter for closed-loop simulation.
+    The history buffer only shifts by one frame per tick, so the absolute ego and agent tensors of every frame
+    are cached by timestamp and only newly appended frames are tensorized. The track token mapping is kept across
+    ticks, its ids are only used to match agents between frames.
+    With a LaneStore (see map_store.py) lanes and route lanes are gathered from it instead of the map api.
+    """
+    object_types = [TrackedObjectType.VEHICLE, TrackedObjectType.PEDESTRIAN, TrackedObjectType.BICYCLE]
+
+    def __init__(self, lane_store=None):
+        self.lane_store = lane_store
+        self.reset()
+
+    def reset(self):
+        self._track_token_ids = {}
+        self._frames = {} # time_us -> (ego row, agents tensor, agent types)
+
+    def __call__(self, history_buffer, traffic_light_data, map_api, route_roadblock_ids, device='cpu'):
+        ego_state_buffer = history_buffer.ego_state_buffer
+        observation_buffer = history_buffer.observation_buffer
+
+        frames = {}
+        for ego_state, observation in zip(ego_state_buffer, observation_buffer):
+            time_us = ego_state.time_point.time_us
+            frame = self._frames.get(time_us)
+            if frame is None:
+                frame = self._tensorize_frame(ego_state, observation)
+            frames[time_us] = frame
+        # frames that left the buffer are dropped
+        self._frames = frames
+
+        frame_list = [frames[ego_state.time_point.time_us] for ego_state in ego_state_buffer]
+        # agent_past_process converts the ego tensor in place, stack a fresh one from the cached absolute rows
+        ego_agent_past = torch.stack([ego_row for ego_row, _, _ in frame_list])
+        past_tracked_objects_tensor_list = [agents for _, agents, _ in frame_list]
+        past_tracked_objects_types = [agent_types for _, _, agent_types in frame_list]
+        time_stamps_past = sampled_past_timestamps_to_tensor([state.time_point for state in ego_state_buffer])
+
+        return build_model_inputs(history_buffer.current_state[0], ego_agent_past, past_tracked_objects_tensor_list,
+                                  past_tracked_objects_types, time_stamps_past, traffic_light_data, map_api,
+                                  route_roadblock_ids, device, self.lane_store)
+
+    def _tensorize_frame(self, ego_state, observation):
+        ego_row = sampled_past_ego_states_to_tensor([ego_state])[0]
+        agents, self._track_token_ids, agent_types = extract_agent_tensor_columnwise(
+            observation.tracked_objects, self._track_token_ids, self.object_types)
+        return ego_row, agents, agent_types
+
+
 def convert_to_model_inputs(data, device):
     tensor_data = {}
     for k, v in data.items():
@@ -80,6 +152,32 @@ def extract_agent_tensor(tracked_objects, track_token_ids, object_types):
     return output, track_token_ids, agent_types
 
 
+def extract_agent_tensor_columnwise(tracked_objects, track_token_ids, object_types):
+    """
+    Same output as extract_agent_tensor, filled one column at a time instead of one element at a time.
+    """
+    agents = tracked_objects.get_tracked_objects_of_types(object_types)
+    output = torch.zeros((len(agents), AgentInternalIndex.dim()), dtype=torch.float32)
+    if len(agents) == 0:
+        return output, track_token_ids, []
+
+    for agent in agents:
+        if agent.track_token not in track_token_ids:
+            track_token_ids[agent.track_token] = len(track_token_ids)
+
+    output[:, AgentInternalIndex.track_token()] = torch.tensor([float(track_token_ids[agent.track_token]) for agent in agents])
+    output[:, AgentInternalIndex.vx()] = torch.tensor([agent.velocity.x for agent in agents])
+    output[:, AgentInternalIndex.vy()] = torch.tensor([agent.velocity.y for agent in agents])
+    output[:, AgentInternalIndex.heading()] = torch.tensor([agent.center.heading for agent in agents])
+    output[:, AgentInternalIndex.width()] = torch.tensor([agent.box.width for agent in agents])
+    output[:, AgentInternalIndex.length()] = torch.tensor([agent.box.length for agent in agents])
+    output[:, AgentInternalIndex.x()] = torch.tensor([agent.center.x for agent in agents])
+    output[:, AgentInternalIndex.y()] = torch.tensor([agent.center.y for agent in agents])
+    agent_types = [agent.tracked_object_type for agent in agents]
+
+    return output, track_token_ids, agent_types
+
+
 def sampled_tracked_objects_to_tensor_list(past_tracked_objects):
     object_types = [TrackedObjectType.VEHICLE, TrackedObjectType.PEDESTRIAN, TrackedObjectType.BICYCLE]
     output = []
@@ -99,79 +197,12 @@ def convert_feature_layer_to_fixed_size(ego_pose, feature_coords, feature_tl_dat
     if feature_tl_data is not None and len(feature_coords) != len(feature_tl_data):
         raise ValueError(f"Size between feature coords and traffic light data inconsistent: {len(feature_coords)}, {len(feature_tl_data)}")
 
-    # trim or zero-pad elements to maintain fixed size
-    coords_tensor = torch.zeros((max_elements, max_points, 2), dtype=torch.float32)
-    avails_tensor = torch.zeros((max_elements, max_points), dtype=torch.bool)
-    tl_data_tensor = (
-        torch.zeros((max_elements, max_points, traffic_light_encoding_dim), dtype=torch.float32)
-        if feature_tl_data is not None else None
-    )
-
-    # get elements according to the mean distance to the ego pose
-    mapping = {}
-    for i, e in enumerate(feature_coords):
-        dist = torch.norm(e - ego_pose[None, :2], dim=-1).min()
-        mapping[i] = dist
-
-    mapping = sorted(mapping.items(), key=lambda item: item[1])
-    sorted_elements = mapping[:max_elements]
-
-    # pad or trim waypoints in a map element
-    for idx, element_idx in enumerate(sorted_elements):
-        element_coords = feature_coords[element_idx[0]]
-    
-        # interpolate to maintain fixed size if the number of points is not enough
-        element_coords = interpolate_points(element_coords, max_points, interpolation=interpolation)
-        coords_tensor[idx] = element_coords
-        avails_tensor[idx] = True  # specify real vs zero-padded data
-
-        if tl_data_tensor is not None and feature_tl_data is not None:
-            tl_data_tensor[idx] = feature_tl_data[element_idx[0]]
-
-    return coords_tensor, tl_data_tensor, avails_tensor
-
-
-def global_velocity_to_local(velocity, anchor_heading):
-    velocity_x = velocity[:, 0] * torch.cos(anchor_heading) + velocity[:, 1] * torch.sin(anchor_heading)
-    velocity_y = velocity[:, 1] * torch.cos(anchor_heading) - velocity[:, 0] * torch.sin(anchor_heading)
-
-    return torch.stack([velocity_x, velocity_y], dim=-1)
-
-
-def convert_absolute_quantities_to_relative(agent_state, ego_state, agent_type='ego'):
-    """
-    Converts the agent' poses and relative velocities from absolute to ego-relative coordinates.
-    :param agent_state: The agent states to convert, in the AgentInternalIndex schema.
-    :param ego_state: The ego state to convert, in the EgoInternalIndex schema.
-    :return: The converted states, in AgentInternalIndex schema.
-    """
-    ego_pose = torch.tensor(
-        [
-            float(ego_state[EgoInternalIndex.x()].item()),
-            float(ego_state[EgoInternalIndex.y()].item()),
-            float(ego_state[EgoInternalIndex.heading()].item()),
-        ],
-        dtype=torch.float64,
-    )
-
-    if agent_type == 'ego':
-        agent_global_poses = agent_state[:, [EgoInternalIndex.x(), EgoInternalIndex.y(), EgoInternalIndex.heading()]]
-        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
-        agent_state[:, EgoInternalIndex.x()] = transformed_poses[:, 0].float()
-        agent_state[:, EgoInternalIndex.y()] = transformed_poses[:, 1].float()
-        agent_state[:, EgoInternalIndex.heading()] = transformed_poses[:, 2].float()
-    else:
-        agent_global_poses = agent_state[:, [AgentInternalIndex.x(), AgentInternalIndex.y(), AgentInternalIndex.heading()]]
-        agent_global_velocities = agent_state[:, [AgentInternalIndex.vx(), AgentInternalIndex.vy()]]
-        transformed_poses = global_state_se2_tensor_to_local(agent_global_poses, ego_pose, precision=torch.float64)
-        transformed_velocities = global_velocity_to_local(agent_global_velocities, ego_pose[-1])
-        agent_state[:, AgentInternalIndex.x()] = transformed_poses[:, 0].float()
-        agent_state[:, AgentInternalIndex.y()] = transformed_poses[:, 1].float()
-        agent_state[:, AgentInternalIndex.heading()] = transformed_poses[:, 2].float()
-        agent_state[:, AgentInternalIndex.vx()] = transformed_velocities[:, 0].float()
-        agent_state[:, AgentInternalIndex.vy()] = transformed_velocities[:, 1].float()
+    coords, lengths = pack_polylines(feature_coords)
+    if feature_tl_data is not None:
+        feature_tl_data = torch.stack(feature_tl_data) if len(feature_tl_data) > 0 else torch.zeros((0, traffic_light_encoding_dim))
 
-    return agent_state
+    return convert_packed_feature_layer_to_fixed_size(ego_pose, coords, lengths, feature_tl_data, max_elements, max_points,
+                                                      traffic_light_encoding_dim, interpolation)
 
 
 def agent_past_process(past_ego_states, past_time_stamps, past_tracked_objects, tracked_objects_types, num_agents):
@@ -189,42 +220,25 @@ def agent_past_process(past_ego_states, past_time_stamps, past_tracked_objects,
         # Return zero tensor when there are no agents in the scene
         agents_tensor = torch.zeros((len(agent_history), 0, agents_states_dim)).float()
     else:
-        local_coords_agent_states = []
         padded_agent_states = pad_agent_states(agent_history, reverse=True)
-
-        for agent_state in padded_agent_states:
-            local_coords_agent_states.append(convert_absolute_quantities_to_relative(agent_state, anchor_ego_state, 'agent'))
+        local_coords_agent_states = convert_agent_frames_to_relative(padded_agent_states, anchor_ego_state)
     
         # Calculate yaw rate
-        yaw_rate_horizon = compute_yaw_rate_from_state_tensors(padded_agent_states, time_stamps)
+        yaw_rate_horizon = compute_yaw_rate_from_state_tensors(local_coords_agent_states, time_stamps)
     
         agents_tensor = pack_agents_tensor(local_coords_agent_states, yaw_rate_horizon)
 
     agents = torch.zeros((num_agents, agents_tensor.shape[0], agents_tensor.shape[-1]+3), dtype=torch.float32)
 
-    # sort agents according to distance to ego
+    # sort agents according to distance to ego, then drop the ones far behind
     distance_to_ego = torch.norm(agents_tensor[-1, :, :2], dim=-1)
-    indices = list(torch.argsort(distance_to_ego).numpy())[:num_agents]
+    indices = torch.argsort(distance_to_ego)[:num_agents]
+    indices = indices[~(agents_tensor[-1, indices, 0] < -6.0)]
 
     # fill agent features into the array
-    added_agents = 0
-    for i in indices:
-        if added_agents >= num_agents:
-            break
-        
-        if agents_tensor[-1, i, 0] < -6.0:
-            continue
-
-        agents[added_agents, :, :agents_tensor.shape[-1]] = agents_tensor[:, i, :agents_tensor.shape[-1]]
-
-        if agent_types[i] == TrackedObjectType.VEHICLE:
-            agents[added_agents, :, agents_tensor.shape[-1]:] = torch.tensor([1, 0, 0])
-        elif agent_types[i] == TrackedObjectType.PEDESTRIAN:
-            agents[added_agents, :, agents_tensor.shape[-1]:] = torch.tensor([0, 1, 0])
-        else:
-            agents[added_agents, :, agents_tensor.shape[-1]:] = torch.tensor([0, 0, 1])
-
-        added_agents += 1
+    agents[:len(indices), :, :agents_tensor.shape[-1]] = agents_tensor[:, indices].transpose(0, 1)
+    if len(indices) > 0:
+        agents[:len(indices), :, agents_tensor.shape[-1]:] = agent_types_to_one_hot([agent_types[i] for i in indices.tolist()])[:, None]
 
     return ego_tensor, agents
 
@@ -329,33 +343,29 @@ def get_neighbor_map(
     return coords, traffic_light_data
 
 
-def map_process(anchor_state, coords, traffic_light_data, map_features, max_elements, max_points, interpolation_method):
-    # convert data to tensor list
+def map_process(anchor_state, coords, traffic_light_data, map_features, max_elements, max_points, interpolation_method,
+                fixed_size_features=None):
+    # pack each layer into one padded tensor
     anchor_state_tensor = torch.tensor([anchor_state.x, anchor_state.y, anchor_state.heading], dtype=torch.float32)
     list_tensor_data = {}
 
     for feature_name, feature_coords in coords.items():
-        list_feature_coords = []
+        list_tensor_data[f"coords.{feature_name}"] = pack_polylines(feature_coords.to_vector())
 
-        # Pack coords into tensor list
-        for element_coords in feature_coords.to_vector():
-            list_feature_coords.append(torch.tensor(element_coords, dtype=torch.float32))
-        list_tensor_data[f"coords.{feature_name}"] = list_feature_coords
-
-        # Pack traffic light data into tensor list if it exists
+        # Pack traffic light data into a tensor if it exists
         if feature_name in traffic_light_data:
-            list_feature_tl_data = []
-
-            for element_tl_data in traffic_light_data[feature_name].to_vector():
-                list_feature_tl_data.append(torch.tensor(element_tl_data, dtype=torch.float32))
-            list_tensor_data[f"traffic_light_data.{feature_name}"] = list_feature_tl_data
+            list_tensor_data[f"traffic_light_data.{feature_name}"] = torch.tensor(
+                traffic_light_data[feature_name].to_vector(), dtype=torch.float32
+            ).reshape(-1, LaneSegmentTrafficLightData.encoding_dim())
 
     tensor_output = {}
     traffic_light_encoding_dim = LaneSegmentTrafficLightData.encoding_dim()
 
     for feature_name in map_features:
-        if f"coords.{feature_name}" in list_tensor_data:
-            feature_coords = list_tensor_data[f"coords.{feature_name}"]
+        if fixed_size_features is not None and feature_name in fixed_size_features:
+            coords, tl_data, avails = fixed_size_features[feature_name]
+        elif f"coords.{feature_name}" in list_tensor_data:
+            feature_coords, feature_lengths = list_tensor_data[f"coords.{feature_name}"]
 
             feature_tl_data = (
                 list_tensor_data[f"traffic_light_data.{feature_name}"]
@@ -363,9 +373,10 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
                 else None
             )
 
-            coords, tl_data, avails = convert_feature_layer_to_fixed_size(
+            coords, tl_data, avails = convert_packed_feature_layer_to_fixed_size(
                     anchor_state_tensor,
                     feature_coords,
+                    feature_lengths,
                     feature_tl_data,
                     max_elements[feature_name],
                     max_points[feature_name],
@@ -381,14 +392,16 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
                     ]
                     else None,
             )
+        else:
+            continue
 
-            coords = vector_set_coordinates_to_local_frame(coords, avails, anchor_state_tensor)
+        coords = vector_set_coordinates_to_local_frame(coords, avails, anchor_state_tensor)
 
-            tensor_output[f"vector_set_map.coords.{feature_name}"] = coords
-            tensor_output[f"vector_set_map.availabilities.{feature_name}"] = avails
+        tensor_output[f"vector_set_map.coords.{feature_name}"] = coords
+        tensor_output[f"vector_set_map.availabilities.{feature_name}"] = avails
 
-            if tl_data is not None:
-                tensor_output[f"vector_set_map.traffic_light_data.{feature_name}"] = tl_data
+        if tl_data is not None:
+            tensor_output[f"vector_set_map.traffic_light_data.{feature_name}"] = tl_data
 
     for feature_name in map_features:
         if feature_name == "LANE":
@@ -416,18 +429,14 @@ def map_process(anchor_state, coords, traffic_light_data, map_features, max_elem
 
 
 def polyline_process(polylines, avails, traffic_light=None):
-    dim = 3 if traffic_light is None else 7
-    new_polylines = torch.zeros((polylines.shape[0], polylines.shape[1], dim), dtype=torch.float32)
-
-    for i in range(polylines.shape[0]):
-        if avails[i][0]:
-            polyline = polylines[i]
-            polyline_heading = torch.atan2(polyline[1:, 1]-polyline[:-1, 1], polyline[1:, 0]-polyline[:-1, 0])
-            polyline_heading = torch.fmod(polyline_heading, 2*torch.pi)
-            polyline_heading = torch.cat([polyline_heading, polyline_heading[-1].unsqueeze(0)], dim=0).unsqueeze(-1)
-            if traffic_light is None:
-                new_polylines[i] = torch.cat([polyline, polyline_heading], dim=-1)
-            else:
-                new_polylines[i] = torch.cat([polyline, polyline_heading, traffic_light[i]], dim=-1)
+    # headings of all polylines at once, zeroed for the padded elements
+    polyline_heading = torch.atan2(polylines[:, 1:, 1]-polylines[:, :-1, 1], polylines[:, 1:, 0]-polylines[:, :-1, 0])
+    polyline_heading = torch.fmod(polyline_heading, 2*torch.pi)
+    polyline_heading = torch.cat([polyline_heading, polyline_heading[:, -1:]], dim=1).unsqueeze(-1)
+    if traffic_light is None:
+        new_polylines = torch.cat([polylines, polyline_heading], dim=-1).float()
+    else:
+        new_polylines = torch.cat([polylines, polyline_heading, traffic_light], dim=-1).float()
+    new_polylines[~avails[:, 0]] = 0
 
     return new_polylines
@@ -10,20 +10,33 @@ import math
 import time
 import logging
 import matplotlib.pyplot as plt
-from shapely import Point, LineString
+from shapely import Point, LineString, STRtree
 from planner_utils import *
 from obs_adapter import *
+from map_store import get_lane_store
 from predictor import GameFormer
+from inference_engine import get_inference_engine, set_worker_threads
 from state_lattice_planner import LatticePlanner
 
 from nuplan.planning.simulation.observation.observation_type import DetectionsTracks
 from nuplan.planning.simulation.planner.abstract_planner import AbstractPlanner, PlannerInitialization, PlannerInput
+from nuplan.planning.simulation.planner.planner_report import PlannerReport, StagedPlannerReport
 from nuplan.planning.simulation.trajectory.interpolated_trajectory import InterpolatedTrajectory
 
 logging.basicConfig(level=logging.INFO)
 
 class Planner(AbstractPlanner):
-    def __init__(self, device=None, disable_refpath=False):
+    def __init__(self, device=None, disable_refpath=False, use_lane_store=False, lane_store_dir=None,
+                 inference_backend=None, quantize=False, max_plan_ade=0.2, num_accuracy_checks=1, num_threads=None,
+                 num_workers=None):
+        """
+        :param inference_backend: None runs the model eagerly, else 'eager', 'torchscript' or 'export' through a
+            GameFormerInferenceEngine (see inference_engine.py).
+        :param quantize: dynamic int8 quantization of the model, cpu only, needs an inference_backend.
+        :param max_plan_ade: [m] max plan deviation of the engine from the eager model before falling back to it.
+        :param num_accuracy_checks: number of inputs per input shape checked against the eager model.
+        :param num_threads: torch threads of the worker, else os.cpu_count() // num_workers when num_workers is set.
+        """
         self._max_path_length = MAX_LEN # [m]
         self._future_horizon = T # [s] 
         self._step_interval = DT # [s]
@@ -39,6 +52,15 @@ class Planner(AbstractPlanner):
 
         self._device = device
         self.disable_refpath = disable_refpath
+        self.use_lane_store = use_lane_store
+        self.lane_store_dir = lane_store_dir
+        self.inference_backend = inference_backend
+        self.quantize = quantize
+        self.max_plan_ade = max_plan_ade
+        self.num_accuracy_checks = num_accuracy_checks
+        self.num_threads = num_threads
+        self.num_workers = num_workers
+        self._stage_timer = StageTimer()
         logging.error(f'Using device: {self._device}')
         if self.disable_refpath:
             logging.info('disable ref path --------------------------------------------------------------')
@@ -53,6 +75,21 @@ class Planner(AbstractPlanner):
 
     def name(self) -> str:
         return "GameFormer Planner"
+
+    @property
+    def stage_runtimes(self):
+        # per-tick runtimes [s] of the planning stages since the last planner report
+        return self._stage_timer.runtimes
+
+    def generate_planner_report(self, clear_stats: bool = True) -> PlannerReport:
+        report = StagedPlannerReport(
+            compute_trajectory_runtimes=self._compute_trajectory_runtimes,
+            stage_runtimes=dict(self._stage_timer.runtimes),
+        )
+        if clear_stats:
+            self._compute_trajectory_runtimes = []
+            self._stage_timer.reset()
+        return report
     
     def observation_type(self):
         return DetectionsTracks
@@ -62,15 +99,31 @@ class Planner(AbstractPlanner):
         self._goal = initialization.mission_goal
         self._route_roadblock_ids = initialization.route_roadblock_ids
         self._initialize_route_plan(self._route_roadblock_ids)
+        set_worker_threads(self.num_threads, self.num_workers)
         self._initialize_model()
         self._trajectory_planner = TrajectoryPlanner(self._device)
         self._path_planner = LatticePlanner(self._candidate_lane_edge_ids, self._max_path_length)
+        lane_store = get_lane_store(self._map_api, self.lane_store_dir) if self.use_lane_store else None
+        self._observation_adapter = ObservationAdapter(lane_store)
+
+    def _load_model(self, checkpoint_path):
+        model = GameFormer(3, 2, 6, 20)
+        model.load_state_dict(torch.load(checkpoint_path, map_location=self._device))
+        model.to(self._device)
+        model.eval()
+
+        return model
 
     def _initialize_model(self):
-        self._model = GameFormer(3, 2, 6, 20)
-        self._model.load_state_dict(torch.load(current_dir+'/model_epoch_50_valADE_1.1328.pth', map_location=self._device))
-        self._model.to(self._device)
-        self._model.eval()
+        checkpoint_path = current_dir+'/model_epoch_50_valADE_1.1328.pth'
+        if self.inference_backend is None:
+            self._model = self._load_model(checkpoint_path)
+        else:
+            # the planners loading the model differently (e.g. random init) get their own engine
+            self._model = get_inference_engine(checkpoint_path, self._device, self.inference_backend, self.quantize,
+                                               self.max_plan_ade, model_builder=lambda: self._load_model(checkpoint_path),
+                                               model_id=type(self)._load_model,
+                                               num_accuracy_checks=self.num_accuracy_checks)
         
     def _initialize_route_plan(self, route_roadblock_ids):
         self._route_roadblocks = []
@@ -86,24 +139,32 @@ class Planner(AbstractPlanner):
             edge.id for block in self._route_roadblocks if block for edge in block.interior_edges
         ]
 
+        # spatial index of the route edges, rebuilt with the route
+        self._route_edge_blocks = [block for block in self._route_roadblocks if block for _ in block.interior_edges]
+        self._route_edge_tree = STRtree(
+            [edge.polygon for block in self._route_roadblocks if block for edge in block.interior_edges]
+        )
+
+    def _get_starting_block(self, ego_state):
+        """
+        Get the route block holding the route edge closest to ego, the first one in route order among ties.
+        :return: starting block and its distance to ego, (None, inf) for an empty route.
+        """
+        if len(self._route_edge_blocks) == 0:
+            return None, math.inf
+
+        cur_point = Point(ego_state.rear_axle.x, ego_state.rear_axle.y)
+        indices, distances = self._route_edge_tree.query_nearest(cur_point, return_distance=True, all_matches=True)
+        closest = np.argmin(indices)
+
+        return self._route_edge_blocks[indices[closest]], distances[closest]
+
     def _get_reference_path(self, ego_state, traffic_light_data, observation):
         # Get starting block
-        starting_block = None
         min_target_speed = 3
         max_target_speed = 15
-        cur_point = (ego_state.rear_axle.x, ego_state.rear_axle.y)
-        closest_distance = math.inf
-
-        for block in self._route_roadblocks:
-            for edge in block.interior_edges:
-                distance = edge.polygon.distance(Point(cur_point))
-                if distance < closest_distance:
-                    starting_block = block
-                    closest_distance = distance
-
-            if np.isclose(closest_distance, 0):
-                break
-            
+        starting_block, closest_distance = self._get_starting_block(ego_state)
+
         # In case the ego vehicle is not on the route, return None
         if closest_distance > 7:
             return None
@@ -188,12 +249,9 @@ class Planner(AbstractPlanner):
         return plan
     
     def _plan(self, ego_state, history, traffic_light_data, observation):
-        # start time
-        start_time = time.perf_counter()
-      
         # Construct input features
-        features = observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids, self._device)
-        feature_construct_time = time.perf_counter() - start_time
+        with self._stage_timer.measure('observation_adapter'):
+            features = self._observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids, self._device)
         # if feature_construct_time > 0.5:
         #     logging.error(f'Feature construction time: {feature_construct_time:.3f} s')
         #     plan = self._constant_velocity_planning(ego_state, None)
@@ -206,8 +264,8 @@ class Planner(AbstractPlanner):
         if self.disable_refpath:
             ref_path = None
         else:
-            ref_path = self._get_reference_path(ego_state, traffic_light_data, observation)
-        find_path_time = time.perf_counter() - start_time
+            with self._stage_timer.measure('reference_path'):
+                ref_path = self._get_reference_path(ego_state, traffic_light_data, observation)
         # if find_path_time > 0.5:
         #     logging.error(f'Find path time: {find_path_time:.3f} s')
         #     plan = self._constant_velocity_planning(ego_state, ref_path)
@@ -217,10 +275,9 @@ class Planner(AbstractPlanner):
         #     return trajectory
 
         # Infer prediction model
-        with torch.no_grad():
+        with torch.no_grad(), self._stage_timer.measure('gameformer_decode'):
             plan, predictions, pred_scores, ego_state_transformed, neighbors_state_transformed = self._get_prediction(features)
 
-        prediction_time = time.perf_counter() - start_time
         # if prediction_time > 0.5:
         #     logging.error(f'Prediction time: {prediction_time:.3f} s')
         #     plan = self._ml_planning(plan[0], ref_path)
@@ -230,7 +287,7 @@ class Planner(AbstractPlanner):
         #     return trajectory
 
         # Trajectory planning
-        with torch.no_grad():
+        with torch.no_grad(), self._stage_timer.measure('speed_planning'):
             plan = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed, 
                                                  predictions, plan, pred_scores, ref_path, observation)
             
@@ -1,7 +1,10 @@
+import time
 import scipy
 import torch
 import numpy as np
 import matplotlib.pyplot as plt
+from collections import defaultdict
+from contextlib import contextmanager
 try:
     from common_utils import *
     from speed_planner import SpeedPlanner
@@ -18,6 +21,29 @@ except:
 
 #smoother = MotionNonlinearSmoother(int(T/DT), DT)
 
+class StageTimer:
+    """
+    Runtimes [s] of the planner stages (observation adapter, reference path, model, speed planning, ...),
+    one time series per stage name, collected over the ticks of a simulation.
+    """
+    def __init__(self):
+        self.runtimes = defaultdict(list)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.runtimes[stage].append(time.perf_counter() - start)
+
+    def add(self, stage, runtime):
+        self.runtimes[stage].append(runtime)
+
+    def reset(self):
+        self.runtimes = defaultdict(list)
+
+
 class TrajectoryPlanner:
     def __init__(self, device='cpu'):
         self.N = int(T/DT)
@@ -36,25 +62,10 @@ class TrajectoryPlanner:
     def plan(self, ego_state, ego_state_transformed, neighbors_state_transformed, 
              predictions, plan, pred_scores, ref_path, observation):
         # Get the plan from the prediction model
-        plan = plan[0].cpu().numpy()
-        dy = plan[1:, 1] - plan[:-1, 1]
-        dx = plan[1:, 0] - plan[:-1, 0]
-        dx = np.clip(dx, 1e-2, None)
-        heading = np.arctan2(dy, dx)
-        heading = np.concatenate([heading, [heading[-1]]])
-        plan = np.column_stack([plan, heading])
+        plan = self._plan_with_heading(plan)
         
         # Get the plan in the reference path
-        if ref_path is not None:
-            distance_to_ref = scipy.spatial.distance.cdist(plan[:, :2], ref_path[:, :2])
-            i = np.argmin(distance_to_ref, axis=1)
-            plan = ref_path[i, :3]
-            s = np.concatenate([[0], i]) * 0.1
-            speed = np.diff(s) / DT
-        else:
-            speed = np.diff(plan[:, :2], axis=0) / DT
-            speed = np.linalg.norm(speed, axis=-1)
-            speed = np.concatenate([speed, [speed[-1]]])
+        plan, s, speed = self._project_plan(plan, ref_path)
             
         # Speed planning
         if ref_path is not None and predictions is not None and pred_scores is not None:
@@ -71,8 +82,7 @@ class TrajectoryPlanner:
 
             # Convert to Cartesian trajectory
             ref_path = ref_path.squeeze(0).cpu().numpy()
-            i = (s * 10).astype(np.int32).clip(0, len(ref_path)-1)
-            plan = ref_path[i, :3]
+            plan = self._path_at_s(s, ref_path)
 
         # Trajectory smoothing
         #current = ego_state_transformed.squeeze(0).cpu().numpy()[:4]
@@ -86,6 +96,71 @@ class TrajectoryPlanner:
         #    plan = plan[1:, :3]
 
         return plan
+
+    def plan_batch(self, ego_state, ego_state_transformed, neighbors_state_transformed,
+                   predictions, plan, pred_scores, ref_paths, observation):
+        """
+        Same as plan for each of ref_paths, with a single batched speed optimization.
+        :return: list of plans, one per reference path
+        """
+        if predictions is None or pred_scores is None or len(ref_paths) == 0:
+            return [self.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
+                              predictions, plan, pred_scores, ref_path, observation) for ref_path in ref_paths]
+
+        plan = self._plan_with_heading(plan)
+        ego_plan_ds, ego_plan_s, occupancies = [], [], []
+        for ref_path in ref_paths:
+            _, s, speed = self._project_plan(plan, ref_path)
+            ego_plan_ds.append(speed)
+            ego_plan_s.append(s)
+            occupancies.append(occupancy_adpter(predictions[0], pred_scores[0, 1:], neighbors_state_transformed[0], ref_path))
+
+        # ref paths are padded to MAX_LEN*10, pad again in case they are not to stack them
+        path_len = max(len(ref_path) for ref_path in ref_paths)
+        padded_ref_paths = [np.append(ref_path, np.repeat(ref_path[np.newaxis, -1], path_len-len(ref_path), axis=0), axis=0)
+                            for ref_path in ref_paths]
+
+        ego_plan_ds = torch.from_numpy(np.stack(ego_plan_ds)).float().to(self._device)
+        ego_plan_s = torch.from_numpy(np.stack(ego_plan_s)).float().to(self._device)
+        occupancies = torch.from_numpy(np.stack(occupancies)).to(self._device)
+        ref_paths_tensor = torch.from_numpy(np.stack(padded_ref_paths)).to(self._device)
+        ego_state_transformed = ego_state_transformed.to(self._device)
+
+        s, _ = self.speed_planenr.plan_batch(ego_state_transformed, ego_plan_ds, ego_plan_s, occupancies, ref_paths_tensor)
+        s = s.cpu().numpy()
+
+        # Convert to Cartesian trajectory
+        return [self._path_at_s(s[b], ref_path) for b, ref_path in enumerate(padded_ref_paths)]
+
+    @staticmethod
+    def _plan_with_heading(plan):
+        plan = plan[0].cpu().numpy()
+        dy = plan[1:, 1] - plan[:-1, 1]
+        dx = plan[1:, 0] - plan[:-1, 0]
+        dx = np.clip(dx, 1e-2, None)
+        heading = np.arctan2(dy, dx)
+        heading = np.concatenate([heading, [heading[-1]]])
+        return np.column_stack([plan, heading])
+
+    @staticmethod
+    def _project_plan(plan, ref_path):
+        if ref_path is not None:
+            distance_to_ref = scipy.spatial.distance.cdist(plan[:, :2], ref_path[:, :2])
+            i = np.argmin(distance_to_ref, axis=1)
+            plan = ref_path[i, :3]
+            s = np.concatenate([[0], i]) * 0.1
+            speed = np.diff(s) / DT
+        else:
+            s = None
+            speed = np.diff(plan[:, :2], axis=0) / DT
+            speed = np.linalg.norm(speed, axis=-1)
+            speed = np.concatenate([speed, [speed[-1]]])
+        return plan, s, speed
+
+    @staticmethod
+    def _path_at_s(s, ref_path):
+        i = (s * 10).astype(np.int32).clip(0, len(ref_path)-1)
+        return ref_path[i, :3]
     
     @staticmethod
     def transform_to_Cartesian_path(path, ref_path):
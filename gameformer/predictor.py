@@ -135,13 +135,14 @@ class LLMEnhancedGameFormer(nn.Module):
         super(LLMEnhancedGameFormer, self).__init__()
         self.neighbors = neighbors
         self.share_encoder = share_encoder
-        self.encoder = Encoder(layers=encoder_layers)
+        # with a shared encoder the encoder outputs are computed outside and passed to forward
+        self.encoder = None if share_encoder else Encoder(layers=encoder_layers)
         self.decoder = Decoder(neighbors, modalities, decoder_levels)
         self.planner = NeuralPlanner()
 
     def forward_not_share_encoder(self, inputs, llm_feature):
         # TODO: add fusion module
-        encoder_outputs = self.encoder(inputs, swap=self.swap)
+        encoder_outputs = self.encoder(inputs)
         route_lanes = encoder_outputs['route_lanes']
         decoder_outputs, env_encoding = self.decoder(encoder_outputs, llm_feature=llm_feature)
         ego_plan = self.planner(env_encoding, route_lanes)
@@ -135,7 +135,8 @@ class LLMEnhancedGameFormer_Adapter(nn.Module):
         super(LLMEnhancedGameFormer_Adapter, self).__init__()
         self.neighbors = neighbors
         self.share_encoder = share_encoder
-        self.encoder = Encoder(layers=encoder_layers)
+        # with a shared encoder the encoder outputs are computed outside and passed to forward
+        self.encoder = None if share_encoder else Encoder(layers=encoder_layers)
         self.decoder = Decoder(neighbors, modalities, decoder_levels)
         self.planner = NeuralPlanner()
 
@@ -152,7 +152,7 @@ class AdaptiveBlock(nn.Module):
     def __init__(self, heads=8, dim=256):
         super().__init__()
         self.head_dim = dim // heads
-        self.gate = torch.nn.Parameter(torch.zeros(1, heads, 1, 1, device='cuda'))
+        self.gate = torch.nn.Parameter(torch.zeros(1, heads, 1, 1))
         self.n_local_heads = heads
         # self.n_local_heads = heads // int(os.environ["WORLD_SIZE"])
         # self.head_start = self.n_local_heads * int(os.environ["LOCAL_RANK"])
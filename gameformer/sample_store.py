@@ -0,0 +1,264 @@
+import os
+import glob
+import json
+import argparse
+
+import numpy as np
+
+
+SCHEMA_FILE = 'schema.json'
+META_FILE = 'meta.jsonl'
+# a sample reference is <store root>/<shard>@<row>, stored as map_info in the json indices
+REF_SEPARATOR = '@'
+
+# opened shards of the process, the reader side of load_sample
+_SHARDS = {}
+
+
+def _is_numeric(value):
+    # python lists (instruction, traffic_light) vary in length between samples
+    return not isinstance(value, (list, tuple)) and np.asarray(value).dtype.kind in 'biuf'
+
+
+def _to_array(value):
+    # meta values come back as arrays, as np.savez stored them
+    try:
+        return np.asarray(value)
+    except ValueError:
+        return np.array(value, dtype=object)
+
+
+def _to_json(value):
+    if isinstance(value, np.ndarray) or isinstance(value, np.generic):
+        return value.tolist()
+    if isinstance(value, (list, tuple)):
+        return [_to_json(v) for v in value]
+    return value
+
+
+class SampleStoreWriter:
+    """
+    Appends samples to one shard of a columnar sample store, a directory holding one shard per writer.
+    Every numeric field of the samples is one contiguous raw array file of the shard, <field>.bin, with its dtype and
+    per-sample shape fixed by the first sample in schema.json. String / variable sized fields (map_name, token,
+    instruction, traffic_light) go to the side table meta.jsonl, one line per sample.
+    A sample counts once its side table line is written, so a shard killed while appending loses that sample only.
+    """
+    def __init__(self, root, shard):
+        self.root = root
+        self.shard = shard
+        self.shard_dir = os.path.join(root, shard)
+        os.makedirs(self.shard_dir, exist_ok=True)
+
+        self._schema = None
+        schema_path = os.path.join(self.shard_dir, SCHEMA_FILE)
+        if os.path.exists(schema_path):
+            with open(schema_path, 'r') as f:
+                self._schema = json.load(f)
+        self._num_rows = SampleStoreShard(self.shard_dir).num_rows if self._schema is not None else 0
+        self._files = {}
+        self._meta = None
+
+    def _open(self, sample):
+        if self._schema is None:
+            self._schema = {
+                'numeric': {k: {'dtype': np.asarray(v).dtype.str, 'shape': list(np.asarray(v).shape)}
+                            for k, v in sample.items() if _is_numeric(v)},
+                'meta': sorted(k for k, v in sample.items() if not _is_numeric(v)),
+            }
+            with open(os.path.join(self.shard_dir, SCHEMA_FILE), 'w') as f:
+                json.dump(self._schema, f, indent=2)
+
+        row_bytes = {k: np.dtype(v['dtype']).itemsize * int(np.prod(v['shape'], dtype=np.int64))
+                     for k, v in self._schema['numeric'].items()}
+        for k in self._schema['numeric']:
+            path = os.path.join(self.shard_dir, f'{k}.bin')
+            f = open(path, 'ab')
+            # drop the part of a sample written by a killed writer
+            f.truncate(self._num_rows * row_bytes[k])
+            f.seek(0, os.SEEK_END)
+            self._files[k] = f
+        self._meta = open(os.path.join(self.shard_dir, META_FILE), 'a')
+
+    def append(self, sample):
+        """
+        :param sample: dict of field -> numpy array / tensor / python value, with the fields of the first sample.
+        :return: reference of the sample, see load_sample.
+        """
+        if self._meta is None:
+            self._open(sample)
+        numeric, meta = self._schema['numeric'], self._schema['meta']
+        if set(sample.keys()) != set(numeric) | set(meta):
+            raise ValueError(f'Sample fields {sorted(sample.keys())} differ from the store schema {sorted(numeric) + meta}')
+
+        for k, spec in numeric.items():
+            value = np.asarray(sample[k])
+            if list(value.shape) != spec['shape']:
+                raise ValueError(f"Field {k} has shape {list(value.shape)}, the store schema has {spec['shape']}")
+            self._files[k].write(np.ascontiguousarray(value, dtype=np.dtype(spec['dtype'])).tobytes())
+            self._files[k].flush()
+        self._meta.write(json.dumps({k: _to_json(sample[k]) for k in meta}) + '\n')
+        self._meta.flush()
+        self._num_rows += 1
+
+        return sample_ref(self.root, self.shard, self._num_rows - 1)
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        if self._meta is not None:
+            self._meta.close()
+        self._files, self._meta = {}, None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SampleStoreShard:
+    """
+    Read side of a shard: the numeric fields are memory mapped copy-on-write, so a sample is a set of views into the
+    shard files (zero-copy, writable without touching the files).
+    """
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        with open(os.path.join(shard_dir, SCHEMA_FILE), 'r') as f:
+            self.schema = json.load(f)
+
+        self.meta = []
+        meta_path = os.path.join(shard_dir, META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r') as f:
+                for line in f:
+                    try:
+                        self.meta.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        # last line of a killed writer
+                        break
+
+        num_rows = len(self.meta)
+        specs = {}
+        for k, spec in self.schema['numeric'].items():
+            dtype, shape = np.dtype(spec['dtype']), tuple(spec['shape'])
+            row_bytes = dtype.itemsize * int(np.prod(shape, dtype=np.int64))
+            path = os.path.join(shard_dir, f'{k}.bin')
+            size = os.path.getsize(path) if os.path.exists(path) else 0
+            num_rows = min(num_rows, size // row_bytes if row_bytes > 0 else num_rows)
+            specs[k] = (path, dtype, shape)
+        self.num_rows = num_rows
+
+        self.arrays = {}
+        for k, (path, dtype, shape) in specs.items():
+            if num_rows == 0:
+                self.arrays[k] = np.zeros((0,) + shape, dtype=dtype)
+            else:
+                self.arrays[k] = np.memmap(path, dtype=dtype, mode='c', shape=(num_rows,) + shape)
+
+    def __len__(self):
+        return self.num_rows
+
+    def __getitem__(self, row):
+        if not 0 <= row < self.num_rows:
+            raise IndexError(f'Row {row} out of the {self.num_rows} rows of {self.shard_dir}')
+        sample = {k: array[row] for k, array in self.arrays.items()}
+        sample.update({k: _to_array(v) for k, v in self.meta[row].items()})
+
+        return sample
+
+
+class SampleStore:
+    """
+    All shards of a store, indexed by a global sample index (shards in name order) or by (token, iter).
+    """
+    def __init__(self, root):
+        self.root = root
+        shard_dirs = sorted(os.path.dirname(path) for path in glob.glob(os.path.join(root, '*', SCHEMA_FILE)))
+        self.shards = [get_shard(shard_dir) for shard_dir in shard_dirs]
+        self.offsets = np.cumsum([0] + [len(shard) for shard in self.shards])
+        self._lookup = None
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+    def __getitem__(self, idx):
+        shard_idx = int(np.searchsorted(self.offsets, idx, side='right')) - 1
+        return self.shards[shard_idx][idx - int(self.offsets[shard_idx])]
+
+    def find(self, token, iter):
+        """
+        :return: global index of the sample of frame iter of scenario token, the last written one if it was written
+            several times, None if it is not in the store.
+        """
+        if self._lookup is None:
+            # reads the token / iter of every sample once
+            self._lookup = {}
+            for shard_idx, shard in enumerate(self.shards):
+                for row in range(len(shard)):
+                    sample = shard[row]
+                    self._lookup[(str(sample['token']), int(sample['iter']))] = int(self.offsets[shard_idx]) + row
+        return self._lookup.get((token, iter))
+
+
+def sample_ref(root, shard, row):
+    return f'{os.path.join(root, shard)}{REF_SEPARATOR}{row}'
+
+
+def is_sample_ref(map_info):
+    return REF_SEPARATOR in os.path.basename(map_info) and not map_info.endswith('.npz')
+
+
+def get_shard(shard_dir):
+    """
+    Shard opened once per process. Shards appended after opening are not reloaded.
+    """
+    if shard_dir not in _SHARDS:
+        _SHARDS[shard_dir] = SampleStoreShard(shard_dir)
+    return _SHARDS[shard_dir]
+
+
+def load_sample(map_info):
+    """
+    Load the sample of a json index entry: a sample store reference, or the path of a per-frame npz file.
+    :return: dict-like of field -> array / value, with the keys of the npz files.
+    """
+    if is_sample_ref(map_info):
+        shard_dir, row = map_info.rsplit(REF_SEPARATOR, 1)
+        shard = get_shard(shard_dir)
+        if int(row) >= len(shard):
+            # appended since the shard was opened
+            shard = _SHARDS[shard_dir] = SampleStoreShard(shard_dir)
+        return shard[int(row)]
+
+    return np.load(map_info, allow_pickle=True)
+
+
+def convert_npz_index(index_path, store_root, output_path, shard='converted'):
+    """
+    Copy the npz samples of a json index into one shard of a sample store and write the index with the references.
+    """
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+
+    with SampleStoreWriter(store_root, shard) as writer:
+        for entry in index:
+            if entry.get('map_info') is None or entry['map_info'] == 'null' or is_sample_ref(entry['map_info']):
+                continue
+            data = np.load(entry['map_info'], allow_pickle=True)
+            entry['map_info'] = writer.append({k: data[k] for k in data.keys()})
+
+    with open(output_path, 'w') as f:
+        json.dump(index, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert the npz samples of a json index to a sample store')
+    parser.add_argument('--index', type=str, required=True, help='json index with npz paths as map_info')
+    parser.add_argument('--store', type=str, required=True, help='sample store directory')
+    parser.add_argument('--output', type=str, required=True, help='json index with sample references as map_info')
+    parser.add_argument('--shard', type=str, default=None, help='shard name, the index file name by default')
+    args = parser.parse_args()
+
+    shard = args.shard or os.path.splitext(os.path.basename(args.index))[0]
+    convert_npz_index(args.index, args.store, args.output, shard)
@@ -181,3 +181,10 @@ class SpeedPlanner:
         s = torch.cumsum(ds * DT, dim=-1).to(self._device)
 
         return s, ds
+
+    def plan_batch(self, ego_state, init_plans, pred_plans, occupancies, ref_paths):
+        """Solve the speed profiles of B reference paths in one batched optimization, as B calls of plan."""
+        batch_size = init_plans.shape[0]
+        ego_state = ego_state.expand(batch_size, -1)
+
+        return self.plan(ego_state, init_plans, pred_plans, occupancies, ref_paths)
@@ -1,45 +1,42 @@
 import scipy
 import numpy as np
 import matplotlib.pyplot as plt
-from shapely import Point, LineString
+import shapely
+from shapely import Point, LineString, STRtree
 from shapely.geometry.base import CAP_STYLE
+from shapely.errors import GEOSException
 import logging
 try:
     from common_utils import *
-    from bezier_path import calc_4points_bezier_path
+    from bezier_path import calc_4points_bezier_path, calc_4points_bezier_paths
     from cubic_spline_planner import calc_spline_course
 except:
     from .common_utils import *
-    from .bezier_path import calc_4points_bezier_path
+    from .bezier_path import calc_4points_bezier_path, calc_4points_bezier_paths
     from .cubic_spline_planner import calc_spline_course
 from nuplan.common.actor_state.tracked_objects_types import TrackedObjectType
-from nuplan.planning.simulation.observation.idm.utils import path_to_linestring
 from nuplan.planning.metrics.utils.expert_comparisons import principal_value
 
 
 class LatticePlanner: 
     def __init__(self, route_ids, max_len=120, return_all_refpath=False):
         self.target_depth = max_len
-        self.candidate_lane_edge_ids = route_ids
+        self.candidate_lane_edge_ids = set(route_ids)
         self.max_path_len = max_len
         self.return_all_refpath = return_all_refpath
+        # starting edge id -> [(lane sequence, polyline)], the route is fixed for the lifetime of the planner
+        self._path_cache = {}
 
     def get_candidate_paths(self, edges):
         '''Get candidate paths using depth first search'''
-        # get all paths
+        # get all paths with their polylines
         paths = []
         for edge in edges:
-            paths.extend(self.depth_first_search(edge)) # [[path1(lane1, lane2, ...)], [path2], ...]
+            paths.extend(self.get_edge_paths(edge)) # [(path1(lane1, lane2, ...), polyline1), ...]
 
         candidate_paths = {}
 
-        # extract path polyline
-        for i, path in enumerate(paths):
-            path_polyline = [] # all point of a path; [points*N]
-            for edge in path:
-                path_polyline.extend(edge.baseline_path.discrete_path)
-
-            path_polyline = self.check_path(np.array(path_to_linestring(path_polyline).coords))
+        for i, (path, path_polyline) in enumerate(paths):
             dist_to_ego = scipy.spatial.distance.cdist([self.ego_point], path_polyline)
             path_polyline = path_polyline[dist_to_ego.argmin():]
             if len(path_polyline) < 3:
@@ -121,15 +118,25 @@ class LatticePlanner:
             self._just_stay_current = False
 
         # Calculate costs and choose the optimal path
+        try:
+            costs = self.calculate_costs(paths, obstacles, vehicles)
+        except (ValueError, IndexError, GEOSException) as e:
+            # cost each path on its own to skip only the failing ones
+            logging.warning(f'Error in calculating the costs of all paths ({e}), costing each path on its own')
+            costs = None
+
         optimal_path = None
         min_cost = np.inf
         path_cost = []
-        for path in paths:
-            try:
-                cost = self.calculate_cost(path, obstacles, vehicles)
-            except:
-                logging.error('Error in calculating cost !!!!!!!!!!!! skip this path')
-                continue
+        for i, path in enumerate(paths):
+            if costs is not None:
+                cost = costs[i]
+            else:
+                try:
+                    cost = self.calculate_cost(path, obstacles, vehicles)
+                except:
+                    logging.error('Error in calculating cost !!!!!!!!!!!! skip this path')
+                    continue
             path_cost.append((path[0], cost))
             if cost < min_cost:
                 min_cost = cost
@@ -152,7 +159,9 @@ class LatticePlanner:
         '''Generate paths from state lattice'''
         new_paths = []
         ego_state = ego_state.rear_axle.x, ego_state.rear_axle.y, ego_state.rear_axle.heading
-        
+
+        # sample the target states of all paths first
+        sampled_paths = []
         for _, (path_len, dist, path, path_polyline) in paths:
             if len(path_polyline) > 81:
                 sampled_index = np.array([5, 10, 15, 20]) * 4
@@ -164,17 +173,80 @@ class LatticePlanner:
                 sampled_index = [20]
             else:
                 sampled_index = [1]
-     
-            target_states = path_polyline[sampled_index].tolist()
-            for j, state in enumerate(target_states):
-                first_stage_path = calc_4points_bezier_path(ego_state[0], ego_state[1], ego_state[2], 
-                                                            state[0], state[1], state[2], 3, sampled_index[j])[0]
+            sampled_paths.append((path_len, dist, path, path_polyline, sampled_index))
+
+        # one batch of bezier curves per number of points
+        targets = {}
+        for k, (_, _, _, path_polyline, sampled_index) in enumerate(sampled_paths):
+            for j, index in enumerate(sampled_index):
+                targets.setdefault(int(index), []).append((k, j, path_polyline[index]))
+        bezier_paths = {}
+        for n_points, states in targets.items():
+            states_array = np.array([state for _, _, state in states])
+            curves = calc_4points_bezier_paths(ego_state[0], ego_state[1], ego_state[2],
+                                               states_array[:, 0], states_array[:, 1], states_array[:, 2], 3, n_points)
+            for (k, j, _), curve in zip(states, curves):
+                bezier_paths[(k, j)] = curve
+
+        for k, (path_len, dist, path, path_polyline, sampled_index) in enumerate(sampled_paths):
+            for j in range(len(sampled_index)):
+                first_stage_path = bezier_paths[(k, j)]
                 second_stage_path = path_polyline[sampled_index[j]+1:, :2]
                 path_polyline = np.concatenate([first_stage_path, second_stage_path], axis=0)
                 new_paths.append((path_polyline, dist, path, path_len))     
 
         return new_paths
 
+    def calculate_costs(self, paths, obstacles, vehicles):
+        '''calculate_cost of all paths at once'''
+        num_paths = len(paths)
+        if num_paths == 0:
+            return np.zeros((0,))
+
+        # path curvature, batched over the paths of equal length
+        curvature = np.zeros((num_paths,))
+        path_heads = [path[0][0:100] for path in paths]
+        for length in set(len(head) for head in path_heads):
+            idx = [i for i, head in enumerate(path_heads) if len(head) == length]
+            curvature[idx] = np.max(self.calculate_path_curvature(np.stack([path_heads[i] for i in idx])), axis=-1)
+
+        # lane change
+        lane_change = np.array([path[1] for path in paths], dtype=np.float64)
+        if self._just_stay_current:
+            lane_change = 5 * lane_change
+
+        # go to the target lane
+        target = np.zeros((num_paths,))
+        near_target = np.array([np.abs(path[3] - self.path_len) <= 5 for path in paths])
+        if near_target.any():
+            target[near_target] = 1
+            if len(vehicles) > 0:
+                target_idx = np.nonzero(near_target)[0]
+                lines = [LineString(paths[i][0][0:50:10]) for i in target_idx]
+                tree = STRtree([v.geometry for v in vehicles])
+                (line_idx, _), distances = tree.query_nearest(lines, return_distance=True, all_matches=False)
+                near_vehicle = np.zeros((len(target_idx),), dtype=bool)
+                near_vehicle[line_idx[distances < 5]] = True
+                target[target_idx[near_vehicle]] = 0
+
+        # check obstacles
+        obstacle_cost = np.zeros((num_paths,))
+        if len(obstacles) > 0:
+            # the paths have different numbers of points, shapely.linestrings only takes equal ones
+            lines = [LineString(path[0][0:100:10]) for path in paths]
+            expanded_paths = shapely.buffer(lines, WIDTH/2, cap_style='square')
+            tree = STRtree([obstacle.geometry for obstacle in obstacles])
+            path_idx, _ = tree.query(expanded_paths, predicate='intersects')
+            obstacle_cost[path_idx] = 1
+
+        # out of boundary
+        out_boundary = 0
+
+        # final cost
+        costs = 10 * obstacle_cost + 2 * out_boundary + 1 * lane_change + 0.1 * curvature - 5 * target
+
+        return costs
+
     def calculate_cost(self, path, obstacles, vehicles):
         # path curvature
         curvature = self.calculate_path_curvature(path[0][0:100])
@@ -211,6 +283,17 @@ class LatticePlanner:
 
         return ref_path
 
+    def get_edge_paths(self, starting_edge):
+        '''Lane sequences from starting_edge and their polylines, enumerated once per starting edge'''
+        if starting_edge.id not in self._path_cache:
+            edge_paths = []
+            for path in self.depth_first_search(starting_edge):
+                path_polyline = np.array([[point.x, point.y] for edge in path for point in edge.baseline_path.discrete_path])
+                edge_paths.append((path, self.check_path(path_polyline)))
+            self._path_cache[starting_edge.id] = edge_paths
+
+        return self._path_cache[starting_edge.id]
+
     def depth_first_search(self, starting_edge, depth=0):
         if depth >= self.target_depth:
             return [[starting_edge]]
@@ -252,15 +335,9 @@ class LatticePlanner:
 
     @staticmethod
     def check_path(path):
-        refine_path = [path[0]]
-        
-        for i in range(1, path.shape[0]):
-            if np.linalg.norm(path[i] - path[i-1]) < 0.1:
-                continue
-            else:
-                refine_path.append(path[i])
-        
-        line = np.array(refine_path)
+        # drop the points closer than 0.1m to their predecessor
+        keep = np.linalg.norm(np.diff(path, axis=0), axis=-1) >= 0.1
+        line = path[np.concatenate([[True], keep])]
 
         return line
 
@@ -296,10 +373,11 @@ class LatticePlanner:
 
     @staticmethod
     def calculate_path_curvature(path):
-        dx = np.gradient(path[:, 0])
-        dy = np.gradient(path[:, 1])
-        d2x = np.gradient(dx)
-        d2y = np.gradient(dy)
+        # path: (N, 2) or a batch (B, N, 2)
+        dx = np.gradient(path[..., 0], axis=-1)
+        dy = np.gradient(path[..., 1], axis=-1)
+        d2x = np.gradient(dx, axis=-1)
+        d2y = np.gradient(dy, axis=-1)
         curvature = np.abs(dx * d2y - d2x * dy) / (dx**2 + dy**2)**(3/2)
 
         return curvature
@@ -0,0 +1,157 @@
+import unittest
+
+import numpy as np
+import scipy
+import torch
+from nuplan.planning.metrics.utils.expert_comparisons import principal_value
+
+from gameformer.adapter import occupancy_adpter, transform_to_Frenet
+from gameformer.common_utils import MAX_LEN, T, WIDTH
+
+
+def loop_transform_to_Frenet(traj, ref_path):
+    """transform_to_Frenet of a single (timesteps, 2|3) trajectory over the full distance matrix"""
+    distance_to_ref_path = scipy.spatial.distance.cdist(traj[:, :2], ref_path[:, :2])
+    frenet_idx = np.argmin(distance_to_ref_path, axis=-1)
+    ref_points = ref_path[frenet_idx]
+    interval = 0.1
+
+    frenet_s = interval * frenet_idx
+    e = np.sign((traj[:, 1] - ref_points[:, 1]) * np.cos(ref_points[:, 2]) - (traj[:, 0] - ref_points[:, 0]) * np.sin(ref_points[:, 2]))
+    frenet_l = np.linalg.norm(traj[:, :2] - ref_points[:, :2], axis=-1) * e
+
+    if traj.shape[-1] == 3:
+        frenet_h = principal_value(ref_points[:, 2] - traj[:, 2])
+        frenet_traj = np.column_stack([frenet_s, frenet_l, frenet_h])
+    else:
+        frenet_traj = np.column_stack([frenet_s, frenet_l])
+
+    return frenet_traj
+
+
+def loop_occupancy_adpter(predictions, scores, neighbors, ref_path):
+    """occupancy_adpter with one Frenet projection per agent and the grid filled per timestep and agent"""
+    best_mode = np.argmax(scores.cpu().numpy(), axis=-1)
+    predictions = predictions.cpu().numpy()
+    neighbors = neighbors.cpu().numpy()
+
+    best_predictions = [predictions[i, best_mode[i], :, :2] for i in range(predictions.shape[0])]
+    prediction_F = [loop_transform_to_Frenet(a, ref_path) for a in best_predictions]
+    len_path = ref_path.shape[0]
+    if len_path < MAX_LEN * 10:
+        ref_path = np.append(ref_path, np.repeat(ref_path[np.newaxis, -1], MAX_LEN*10-len(ref_path), axis=0), axis=0)
+
+    time_occupancy = np.stack(T * 10 * [ref_path[:, -1]], axis=0)
+
+    for t in range(T * 10):
+        for n, a in enumerate(prediction_F):
+            if neighbors[n][0] == 0:
+                continue
+
+            if a[0][0] <= 0:
+                continue
+
+            aw = neighbors[n][7]
+            threshold = aw * 0.5 + WIDTH * 0.5 + 0.3
+
+            if a[t][0] > 0 and np.abs(a[t][1]) < threshold:
+                al = neighbors[n][6]
+                backward = 0.5 * al + 3
+                forward = 0.5 * al
+                os = np.clip(a[t][0] - backward, 0, MAX_LEN)
+                oe = np.clip(a[t][0] + forward, 0, MAX_LEN)
+                time_occupancy[t][int(os*10):int(oe*10)] = 1
+
+        if len_path < MAX_LEN * 10:
+            time_occupancy[t][len_path:] = 1
+
+    time_occupancy = np.reshape(time_occupancy, (T*10, -1, 10))
+    time_occupancy = np.max(time_occupancy, axis=-1)
+
+    return time_occupancy
+
+
+def make_ref_path(length, padded_length=None):
+    """(x, y, heading, curvature, speed limit, occupancy) of a straight path at 0.1 m spacing, the last point
+    repeated up to padded_length as the planner pads its paths"""
+    s = np.arange(int(length * 10)) * 0.1
+    ref_path = np.stack([s, np.zeros_like(s), np.zeros_like(s), np.zeros_like(s), np.full_like(s, 10.0),
+                         np.zeros_like(s)], axis=-1)
+    ref_path[-20:, -1] = 1  # e.g. a red light
+    if padded_length is not None:
+        ref_path = np.append(ref_path, np.repeat(ref_path[np.newaxis, -1], int(padded_length * 10) - len(ref_path), axis=0), axis=0)
+
+    return ref_path
+
+
+class TestFrenetProjection(unittest.TestCase):
+    """Test the vectorized Frenet projection and occupancy grid against one projection per agent"""
+
+    def setUp(self):
+        self.rng = np.random.default_rng(0)
+
+    def _assert_frenet_equal(self, traj, ref_path):
+        frenet = transform_to_Frenet(traj, ref_path)
+        for agent_traj, agent_frenet in zip(traj, frenet):
+            self.assertTrue(np.array_equal(agent_frenet, loop_transform_to_Frenet(agent_traj, ref_path)))
+
+    def test_transform_to_Frenet(self):
+        ref_path = make_ref_path(60.0)
+        ref_path[:, 1] = np.sin(ref_path[:, 0] / 10)
+        ref_path[:, 2] = np.arctan(np.cos(ref_path[:, 0] / 10) / 10)
+        traj = np.concatenate([self.rng.uniform(-10, 70, (5, 30, 1)), self.rng.uniform(-5, 5, (5, 30, 1)),
+                               self.rng.uniform(-np.pi, np.pi, (5, 30, 1))], axis=-1).astype(np.float32)
+        self._assert_frenet_equal(traj, ref_path)
+        self._assert_frenet_equal(traj[..., :2], ref_path)
+
+    def test_equal_distance(self):
+        """Points at the same distance of several path points project to the first of them"""
+        # padded duplicate tail points, beyond the end of the path and the midpoints between two path points
+        ref_path = make_ref_path(30.0, padded_length=MAX_LEN)
+        midpoints = (np.arange(40) + 0.5) * 0.25
+        traj = np.stack([
+            np.stack([np.linspace(30, 50, 40), np.zeros(40)], axis=-1),
+            np.stack([midpoints, np.full(40, 1.0)], axis=-1),
+            np.stack([np.full(40, 5.05), np.linspace(-2, 2, 40)], axis=-1),
+        ])
+        self._assert_frenet_equal(traj, ref_path)
+
+        # all points of a circle at the same distance of its center
+        angle = np.linspace(0, np.pi, 100)
+        circle = np.stack([np.cos(angle), np.sin(angle), angle + np.pi / 2, np.zeros_like(angle),
+                           np.zeros_like(angle), np.zeros_like(angle)], axis=-1)
+        self._assert_frenet_equal(np.zeros((1, 3, 2)), circle)
+
+    def test_occupancy_adpter(self):
+        num_agents, num_modes, num_steps = 8, 6, T * 10
+        ref_path = make_ref_path(30.0)
+
+        # agents driving along the path, from behind the ego to beyond the end of the path
+        start = self.rng.uniform(-20, 100, (num_agents, num_modes, 1))
+        speed = self.rng.uniform(0, 15, (num_agents, num_modes, 1))
+        x = start + speed * np.arange(1, num_steps + 1) * 0.1
+        y = self.rng.uniform(-3, 3, (num_agents, num_modes, 1)) + np.zeros_like(x)
+        predictions = np.stack([x, y, np.zeros_like(x), np.zeros_like(x)], axis=-1)
+        # first step behind the path start, a long agent clipped at the start and one clipped at MAX_LEN
+        predictions[0, :, :, 0] = np.linspace(-5, 20, num_steps)
+        predictions[1, :, :, :2] = [[0.5, 0.0]]
+        predictions[2, :, :, :2] = [[MAX_LEN - 1.0, 0.0]]
+        scores = self.rng.normal(size=(num_agents, num_modes))
+
+        neighbors = np.zeros((num_agents, 11))
+        neighbors[:, 0] = 1.0
+        neighbors[:, 6] = self.rng.uniform(1, 15, num_agents)
+        neighbors[:, 7] = self.rng.uniform(0.5, 3, num_agents)
+        neighbors[1, 6] = 20.0
+        neighbors[3, 0] = 0  # padded agent
+
+        args = (torch.from_numpy(predictions).float(), torch.from_numpy(scores).float(),
+                torch.from_numpy(neighbors).float())
+        for path in [ref_path, make_ref_path(30.0, padded_length=MAX_LEN), make_ref_path(MAX_LEN)]:
+            occupancy = occupancy_adpter(*args, path)
+            self.assertTrue(np.array_equal(occupancy, loop_occupancy_adpter(*args, path)))
+            self.assertTrue(np.any(occupancy[:, :10] == 1))
+
+
+if __name__ == '__main__':
+    unittest.main()
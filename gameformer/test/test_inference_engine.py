@@ -0,0 +1,120 @@
+import unittest
+from unittest.mock import patch
+
+import torch
+
+from gameformer.inference_engine import (_ENGINES, GameFormerInferenceEngine, _input_signature, compare_outputs,
+                                         get_inference_engine)
+from gameformer.predictor import GameFormer
+
+
+def make_inputs(batch_size=1, seed=0):
+    """Random GameFormer inputs with the shapes of the observation adapter, all agents and polylines valid"""
+    generator = torch.Generator().manual_seed(seed)
+    shapes = {
+        'ego_agent_past': (batch_size, 21, 7),
+        'neighbor_agents_past': (batch_size, 20, 21, 11),
+        'map_lanes': (batch_size, 40, 50, 7),
+        'map_crosswalks': (batch_size, 5, 30, 3),
+        'route_lanes': (batch_size, 10, 50, 3),
+    }
+    return {key: torch.randn(shape, generator=generator) for key, shape in shapes.items()}
+
+
+class TestGameFormerInferenceEngine(unittest.TestCase):
+    """Test the compiled and quantized GameFormer engines against the eager model"""
+
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.model = GameFormer(3, 2, 6, 20).eval()
+        cls.inputs = make_inputs()
+        with torch.inference_mode():
+            cls.reference = cls.model(cls.inputs)
+
+    def _assert_close_to_eager(self, engine, inputs, reference, max_plan_ade):
+        accuracy = compare_outputs(reference, engine(inputs))
+        self.assertLessEqual(accuracy['plan_ade'], max_plan_ade)
+        return accuracy
+
+    def test_torchscript(self):
+        engine = GameFormerInferenceEngine(self.model, 'torchscript', max_plan_ade=0.2)
+        accuracy = self._assert_close_to_eager(engine, self.inputs, self.reference, 1e-4)
+        self.assertLess(accuracy['score_max_abs_diff'], 1e-4)
+        # compiled, not fallen back to the eager encoder
+        modules = engine._compiled[_input_signature(self.inputs)]
+        self.assertIsInstance(modules[0], torch.jit.ScriptModule)
+
+        # a new batch size is compiled separately
+        inputs = make_inputs(batch_size=2, seed=1)
+        with torch.inference_mode():
+            reference = self.model(inputs)
+        self._assert_close_to_eager(engine, inputs, reference, 1e-4)
+        self.assertEqual(len(engine._compiled), 2)
+
+    def test_quantized(self):
+        for backend in ['eager', 'torchscript']:
+            with self.subTest(backend=backend):
+                engine = GameFormerInferenceEngine(self.model, backend, quantize=True, max_plan_ade=0.2)
+                self._assert_close_to_eager(engine, self.inputs, self.reference, engine.max_plan_ade)
+                signature = _input_signature(self.inputs)
+                self.assertLessEqual(engine.accuracy[signature]['plan_ade'], engine.max_plan_ade)
+                # not fallen back to the float model
+                self.assertIsNot(engine._compiled[signature][0], self.model.encoder)
+
+    def test_compile_failure(self):
+        """A signature that fails to compile runs the eager modules"""
+        engine = GameFormerInferenceEngine(self.model, 'torchscript')
+        with patch.object(engine, '_compile', side_effect=RuntimeError('trace failed')):
+            with self.assertLogs(level='ERROR'):
+                outputs = engine(self.inputs)
+        self.assertIs(engine._compiled[_input_signature(self.inputs)][0], self.model.encoder)
+        self.assertEqual(compare_outputs(self.reference, outputs)['plan_ade'], 0)
+
+    def test_accuracy_fallback(self):
+        """A signature whose plan deviates by more than max_plan_ade falls back to the eager float model"""
+        engine = GameFormerInferenceEngine(self.model, 'torchscript', quantize=True, max_plan_ade=-1)
+        with self.assertLogs(level='ERROR'):
+            outputs = engine(self.inputs)
+        signature = _input_signature(self.inputs)
+        self.assertIs(engine._compiled[signature][0], self.model.encoder)
+        self.assertEqual(engine._num_checks_left[signature], 0)
+        self.assertEqual(compare_outputs(self.reference, outputs)['plan_ade'], 0)
+
+    def test_num_accuracy_checks(self):
+        """The first num_accuracy_checks inputs of a signature are checked, the following ones are not"""
+        engine = GameFormerInferenceEngine(self.model, 'torchscript', num_accuracy_checks=2)
+        with patch.object(engine, '_check', wraps=engine._check) as check:
+            for seed in range(4):
+                engine(make_inputs(seed=seed))
+        self.assertEqual(check.call_count, 2)
+        self.assertEqual(engine._num_checks_left[_input_signature(self.inputs)], 0)
+
+        # nothing compiled, nothing to check
+        engine = GameFormerInferenceEngine(self.model, 'eager')
+        with patch.object(engine, '_check') as check:
+            engine(self.inputs)
+        check.assert_not_called()
+
+
+class TestGetInferenceEngine(unittest.TestCase):
+    """Test the per-process engine cache"""
+
+    def setUp(self):
+        self.addCleanup(_ENGINES.clear)
+        torch.manual_seed(0)
+        self.model = GameFormer(3, 2, 6, 20)
+
+    def test_model_id(self):
+        """Engines of one checkpoint are shared per model_id"""
+        def get(model_id):
+            return get_inference_engine('model.pth', 'cpu', 'eager', model_builder=lambda: self.model,
+                                        model_id=model_id)
+
+        engine = get('load_model')
+        self.assertIs(get('load_model'), engine)
+        self.assertIsNot(get('load_random_model'), engine)
+
+
+if __name__ == '__main__':
+    unittest.main()
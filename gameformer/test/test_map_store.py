@@ -0,0 +1,105 @@
+import pickle
+import unittest
+
+import torch
+from nuplan.common.actor_state.state_representation import StateSE2
+from nuplan.common.maps.maps_datatypes import TrafficLightStatusData, TrafficLightStatusType
+from nuplan.common.maps.nuplan_map.nuplan_map import NuPlanMap
+from nuplan.planning.training.preprocessing.utils.agents_preprocessing import (
+    sampled_past_ego_states_to_tensor,
+    sampled_past_timestamps_to_tensor,
+)
+
+from benchmark.replay import PatchMapsDB
+from benchmark.synthetic_replay import (
+    CONNECTOR_ID, LANE_CONNECTOR_ID, LANE_WIDTH, MAP_NAME, ROADBLOCK_ID, ROADBLOCK_LENGTH, build_synthetic_replay,
+    straight_road_layers,
+)
+from gameformer.map_store import LaneStore
+from gameformer.obs_adapter import build_model_inputs, sampled_tracked_objects_to_tensor_list
+
+
+class TestLaneStore(unittest.TestCase):
+    """Test the lane store features against the map api ones"""
+
+    @classmethod
+    def setUpClass(cls):
+        layers, cls.route_roadblock_ids = straight_road_layers(num_roadblocks=4, num_lanes=3)
+        cls.map_api = NuPlanMap(PatchMapsDB(MAP_NAME, layers), MAP_NAME)
+        cls.lane_store = pickle.loads(pickle.dumps(LaneStore(cls.map_api)))
+
+        # agents of the synthetic replay, only the map around the ego matters here
+        history = next(iter(build_synthetic_replay(num_ticks=1).planner_inputs())).history
+        cls.ego_state_buffer = history.ego_state_buffer
+        cls.observation_buffer = history.observation_buffer
+        cls.traffic_light_data = [
+            TrafficLightStatusData(TrafficLightStatusType.GREEN, LANE_CONNECTOR_ID, 0),
+            TrafficLightStatusData(TrafficLightStatusType.RED, LANE_CONNECTOR_ID + 1, 0),
+            TrafficLightStatusData(TrafficLightStatusType.YELLOW, LANE_CONNECTOR_ID + 10, 0),
+        ]
+
+    def _model_inputs(self, x, y, route_roadblock_ids, lane_store):
+        ego_state = self.ego_state_buffer[-1]
+        ego_state = type(ego_state).build_from_rear_axle(
+            StateSE2(x, y, 0.1), ego_state.dynamic_car_state.rear_axle_velocity_2d,
+            ego_state.dynamic_car_state.rear_axle_acceleration_2d, ego_state.tire_steering_angle,
+            ego_state.time_point, ego_state.car_footprint.vehicle_parameters,
+        )
+        past_tracked_objects_tensor_list, past_tracked_objects_types = sampled_tracked_objects_to_tensor_list(
+            self.observation_buffer)
+        time_stamps_past = sampled_past_timestamps_to_tensor([state.time_point for state in self.ego_state_buffer])
+
+        return build_model_inputs(ego_state, sampled_past_ego_states_to_tensor(self.ego_state_buffer),
+                                  past_tracked_objects_tensor_list, past_tracked_objects_types, time_stamps_past,
+                                  self.traffic_light_data, self.map_api, route_roadblock_ids, lane_store=lane_store)
+
+    def _assert_same_inputs(self, x, y, route_roadblock_ids=None):
+        route_roadblock_ids = self.route_roadblock_ids if route_roadblock_ids is None else route_roadblock_ids
+        expected = self._model_inputs(x, y, route_roadblock_ids, None)
+        inputs = self._model_inputs(x, y, route_roadblock_ids, self.lane_store)
+
+        self.assertEqual(inputs.keys(), expected.keys())
+        for key in ['map_lanes', 'route_lanes']:
+            torch.testing.assert_close(inputs[key], expected[key], atol=1e-4, rtol=0, msg=f'{key} at ({x}, {y})')
+        # traffic light channels
+        self.assertTrue(torch.equal(inputs['map_lanes'][..., 3:], expected['map_lanes'][..., 3:]))
+        for key in ['map_crosswalks', 'ego_agent_past', 'neighbor_agents_past']:
+            self.assertTrue(torch.equal(inputs[key], expected[key]))
+
+        return inputs
+
+    def test_lanes(self):
+        inputs = self._assert_same_inputs(20.0, -0.5 * LANE_WIDTH)
+        num_lanes = inputs['map_lanes'][0, :, 0, :2].abs().sum(-1).gt(0).sum().item()
+        self.assertEqual(num_lanes, 3)
+
+        # next to the traffic lights of the first lane connectors
+        inputs = self._assert_same_inputs(ROADBLOCK_LENGTH + 5.0, -1.5 * LANE_WIDTH)
+        self.assertTrue(inputs['map_lanes'][..., 3:].sum() > 0)
+
+    def test_equal_distance(self):
+        """Elements at the same distance of the ego are ordered as the map api orders them"""
+        # on the boundary between two lanes
+        self._assert_same_inputs(20.0, -LANE_WIDTH)
+        # where the lanes end and the lane connectors start, lane and lane connector share their end point
+        self._assert_same_inputs(ROADBLOCK_LENGTH, -0.5 * LANE_WIDTH)
+        self._assert_same_inputs(ROADBLOCK_LENGTH, -LANE_WIDTH)
+        # just before and just after that point
+        self._assert_same_inputs(ROADBLOCK_LENGTH - 1.0, -LANE_WIDTH)
+        self._assert_same_inputs(ROADBLOCK_LENGTH + 1.0, -LANE_WIDTH)
+
+    def test_route_pruning(self):
+        # a route broken by a missing roadblock connector is pruned at the gap
+        route = [str(ROADBLOCK_ID), str(ROADBLOCK_ID + 1), str(CONNECTOR_ID + 1)]
+        inputs = self._assert_same_inputs(ROADBLOCK_LENGTH + 2.0, -0.5 * LANE_WIDTH, route)
+        self.assertTrue(inputs['route_lanes'].abs().sum() > 0)
+        # a route starting beyond the query radius
+        inputs = self._assert_same_inputs(20.0, -0.5 * LANE_WIDTH, self.route_roadblock_ids[2:])
+        self.assertEqual(inputs['route_lanes'].abs().sum().item(), 0)
+        # ids not in the map
+        self._assert_same_inputs(20.0, -0.5 * LANE_WIDTH, ['unknown'] + self.route_roadblock_ids + ['unknown'])
+        self._assert_same_inputs(20.0, -0.5 * LANE_WIDTH, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
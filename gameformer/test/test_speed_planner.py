@@ -0,0 +1,62 @@
+import unittest
+
+import torch
+try:
+    import theseus
+except ImportError:
+    theseus = None
+
+from gameformer.common_utils import DT, MAX_LEN, T
+from gameformer.speed_planner import SpeedPlanner
+
+
+def make_path_inputs(speed, speed_limit, obstacle_s=None):
+    """init_plan, pred_plan, occupancy and ref_path of a constant speed plan along a path"""
+    N = int(T / DT)
+    init_plan = torch.full((1, N), speed)
+    pred_plan = torch.cat([torch.zeros(1, 1), torch.cumsum(init_plan * DT, dim=-1)], dim=-1)
+    occupancy = torch.zeros(1, N, MAX_LEN)
+    if obstacle_s is not None:
+        occupancy[:, :, obstacle_s:obstacle_s + 5] = 1
+    ref_path = torch.zeros(1, MAX_LEN * 10, 6)
+    ref_path[:, :, 4] = speed_limit
+
+    return init_plan, pred_plan, occupancy, ref_path
+
+
+@unittest.skipIf(theseus is None, 'theseus is not installed')
+class TestSpeedPlanner(unittest.TestCase):
+    """Test the batched speed optimization against one optimization per path"""
+
+    @classmethod
+    def setUpClass(cls):
+        torch.manual_seed(0)
+        cls.planner = SpeedPlanner('cpu')
+        # x, y, heading, speed, lateral speed, acceleration, lateral acceleration
+        cls.ego_state = torch.tensor([[0.0, 0.0, 0.0, 8.0, 0.0, 0.5, 0.0]])
+        cls.paths = [
+            make_path_inputs(8.0, 10.0),
+            make_path_inputs(8.0, 4.0),
+            make_path_inputs(12.0, 15.0, obstacle_s=40),
+            make_path_inputs(2.0, 15.0),
+        ]
+
+    def test_plan_batch(self):
+        single_s, single_ds = zip(*[self.planner.plan(self.ego_state, *path) for path in self.paths])
+        batch_s, batch_ds = self.planner.plan_batch(self.ego_state, *[torch.cat(inputs) for inputs in zip(*self.paths)])
+
+        self.assertEqual(batch_s.shape, (len(self.paths), int(T / DT)))
+        torch.testing.assert_close(batch_ds, torch.cat(single_ds), atol=1e-3, rtol=1e-4)
+        torch.testing.assert_close(batch_s, torch.cat(single_s), atol=1e-3, rtol=1e-4)
+        # the paths are solved differently
+        self.assertGreater((batch_s[0] - batch_s[1]).abs().max(), 1.0)
+
+    def test_plan_batch_of_one(self):
+        s, ds = self.planner.plan(self.ego_state, *self.paths[2])
+        batch_s, batch_ds = self.planner.plan_batch(self.ego_state, *self.paths[2])
+        torch.testing.assert_close(batch_ds, ds)
+        torch.testing.assert_close(batch_s, s)
+
+
+if __name__ == '__main__':
+    unittest.main()
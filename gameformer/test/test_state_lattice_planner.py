@@ -0,0 +1,64 @@
+import unittest
+from types import SimpleNamespace
+
+import numpy as np
+from shapely import Polygon
+
+from gameformer.state_lattice_planner import LatticePlanner
+
+
+def make_path(curvature, length, lane_change, path_len):
+    """(polyline, lane change, lane sequence, path length) of generate_paths, an arc from the origin"""
+    s = np.linspace(0, length, int(length * 4))
+    if curvature == 0:
+        polyline = np.stack([s, np.zeros_like(s)], axis=-1)
+    else:
+        polyline = np.stack([np.sin(curvature * s) / curvature, (1 - np.cos(curvature * s)) / curvature], axis=-1)
+    return polyline, lane_change, [], path_len
+
+
+def make_box(x, y, size=1.0):
+    return SimpleNamespace(geometry=Polygon([(x - size, y - size), (x + size, y - size),
+                                             (x + size, y + size), (x - size, y + size)]))
+
+
+class TestLatticePlannerCosts(unittest.TestCase):
+    """Test the batched path costs against the per path costs"""
+
+    def setUp(self):
+        self.planner = LatticePlanner(route_ids=[])
+        self.planner.path_len = 60
+        self.paths = [
+            make_path(0, 40, 0, 60),
+            make_path(0.01, 40, 1, 58),
+            make_path(-0.02, 30, 1, 30),
+            make_path(0.05, 15, 2, 61),
+            make_path(0, 20, 0, 20),
+        ]
+
+    def _assert_costs_match(self, obstacles, vehicles):
+        for just_stay_current in [False, True]:
+            self.planner._just_stay_current = just_stay_current
+            costs = self.planner.calculate_costs(self.paths, obstacles, vehicles)
+            expected = [self.planner.calculate_cost(path, obstacles, vehicles) for path in self.paths]
+            np.testing.assert_allclose(costs, expected)
+
+    def test_no_objects(self):
+        self._assert_costs_match([], [])
+
+    def test_obstacles_and_vehicles(self):
+        """Obstacles on some paths only, vehicles near and far from the paths to the target lane"""
+        obstacles = [make_box(10, 0), make_box(25, -30)]
+        vehicles = [make_box(5, 2), make_box(100, 100)]
+        self._assert_costs_match(obstacles, vehicles)
+
+    def test_far_vehicles(self):
+        self._assert_costs_match([make_box(0, 50)], [make_box(100, 100)])
+
+    def test_no_paths(self):
+        self.planner._just_stay_current = False
+        self.assertEqual(len(self.planner.calculate_costs([], [], [])), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
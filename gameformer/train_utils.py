@@ -7,6 +7,10 @@ from torch.utils.data import Dataset
 from torch.nn import functional as F
 import json
 import os
+try:
+    from sample_store import load_sample
+except:
+    from .sample_store import load_sample
 
 
 def initLogging(log_file: str, level: str = "INFO"):
@@ -40,7 +44,7 @@ class DrivingData(Dataset):
         return len(self.data_list)
 
     def __getitem__(self, idx):
-        data = np.load(self.data_list[idx])
+        data = load_sample(self.data_list[idx])
         ego = data['ego_agent_past']
         neighbors = data['neighbor_agents_past']
         route_lanes = data['route_lanes'] 
@@ -18,7 +18,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 """ PyTorch LLaMA model."""
-import math, os
+import math, os, time
 from collections import OrderedDict
 from typing import Any, List, Optional, Tuple, Union, List
 
@@ -51,6 +51,7 @@ from gameformer.predictor import LLMEnhancedGameFormer
 from gameformer.predictor_adapter import LLMEnhancedGameFormer_Adapter
 from gameformer.predictor_modules import CrossTransformer
 from gameformer.train_utils import *
+from llama2.utils.convert_checkpoint import split_gameformer_encoder_weights
 
 from peft import (  # noqa: E402
     LoraConfig,
@@ -165,6 +166,43 @@ class CausalLMOutputWithPastWithModel(CausalLMOutputWithPast):
     plan: Optional[Tuple[torch.FloatTensor]] = None
     llm_plan: Optional[Tuple[torch.FloatTensor]] = None
 
+INFERENCE_HEADS = ['predictions', 'plan', 'llm_plan', 'logits', 'aux']
+
+@dataclass
+class DrivePlanOutput(ModelOutput):
+    """
+    Lightweight inference output holding only what the planner consumes.
+
+    Args:
+        predictions (`dict`, *optional*): gameformer level-k predictions and scores.
+        plan (`torch.FloatTensor`, *optional*): gameformer ego plan.
+        llm_plan (`torch.FloatTensor` of shape `(batch_size, feature_len, 2)`, *optional*): waypoints from the llm head.
+        llm_feature (`torch.FloatTensor` of shape `(batch_size, 1, 256)`, *optional*): llm feature fed to gameformer.
+        logits (`torch.FloatTensor`, *optional*): lm_head scores, only when requested.
+        ego_v_a, neighbour_lane, acc_classification, lane_change, traffic_light (`torch.FloatTensor`, *optional*):
+            predictions of the auxiliary llm heads, only when 'aux' is requested.
+        stage_runtimes (`dict`, *optional*): seconds spent in 'llm_forward' (map encoder + llm) and 'gameformer_decode'.
+    """
+
+    predictions: Optional[dict] = None
+    plan: Optional[torch.FloatTensor] = None
+    llm_plan: Optional[torch.FloatTensor] = None
+    llm_feature: Optional[torch.FloatTensor] = None
+    logits: Optional[torch.FloatTensor] = None
+    ego_v_a: Optional[torch.FloatTensor] = None
+    neighbour_lane: Optional[torch.FloatTensor] = None
+    acc_classification: Optional[torch.FloatTensor] = None
+    lane_change: Optional[torch.FloatTensor] = None
+    traffic_light: Optional[torch.FloatTensor] = None
+    stage_runtimes: Optional[dict] = None
+
+
+def _sync_perf_counter(device):
+    # cuda kernels run asynchronously, wait for them so that the time is charged to the right stage
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.perf_counter()
+
 # RMSNorm : 与 LayerNorm 相比不减均值，没有偏置，速度更快，大型 transformer 中性能相当
 class LlamaRMSNorm(nn.Module):
     def __init__(self, hidden_size, eps=1e-6):
@@ -681,6 +719,18 @@ LLAMA_INPUTS_DOCSTRING = r"""
     "The bare LLaMA Model outputting raw hidden-states without any specific head on top.",
     LLAMA_START_DOCSTRING,
 )
+def _map_token_destinations(special_toks_loc, seq_len, map_len):
+    """
+    Indices of the original tokens and of the map tokens once map_len map tokens are inserted after <map>.
+    :return: token_dest [bsz, seq_len], map_dest [bsz, map_len]
+    """
+    device = special_toks_loc.device
+    token_idx = torch.arange(seq_len, device=device).unsqueeze(0)
+    token_dest = token_idx + map_len * (token_idx > special_toks_loc.unsqueeze(1)).long()
+    map_dest = special_toks_loc.unsqueeze(1) + 1 + torch.arange(map_len, device=device).unsqueeze(0)
+    return token_dest, map_dest
+
+
 class LlamaModel(LlamaPreTrainedModel):
     """
     Transformer decoder consisting of *config.num_hidden_layers* layers. Each layer is a [`LlamaDecoderLayer`]
@@ -704,9 +754,69 @@ class LlamaModel(LlamaPreTrainedModel):
         self.gradient_checkpointing = False  
         
         self.special_token_id = config.special_token_dict['<map>']
+        # kv cache of the constant prompt prefix before <map>, only used in eval mode and cleared when weights are
+        # loaded, weights changed in place otherwise need prefix_cache.clear()
+        self.use_prefix_cache = getattr(config, 'use_prefix_cache', False)
+        self.prefix_cache = OrderedDict()
+        self.prefix_cache_size = 4
         # Initialize weights and apply final processing
         self.post_init()
 
+    def train(self, mode=True):
+        self.prefix_cache.clear()
+        return super().train(mode)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # called for the loads of a parent module (e.g. the lora weights of the peft model) as well
+        self.prefix_cache.clear()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def _get_prefix_len(self, input_ids, special_toks_loc, attention_mask, position_ids):
+        """
+        Returns the length of the prefix (up to and including <map>) shared by the whole batch, or None.
+        """
+        batch_size = input_ids.shape[0]
+        if special_toks_loc.shape[0] != batch_size or not (special_toks_loc == special_toks_loc[0]).all():
+            return None
+        prefix_len = int(special_toks_loc[0]) + 1
+        if not (input_ids[:, :prefix_len] == input_ids[:1, :prefix_len]).all():
+            return None
+        if attention_mask is not None and not attention_mask[:, :prefix_len].bool().all():
+            return None
+        if position_ids.shape[0] != 1 and not (position_ids[:, :prefix_len] == position_ids[:1, :prefix_len]).all():
+            return None
+        return prefix_len
+
+    def _get_prefix_cache(self, input_ids, inputs_embeds, position_ids, prefix_len):
+        # weights moved or cast by .to() compute a new cache
+        prefix_key = (tuple(input_ids[0, :prefix_len].tolist()), inputs_embeds.dtype, str(inputs_embeds.device))
+        if prefix_key in self.prefix_cache:
+            self.prefix_cache.move_to_end(prefix_key)
+            return self.prefix_cache[prefix_key]
+
+        prefix_embeds = inputs_embeds[:1, :prefix_len]
+        prefix_position_ids = position_ids[:1, :prefix_len]
+        attention_mask = self._prepare_decoder_attention_mask(None, (1, prefix_len), prefix_embeds, 0)
+        hidden_states = prefix_embeds
+        prefix_key_values = ()
+        for decoder_layer in self.layers:
+            layer_outputs = decoder_layer(
+                hidden_states,
+                attention_mask=attention_mask,
+                position_ids=prefix_position_ids,
+                past_key_value=None,
+                output_attentions=False,
+                use_cache=True,
+            )
+            hidden_states = layer_outputs[0]
+            prefix_key_values += (layer_outputs[1],)
+        prefix_hidden_states = self.norm(hidden_states)
+
+        self.prefix_cache[prefix_key] = (prefix_key_values, prefix_hidden_states)
+        if len(self.prefix_cache) > self.prefix_cache_size:
+            self.prefix_cache.popitem(last=False)
+        return prefix_key_values, prefix_hidden_states
+
     # 提供一种标准化的方式来获取模型底层的输入词嵌入层
     def get_input_embeddings(self):
         return self.embed_tokens
@@ -808,43 +918,42 @@ class LlamaModel(LlamaPreTrainedModel):
         
         # 将 map_feats 插入到原始的 inputs_embeds 中的特定位置，并相应地调整 labels、position_ids、attention_mask
         loca = []
+        new_inputs_attention_mask = None
+        return_special_toks_loc = None
         if map_feats is not None and past_key_values is None:
-            new_inputs_embeds = torch.zeros((batch_size, new_tokens_num, inputs_embeds.shape[-1]), device=input_ids.device).to(inputs_embeds.dtype)
-            new_inputs_attention_mask = torch.zeros((batch_size, new_tokens_num), dtype=torch.bool, device=input_ids.device).to(inputs_embeds.dtype)
+            map_len = map_feats.shape[1]
+            return_special_toks_loc = special_toks_loc
+            # destination of every original token and every map token in the spliced sequence
+            token_dest, map_dest = _map_token_destinations(special_toks_loc, input_ids.shape[1], map_len)
+            hidden_dim = inputs_embeds.shape[-1]
+
+            new_inputs_embeds = torch.zeros((batch_size, new_tokens_num, hidden_dim), device=input_ids.device).to(inputs_embeds.dtype)
+            new_inputs_embeds = new_inputs_embeds.scatter(1, token_dest.unsqueeze(-1).expand(-1, -1, hidden_dim), inputs_embeds)
+            new_inputs_embeds = new_inputs_embeds.scatter(1, map_dest.unsqueeze(-1).expand(-1, -1, hidden_dim), map_feats.to(inputs_embeds.dtype))
+
+            # 记录 map_feats 插入的起始索引（包含）和结束索引（不包含）
+            loca = list(zip(map_dest[:, 0], map_dest[:, -1] + 1))
+
             new_labels = torch.zeros((batch_size, new_tokens_num), dtype=torch.long, device=input_ids.device)
-            
-            position_ids_bs = position_ids.shape[0]
+            if labels is not None:
+                new_labels.scatter_(1, token_dest, labels)
+                # 将 map_feats 对应的位置标签设置为 -100
+                new_labels.scatter_(1, map_dest, -100)
+
+            position_ids_bs = min(position_ids.shape[0], batch_size)
+            position_ids = position_ids[:position_ids_bs]
             new_position_ids = torch.zeros((position_ids_bs, new_tokens_num), dtype=torch.long, device=input_ids.device)
+            suffix_shift = (token_dest[:position_ids_bs] - torch.arange(input_ids.shape[1], device=input_ids.device)).long()
+            new_position_ids.scatter_(1, token_dest[:position_ids_bs], position_ids + suffix_shift)
+            map_position_start = position_ids.gather(1, special_toks_loc[:position_ids_bs].unsqueeze(1)) + 1
+            map_position_ids = map_position_start + torch.arange(map_len, device=input_ids.device)
+            new_position_ids.scatter_(1, map_dest[:position_ids_bs], map_position_ids)
 
-            # 逐样本处理，batch_size 表示 inputs 的 batch_size
-            for b in range(batch_size):
-                return_special_toks_loc = special_toks_loc
-                
-                # 将 map_feats 插入到特殊标记后
-                new_inputs_embeds[b, :special_toks_loc[b]+1] = inputs_embeds[b, :special_toks_loc[b]+1]
-                new_inputs_embeds[b, special_toks_loc[b]+1:special_toks_loc[b]+map_feats.shape[1]+1] = map_feats[b]
-                new_inputs_embeds[b, special_toks_loc[b]+map_feats.shape[1]+1:] = inputs_embeds[b, special_toks_loc[b]+1:]
-                
-                # 记录 map_feats 插入的起始索引（包含）和结束索引（不包含）存入 local 列表
-                loca.append((special_toks_loc[b]+1, special_toks_loc[b]+map_feats.shape[1]+1))
-                
-                if labels is not None:
-                    new_labels[b, :special_toks_loc[b]+1] = labels[b, :special_toks_loc[b]+1]
-                    # 将 map_feats 对应的位置标签设置为 -100
-                    new_labels[b, special_toks_loc[b]+1:special_toks_loc[b]+map_feats.shape[1]+1] = -100
-                    new_labels[b, special_toks_loc[b]+map_feats.shape[1]+1:] = labels[b, special_toks_loc[b]+1:]
+            new_inputs_attention_mask = torch.zeros((batch_size, new_tokens_num), dtype=torch.bool, device=input_ids.device).to(inputs_embeds.dtype)
+            if attention_mask is not None:
+                new_inputs_attention_mask.scatter_(1, token_dest, attention_mask.to(inputs_embeds.dtype))
+                new_inputs_attention_mask.scatter_(1, map_dest, (~map_masks).to(inputs_embeds.dtype)) # 逻辑非
 
-                
-                if b < position_ids_bs:
-                    new_position_ids[b, :special_toks_loc[b]+1] = position_ids[b, :special_toks_loc[b]+1]
-                    new_position_ids[b, special_toks_loc[b]+1:special_toks_loc[b]+map_feats.shape[1]+1] = torch.arange(position_ids[b, special_toks_loc[b]]+1, position_ids[b, special_toks_loc[b]]+map_feats.shape[1]+1)
-                    new_position_ids[b, special_toks_loc[b]+map_feats.shape[1]+1:] = position_ids[b, special_toks_loc[b]+1:] + map_feats.shape[1]
-                
-                if attention_mask is not None:
-                    new_inputs_attention_mask[b, :special_toks_loc[b]+1] = attention_mask[b, :special_toks_loc[b]+1]
-                    new_inputs_attention_mask[b, special_toks_loc[b]+1:special_toks_loc[b]+map_feats.shape[1]+1] = ~map_masks[b] # 逻辑非
-                    new_inputs_attention_mask[b, special_toks_loc[b]+map_feats.shape[1]+1:] = attention_mask[b, special_toks_loc[b]+1:]
-            
             inputs_embeds = new_inputs_embeds
             attention_mask = new_inputs_attention_mask
             labels = new_labels
@@ -852,14 +961,29 @@ class LlamaModel(LlamaPreTrainedModel):
 
         if map_feats is not None and past_key_values is not None:
             special_toks_loc = torch.where(input_ids_clone == self.special_token_id)[1]
+            token_dest, map_dest = _map_token_destinations(special_toks_loc, attention_mask.shape[1], map_feats.shape[1])
             new_inputs_attention_mask = torch.zeros((batch_size, seq_length_with_past), dtype=torch.bool, device=input_ids.device).to(inputs_embeds.dtype)
-            for b in range(batch_size):
-                new_inputs_attention_mask[b, :special_toks_loc[b]+1] = attention_mask[b, :special_toks_loc[b]+1]
-                new_inputs_attention_mask[b, special_toks_loc[b]+1:special_toks_loc[b]+map_feats.shape[1]+1] = ~ map_masks[b]
-                new_inputs_attention_mask[b, special_toks_loc[b]+map_feats.shape[1]+1:] = attention_mask[b, special_toks_loc[b]+1:]
+            new_inputs_attention_mask.scatter_(1, token_dest, attention_mask.to(inputs_embeds.dtype))
+            new_inputs_attention_mask.scatter_(1, map_dest, (~map_masks).to(inputs_embeds.dtype))
             attention_mask = new_inputs_attention_mask
             position_ids += map_feats.shape[1]
 
+        # reuse the kv of the constant prompt prefix, only map tokens and the suffix go through the decoder
+        prefix_hidden_states = None
+        if (map_feats is not None and past_key_values is None and self.use_prefix_cache and not self.training
+                and not output_hidden_states and not output_attentions):
+            prefix_len = self._get_prefix_len(input_ids, special_toks_loc, attention_mask, position_ids)
+            if prefix_len is not None and prefix_len < seq_length:
+                prefix_key_values, prefix_hidden_states = self._get_prefix_cache(input_ids, inputs_embeds, position_ids, prefix_len)
+                past_key_values = tuple(
+                    (k.expand(batch_size, -1, -1, -1), v.expand(batch_size, -1, -1, -1)) for k, v in prefix_key_values
+                )
+                past_key_values_length = prefix_len
+                inputs_embeds = inputs_embeds[:, prefix_len:]
+                position_ids = position_ids[:, prefix_len:]
+                seq_length = seq_length - prefix_len
+                prefix_hidden_states = prefix_hidden_states.expand(batch_size, -1, -1)
+
         # embed positions
         if attention_mask is None:
             attention_mask = torch.ones(
@@ -928,6 +1052,8 @@ class LlamaModel(LlamaPreTrainedModel):
                 all_self_attns += (layer_outputs[1],)
 
         hidden_states = self.norm(hidden_states)
+        if prefix_hidden_states is not None:
+            hidden_states = torch.cat([prefix_hidden_states, hidden_states], dim=1)
 
         # add hidden states from the last decoder layer
         if output_hidden_states:
@@ -1019,11 +1145,13 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         self.use_all_tokens = config.use_all_tokens
         self.adapter_fusion = config.adapter_fusion
         self.llm_inf_step = config.llm_inf_step
+        # map_encoder also serves as the gameformer encoder
+        self.share_encoder = getattr(config, 'share_encoder', False)
 
         if self.adapter_fusion:
-            self.gameformer =  LLMEnhancedGameFormer_Adapter(encoder_layers=3, decoder_levels=2, modalities=6, neighbors=10) # this
+            self.gameformer =  LLMEnhancedGameFormer_Adapter(encoder_layers=3, decoder_levels=2, modalities=6, neighbors=10, share_encoder=self.share_encoder) # this
         else:
-            self.gameformer =  LLMEnhancedGameFormer(encoder_layers=3, decoder_levels=2, modalities=6, neighbors=10)
+            self.gameformer =  LLMEnhancedGameFormer(encoder_layers=3, decoder_levels=2, modalities=6, neighbors=10, share_encoder=self.share_encoder)
         self.map_encoder = GameformerEncoder(layers=3)
         self.feature_adpter = nn.Linear(self.model.config.hidden_size, 256)
             
@@ -1119,6 +1247,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
                         elif module is None:
                             print("%s could not be loaded successfully"%str(ckpt))
                         else:
+                            if ckpt == 'gameformer.bin':
+                                weights = self._convert_gameformer_weights(weights)
                             try:
                                 module.load_state_dict(weights, strict=True)
                                 module.to(self.model.device)
@@ -1126,11 +1256,18 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
                                 print("%s could not be loaded successfully"%str(ckpt))
             else:
                 weights = torch.load(ckpt_dir)
-                self.gameformer.load_state_dict(weights, strict=True)
+                self.gameformer.load_state_dict(self._convert_gameformer_weights(weights), strict=True)
         self.map_encoder.to(self.model.device)
         self.to(self.model.device)
 
     
+    def _convert_gameformer_weights(self, weights):
+        # checkpoints saved without a shared encoder still carry gameformer.encoder
+        if not self.share_encoder:
+            return weights
+        _, decoder_weights = split_gameformer_encoder_weights(weights)
+        return decoder_weights
+
     def reload_mapencoder_weights(self):
         self.reinit_weights()
         if self.config.mapEncoder_pretrain_weight is None:
@@ -1150,6 +1287,31 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         self.map_encoder.load_state_dict(processed_weights, strict=False)
         self.map_encoder.to(self.model.device)
 
+    def _compute_logits(self, hidden_states):
+        if self.config.pretraining_tp > 1:
+            lm_head_slices = self.lm_head.weight.split(self.vocab_size // self.config.pretraining_tp, dim=0)
+            logits = [F.linear(hidden_states, lm_head_slices[i]) for i in range(self.config.pretraining_tp)]
+            logits = torch.cat(logits, dim=-1)
+        else:
+            logits = self.lm_head(hidden_states)
+        return logits.float()
+
+    def _forward_with_llm_feature(self, raw_map_vector, llm_feature, llm_plan=None):
+        # the llm decoder, map token splicing, lm_head and the llm heads are all skipped here
+        llm_feature = llm_feature.to(self.feature_adpter.weight.device)
+        start_time = _sync_perf_counter(llm_feature.device)
+        if self.share_encoder:
+            level_k_outputs, ego_plan = self.gameformer((self.map_encoder(raw_map_vector), llm_feature))
+        else:
+            level_k_outputs, ego_plan = self.gameformer((raw_map_vector, llm_feature))
+        return DrivePlanOutput(
+            predictions = level_k_outputs,
+            plan = ego_plan,
+            llm_plan = llm_plan,
+            llm_feature = llm_feature,
+            stage_runtimes = {'gameformer_decode': _sync_perf_counter(llm_feature.device) - start_time},
+        )
+
     def cuda(self, *args, **kwargs):
         return nn.Module.cuda(self, *args, **kwargs)
 
@@ -1213,7 +1375,11 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         output_hidden_states: Optional[bool] = None,
         return_dict: Optional[bool] = None,
         inference = False,
-    ) -> Union[Tuple, CausalLMOutputWithPastWithModel]:
+        llm_feature: Optional[torch.FloatTensor] = None,
+        llm_plan: Optional[torch.FloatTensor] = None,
+        llm_only = False,
+        inference_heads: Optional[List[str]] = None,
+    ) -> Union[Tuple, CausalLMOutputWithPastWithModel, DrivePlanOutput]:
         r"""
         Args:
             labels (`torch.LongTensor` of shape `(batch_size, sequence_length)`, *optional*):
@@ -1253,6 +1419,16 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         )
         return_dict = return_dict if return_dict is not None else self.config.use_return_dict
 
+        # only evaluate the heads in inference_heads and return a DrivePlanOutput
+        lightweight = inference and inference_heads is not None
+        if lightweight:
+            assert set(inference_heads) <= set(INFERENCE_HEADS), f'inference_heads should be in {INFERENCE_HEADS}'
+            use_cache = False
+        need_aux_heads = not lightweight or 'aux' in inference_heads
+        need_llm_plan = not lightweight or 'llm_plan' in inference_heads or self.llm_inf_step > 1
+        device = self.feature_adpter.weight.device
+        start_time = _sync_perf_counter(device) if inference else None
+
         if map_feats is not None:
             map_feats = map_feats.to(self.map_adapter.weight.dtype)
             map_feats = self.map_adapter(map_feats)
@@ -1266,6 +1442,9 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
                 'map_crosswalks': map_crosswalks.to(self.map_adapter.weight.dtype),
                 'route_lanes': route_lanes.to(self.map_adapter.weight.dtype), # [16, 10, 50, 3]
             }
+            # between two llm steps only gameformer runs, on the llm feature the caller kept from the last llm step
+            if inference and llm_feature is not None:
+                return self._forward_with_llm_feature(raw_map_vector, llm_feature, llm_plan)
             encoder_outputs = self.map_encoder(raw_map_vector)
             map_feats, map_masks = encoder_outputs['encoding'], encoder_outputs['mask']
             if torch.isnan(map_feats).any():
@@ -1293,11 +1472,6 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
         ego_plan = None
         level_k_outputs = None
         hidden_states = outputs[0]
-
-        if cur_iter.index % self.llm_inf_step != 0:
-            hidden_states = self.prev_hidden_states
-        else:
-            self.prev_hidden_states = hidden_states
         
         # use query feature instead of direct hidden_states
         ########
@@ -1310,36 +1484,48 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             predicted_feature = self.feature_adpter(hidden_states)
             
         # loss for llm hidden feature
-        predicted_waypoints = self.waypoints_predictor(hidden_states)
-        predicted_waypoints = predicted_waypoints.reshape(predicted_waypoints.shape[0], self.feature_len, 2)
+        predicted_waypoints = None
+        if need_llm_plan:
+            predicted_waypoints = self.waypoints_predictor(hidden_states)
+            predicted_waypoints = predicted_waypoints.reshape(predicted_waypoints.shape[0], self.feature_len, 2)
         if not inference:
             waypoints_loss = F.smooth_l1_loss(predicted_waypoints, ego_future[..., :2])
             waypoints_loss += F.smooth_l1_loss(predicted_waypoints[:, -1], ego_future[:, -1, :2])
 
-        predicted_ego_v_a = self.ego_v_a_predictor(hidden_states)
-        predicted_ego_v_a = predicted_ego_v_a.reshape(predicted_ego_v_a.shape[0], 4)
-        if not inference:
-            v_a_loss = F.smooth_l1_loss(predicted_ego_v_a, ego_v_a)
-        
-        predicted_neighbour_lane = self.neighbour_lane(hidden_states)
-        predicted_neighbour_lane = predicted_neighbour_lane.reshape(predicted_neighbour_lane.shape[0], 2)
-        if not inference:
-            neighbour_lane_loss = F.binary_cross_entropy(predicted_neighbour_lane, torch.tensor(neighbour_lane.squeeze(-1), dtype=torch.float32))
-        
-        pred_acc_classification = self.acc_classification(hidden_states)
-        pred_acc_classification = pred_acc_classification.reshape(pred_acc_classification.shape[0], 3)
-        if not inference:
-            acc_class_loss = F.cross_entropy(pred_acc_classification, torch.tensor(acc_classification, dtype=torch.float32))
-        
-        pred_lane_change = self.lane_change(hidden_states)
-        pred_lane_change = pred_lane_change.reshape(pred_lane_change.shape[0], 1)
-        if not inference:
-            lane_change_loss = F.binary_cross_entropy(pred_lane_change, torch.tensor(lane_change, dtype=torch.float32))
-        
-        pred_traffic_light = self.traffic_light(hidden_states)
-        pred_traffic_light = pred_traffic_light.reshape(pred_traffic_light.shape[0], 4)
-        if not inference:
-            traffic_light_loss = F.cross_entropy(pred_traffic_light, torch.tensor(traffic_light, dtype=torch.float32))
+        # the auxiliary heads only provide training signal, the planner does not use them
+        aux_outputs = {}
+        if need_aux_heads:
+            predicted_ego_v_a = self.ego_v_a_predictor(hidden_states)
+            predicted_ego_v_a = predicted_ego_v_a.reshape(predicted_ego_v_a.shape[0], 4)
+            if not inference:
+                v_a_loss = F.smooth_l1_loss(predicted_ego_v_a, ego_v_a)
+            
+            predicted_neighbour_lane = self.neighbour_lane(hidden_states)
+            predicted_neighbour_lane = predicted_neighbour_lane.reshape(predicted_neighbour_lane.shape[0], 2)
+            if not inference:
+                neighbour_lane_loss = F.binary_cross_entropy(predicted_neighbour_lane, torch.tensor(neighbour_lane.squeeze(-1), dtype=torch.float32))
+            
+            pred_acc_classification = self.acc_classification(hidden_states)
+            pred_acc_classification = pred_acc_classification.reshape(pred_acc_classification.shape[0], 3)
+            if not inference:
+                acc_class_loss = F.cross_entropy(pred_acc_classification, torch.tensor(acc_classification, dtype=torch.float32))
+            
+            pred_lane_change = self.lane_change(hidden_states)
+            pred_lane_change = pred_lane_change.reshape(pred_lane_change.shape[0], 1)
+            if not inference:
+                lane_change_loss = F.binary_cross_entropy(pred_lane_change, torch.tensor(lane_change, dtype=torch.float32))
+            
+            pred_traffic_light = self.traffic_light(hidden_states)
+            pred_traffic_light = pred_traffic_light.reshape(pred_traffic_light.shape[0], 4)
+            if not inference:
+                traffic_light_loss = F.cross_entropy(pred_traffic_light, torch.tensor(traffic_light, dtype=torch.float32))
+            aux_outputs = {
+                'ego_v_a': predicted_ego_v_a,
+                'neighbour_lane': predicted_neighbour_lane,
+                'acc_classification': pred_acc_classification,
+                'lane_change': pred_lane_change,
+                'traffic_light': pred_traffic_light,
+            }
         
         if not inference:
             llm_multi_head_loss = v_a_loss + neighbour_lane_loss + acc_class_loss + lane_change_loss + traffic_light_loss
@@ -1361,9 +1547,28 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             llm_feature = predicted_feature.unsqueeze(1)
         else:
             llm_feature = predicted_feature
-
-        input_t = (raw_map_vector, llm_feature)
+        if inference:
+            llm_time = _sync_perf_counter(device)
+            stage_runtimes = {'llm_forward': llm_time - start_time}
+            if llm_only:
+                return DrivePlanOutput(llm_plan=predicted_waypoints, llm_feature=llm_feature,
+                                       stage_runtimes=stage_runtimes)
+
+        input_t = (encoder_outputs if self.share_encoder else raw_map_vector, llm_feature)
         level_k_outputs, ego_plan = self.gameformer(input_t)
+
+        if lightweight:
+            stage_runtimes['gameformer_decode'] = _sync_perf_counter(device) - llm_time
+            logits = self._compute_logits(hidden_states) if 'logits' in inference_heads else None
+            return DrivePlanOutput(
+                predictions = level_k_outputs if 'predictions' in inference_heads else None,
+                plan = ego_plan if 'plan' in inference_heads else None,
+                llm_plan = predicted_waypoints if 'llm_plan' in inference_heads else None,
+                llm_feature = llm_feature,
+                logits = logits,
+                stage_runtimes = stage_runtimes,
+                **aux_outputs,
+            )
         
         if not inference:
             gmm_loss, results = level_k_loss(level_k_outputs, ego_future_gt[..., :2], neighbors_future_gt[:,:self.gameformer.neighbors,:,:2], neighbors_future_valid_gt[:,:self.gameformer.neighbors,...])
@@ -1372,13 +1577,7 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             gameformer_loss = gmm_loss + plan_loss
             loss = gameformer_loss + llm_loss
         
-        if self.config.pretraining_tp > 1:
-            lm_head_slices = self.lm_head.weight.split(self.vocab_size // self.config.pretraining_tp, dim=0)
-            logits = [F.linear(hidden_states, lm_head_slices[i]) for i in range(self.config.pretraining_tp)]
-            logits = torch.cat(logits, dim=-1)
-        else:
-            logits = self.lm_head(hidden_states)
-        logits = logits.float()
+        logits = self._compute_logits(hidden_states)
             
         if not return_dict:
             output = (logits,) + outputs[1:]
@@ -1480,6 +1679,8 @@ class LlamaForCausalLM(LlamaPreTrainedModel):
             #     import pdb; pdb.set_trace()
             try:
                 loaded_weight = torch.load(os.path.join(model_id, f'{map_encoder_name}.bin'))
+                if map_encoder_name == 'gameformer':
+                    loaded_weight = self._convert_gameformer_weights(loaded_weight)
                 new_weight = OrderedDict()
                 for k in loaded_weight:
                     new_weight[f'{map_encoder_name}.{k}'] = loaded_weight[k]
@@ -24,7 +24,10 @@ from peft import (  # noqa: E402
     set_peft_model_state_dict,
 )
 from llama2.model_llama4drive import LlamaForCausalLM
-from llama2.model_llama4drive import LlamaForCausalLM, ModelWithLoRA
+from llama2.model_llama4drive import LlamaForCausalLM, ModelWithLoRA, DrivePlanOutput
+from transformers.models.llama.configuration_llama import LlamaConfig
+from llama2.planner.llm_server import BatchedInferenceServer
+from llama2.utils.prompt_tokenizer import PromptTokenizer
 import torch
 import numpy as np
 
@@ -41,7 +44,12 @@ def get_model(model_name_or_path=None,
               add_special_tokens='<map>,</map>',
               resize_token_embeddings=True,
               devices=None,
+              random_init_config=None,
               **kwargs):
+    """
+    :param random_init_config: LlamaConfig kwargs of a small randomly initialised model built on cpu instead of
+        loading model_name_or_path, e.g. for benchmarks. Only the tokenizer is read from finetune_model_path.
+    """
     if len(os.listdir(finetune_model_path))==1:
             finetune_model_path = os.path.join(finetune_model_path, os.listdir(finetune_model_path)[0])
     tokenizer = AutoTokenizer.from_pretrained(finetune_model_path, use_fast=False)
@@ -55,7 +63,11 @@ def get_model(model_name_or_path=None,
         "revision": 'main',
         "use_auth_token": None,
     }
-    config = AutoConfig.from_pretrained(model_name_or_path, **config_kwargs)
+    if random_init_config is not None:
+        config = LlamaConfig(**random_init_config)
+        config.vocab_size = len(tokenizer)
+    else:
+        config = AutoConfig.from_pretrained(model_name_or_path, **config_kwargs)
     config.feature_len = kwargs.get('feature_len', 80)
     config.map_former = kwargs.get('map_former', False)
     config.mapEncoder_pretrain_weight = kwargs.get('mapEncoder_pretrain_weight', None)
@@ -66,8 +78,10 @@ def get_model(model_name_or_path=None,
 
     config.use_all_tokens = kwargs.get('use_all_tokens', False)
     config.adapter_fusion = kwargs.get('adapter_fusion', False)
+    config.share_encoder = kwargs.get('share_encoder', False)
 
     config.llm_inf_step = kwargs.get('llm_inf_step', 1)
+    config.use_prefix_cache = kwargs.get('use_prefix_cache', True)
     config.lora_r = kwargs.get('lora_r', 16)
 
     if add_special_tokens is not None:
@@ -76,19 +90,22 @@ def get_model(model_name_or_path=None,
         special_token_dict = dict(zip(additional_special_tokens, special_token_ids))
         config.special_token_dict = special_token_dict
 
-    bnb_config = BitsAndBytesConfig(
-        load_in_4bit=True,
-        bnb_4bit_use_double_quant=True,
-        bnb_4bit_quant_type="nf4",
-        bnb_4bit_compute_dtype=torch.bfloat16
-    )
-    model = LlamaForCausalLM.from_pretrained(
-        model_name_or_path,
-        config=config,
-        torch_dtype=torch.float16,
-        device_map=devices if devices else 'auto',
-        quantization_config=bnb_config
-    )
+    if random_init_config is not None:
+        model = LlamaForCausalLM(config)
+    else:
+        bnb_config = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_use_double_quant=True,
+            bnb_4bit_quant_type="nf4",
+            bnb_4bit_compute_dtype=torch.bfloat16
+        )
+        model = LlamaForCausalLM.from_pretrained(
+            model_name_or_path,
+            config=config,
+            torch_dtype=torch.float16,
+            device_map=devices if devices else 'auto',
+            quantization_config=bnb_config
+        )
 
     if config.enable_lora:
         # if model_args.layers_to_transform is not None:
@@ -111,6 +128,9 @@ def get_model(model_name_or_path=None,
     else:
         lora_config = None
 
+    if random_init_config is not None:
+        return model.eval(), tokenizer
+
     embedding_size = model.get_input_embeddings().weight.shape[0]
 
     try:
@@ -154,10 +174,16 @@ class LLAMA2DriveModel:
             if cls._instance is None:
                 cls._instance = super(LLAMA2DriveModel, cls).__new__(cls)
                 cls._initialize_model(model_config)
+                # infer_locker serializes the forwards running the llm, they update its prefix kv cache.
+                # gameformer_locker serializes the gameformer-only forwards, which keep no state on the model (the
+                # llm feature is passed in by the caller), so they may run during an llm forward of the async worker
                 cls._instance.infer_locker = threading.Lock()
+                cls._instance.gameformer_locker = threading.Lock()
                 cls.ins_mode = model_config['ins_mode']
                 cls.ins_wo_stop = model_config['ins_wo_stop']
                 cls.lora_r = model_config['lora_r']
+                # heads evaluated at planning time, None returns the full training output
+                cls.inference_heads = model_config.get('inference_heads', ['predictions', 'plan', 'llm_plan'])
             instance = cls._instance
         return instance
 
@@ -169,7 +195,11 @@ class LLAMA2DriveModel:
         cls.model, cls.tokenizer = get_model(
             **config
         )
+        # the prompt template is tokenized once, only the instruction every tick
+        cls.prompt_tokenizer = PromptTokenizer(cls.tokenizer)
         cls.model_loaded = True
+        # the token ids go to the device of the embedding layer
+        cls.device = next(cls.model.parameters()).device
         cls.diversity = config.get('diversity_ins', False)
 
     def generate_prompt(self, lane, return_navi=False):
@@ -285,9 +315,7 @@ class LLAMA2DriveModel:
         # print('whole route is %s meters.'%str(dis_cum[-1]))
         return [cmd_ls, dis_ls], instruction
 
-    def inference(self, data, ref_path, cur_iter):
-        if not hasattr(self, 'model_loaded') or not self.model_loaded:
-            raise RuntimeError("Model not loaded properly.")
+    def _prepare_inputs(self, data, ref_path, cur_iter):
         tokenizer = self.tokenizer
         messages = self.generate_prompt(ref_path)
         messages = messages.replace('<map>', '<map></map>')
@@ -302,22 +330,105 @@ class LLAMA2DriveModel:
             'neighbors_future': map_info.get('neighbor_agents_future', None),
             'cur_iter': cur_iter,
         }
-        input_ids = tokenizer([messages], return_tensors="pt", add_special_tokens=False).input_ids[0]
-        input_ids = padding_token([input_ids], tokenizer.pad_token_id, padding_side='left').cuda()
-        input_ids = torch.cat([torch.zeros((input_ids.shape[0], 1), dtype=torch.int64)+1, input_ids.cpu(), torch.ones((input_ids.shape[0], 1),  dtype=torch.int64)+1], dim=1).cuda()
+        input_ids = torch.tensor(self.prompt_tokenizer.encode(messages), dtype=torch.int64)
+        input_ids = padding_token([input_ids], tokenizer.pad_token_id, padding_side='left').to(self.device)
+        input_ids = torch.cat([torch.zeros((input_ids.shape[0], 1), dtype=torch.int64)+1, input_ids.cpu(), torch.ones((input_ids.shape[0], 1),  dtype=torch.int64)+1], dim=1).to(self.device)
         attention_mask = input_ids.ne(tokenizer.pad_token_id)
+        return input_ids, attention_mask, input_dict
+
+    def inference(self, data, ref_path, cur_iter):
+        if not hasattr(self, 'model_loaded') or not self.model_loaded:
+            raise RuntimeError("Model not loaded properly.")
+        input_ids, attention_mask, input_dict = self._prepare_inputs(data, ref_path, cur_iter)
         with torch.no_grad():
             with self.infer_locker:
-                output = self.model(input_ids=input_ids, attention_mask=attention_mask, inference=True, **input_dict)
+                output = self.model(input_ids=input_ids, attention_mask=attention_mask, inference=True,
+                                    inference_heads=self.inference_heads, **input_dict)
                 # logging.error(f'{torch.cuda.memory_allocated() / 1024 / 1024}')
                 # torch.cuda.empty_cache()
         return output
 
+    def inference_llm(self, data, ref_path, cur_iter):
+        # llm part only, returns llm_feature / llm_plan for the gameformer path
+        if not hasattr(self, 'model_loaded') or not self.model_loaded:
+            raise RuntimeError("Model not loaded properly.")
+        input_ids, attention_mask, input_dict = self._prepare_inputs(data, ref_path, cur_iter)
+        with torch.no_grad():
+            with self.infer_locker:
+                output = self.model(input_ids=input_ids, attention_mask=attention_mask, inference=True, llm_only=True,
+                                    inference_heads=self.inference_heads, **input_dict)
+        return output
+
+    def inference_with_llm_feature(self, data, cur_iter, llm_feature, llm_plan=None):
+        # gameformer part only, does not wait for a running llm forward
+        if not hasattr(self, 'model_loaded') or not self.model_loaded:
+            raise RuntimeError("Model not loaded properly.")
+        input_dict = {
+            'ego_agent_past': data.get('ego_agent_past', None),
+            'neighbor_agents_past': data.get('neighbor_agents_past', None),
+            'route_lanes': data.get('route_lanes', None),
+            'map_lanes': data.get('map_lanes', None),
+            'map_crosswalks': data.get('map_crosswalks', None),
+            'cur_iter': cur_iter,
+        }
+        with torch.no_grad():
+            with self.gameformer_locker:
+                output = self.model(inference=True, llm_feature=llm_feature, llm_plan=llm_plan, **input_dict)
+        return output
+
+    def batch_inference(self, requests):
+        """
+        Full llm + gameformer inference for requests [(data, ref_path), ...] from different scenarios in one batch.
+        :return: one output per request
+        """
+        if not hasattr(self, 'model_loaded') or not self.model_loaded:
+            raise RuntimeError("Model not loaded properly.")
+        tokenizer = self.tokenizer
+        input_ids_list = []
+        for _, ref_path in requests:
+            messages = self.generate_prompt(ref_path)
+            messages = messages.replace('<map>', '<map></map>')
+            input_ids = torch.tensor(self.prompt_tokenizer.encode(messages), dtype=torch.int64)
+            # left padding puts the pad tokens before bos, each row ends as the single request does
+            input_ids_list.append(torch.cat([torch.tensor([tokenizer.bos_token_id]), input_ids, torch.tensor([tokenizer.eos_token_id])]))
+        input_ids = padding_token(input_ids_list, tokenizer.pad_token_id, padding_side='left').to(self.device)
+        attention_mask = input_ids.ne(tokenizer.pad_token_id)
+        position_ids = attention_mask.long().cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask == 0, 1)
+
+        keys = ['ego_agent_past', 'neighbor_agents_past', 'route_lanes', 'map_lanes', 'map_crosswalks']
+        input_dict = {k: torch.cat([data[k] for data, _ in requests], dim=0) for k in keys}
+        with torch.no_grad():
+            with self.infer_locker:
+                output = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                                    inference=True, inference_heads=self.inference_heads, **input_dict)
+
+        results = []
+        for b in range(len(requests)):
+            predictions = None
+            if output.predictions is not None:
+                predictions = {k: v[b:b+1] for k, v in output.predictions.items()}
+            results.append(DrivePlanOutput(
+                predictions=predictions,
+                plan=output.plan[b:b+1] if output.plan is not None else None,
+                llm_plan=output.llm_plan[b:b+1] if output.llm_plan is not None else None,
+                llm_feature=output.llm_feature[b:b+1] if output.llm_feature is not None else None,
+                # every request waited for the whole batch
+                stage_runtimes=output.stage_runtimes,
+            ))
+        return results
+
+    def get_inference_server(self, max_batch_size=8, max_wait_ms=5.0):
+        with self._lock:
+            if getattr(self, 'inference_server', None) is None:
+                self.inference_server = BatchedInferenceServer(self.batch_inference, max_batch_size, max_wait_ms)
+        return self.inference_server
+
     def debug_inference(self, input_dict):
         tokenizer = self.tokenizer
         messages = input_dict.pop('messages')
         input_ids = tokenizer([messages], return_tensors="pt", add_special_tokens=False).input_ids[0]
-        input_ids = padding_token([input_ids], tokenizer.pad_token_id, padding_side='left').cuda()
-        input_ids = torch.cat([torch.zeros((input_ids.shape[0], 1), dtype=torch.int64)+1, input_ids.cpu(), torch.ones((input_ids.shape[0], 1),  dtype=torch.int64)+1], dim=1).cuda()
+        input_ids = padding_token([input_ids], tokenizer.pad_token_id, padding_side='left').to(self.device)
+        input_ids = torch.cat([torch.zeros((input_ids.shape[0], 1), dtype=torch.int64)+1, input_ids.cpu(), torch.ones((input_ids.shape[0], 1),  dtype=torch.int64)+1], dim=1).to(self.device)
         attention_mask = input_ids.ne(tokenizer.pad_token_id)
         return self.model(input_ids=input_ids, attention_mask=attention_mask, **input_dict)
\ No newline at end of file
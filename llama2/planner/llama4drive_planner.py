@@ -18,6 +18,7 @@ from gameformer.obs_adapter import *
 from gameformer.state_lattice_planner import LatticePlanner
 
 from llama2.planner.llama4drive import LLAMA2DriveModel
+from llama2.planner.llm_worker import AsyncLLMWorker
 from nuplan.common.actor_state.ego_state import EgoState
 from nuplan.common.actor_state.state_representation import StateSE2
 from nuplan.common.maps.abstract_map import AbstractMap
@@ -193,9 +194,16 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
                  near_multiple_vehicles=False,
                  short_ins=-1,
                  llm_inf_step=1,
+                 async_llm=False,
+                 llm_max_staleness=1.0,
+                 llm_server=False,
+                 llm_server_batch_size=8,
+                 llm_server_wait_ms=5.0,
+                 use_lane_store=False,
+                 lane_store_dir=None,
                  model_cfg=None,
                  model_urban: TorchModuleWrapper = None):
-        super().__init__(disable_refpath=disable_refpath)
+        super().__init__(disable_refpath=disable_refpath, use_lane_store=use_lane_store, lane_store_dir=lane_store_dir)
         if isinstance(model_cfg, list):
             model_cfg = {k:v for d in model_cfg for k,v in d.items()}
         self.ins_mode = ins_mode
@@ -206,6 +214,20 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
         self.model_name_or_path = model_name_or_path
         self.near_multiple_vehicles = near_multiple_vehicles
         self.short_ins = short_ins
+        self.llm_inf_step = llm_inf_step
+        # llm feature / plan of the last llm step of this planner, reused until the next one
+        self._llm_feature = None
+        self._llm_plan = None
+        self.async_llm = async_llm
+        self.llm_max_staleness = llm_max_staleness
+        self._llm_worker = None
+        self.llm_server = llm_server
+        self.llm_server_batch_size = llm_server_batch_size
+        self.llm_server_wait_ms = llm_server_wait_ms
+        self._llm_server = None
+        if async_llm and llm_server:
+            raise ValueError('async_llm and llm_server are exclusive, the llm runs either in a background worker '
+                             'or in the batched inference server')
         logging.error(f'Ins mode: {ins_mode}')
         if ins_mode in ['gt', 'plain_ref']:
             ins_mode = None
@@ -238,10 +260,20 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
         state.pop('sub_planner', None)
         state.pop('model_urban', None)
         state.pop('_model_loader', None)
+        state.pop('_llm_worker', None)
+        state.pop('_llm_server', None)
+        state['_llm_feature'] = None
+        state['_llm_plan'] = None
         return state
 
+    def __del__(self):
+        if getattr(self, '_llm_worker', None) is not None:
+            self._llm_worker.close()
+
     def initialize(self, initialization: PlannerInitialization):
         super().initialize(initialization)
+        self._llm_feature = None
+        self._llm_plan = None
         if self.sub_planner:
             self.sub_planner.initialize(initialization)
         if self.enable_pdm_scorer_in_multirefpath:
@@ -249,10 +281,37 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
 
     def _initialize_model(self):
         self._model = LLAMA2DriveModel(self._model_cfg)
+        if self.async_llm:
+            self._llm_worker = AsyncLLMWorker(self._model, max_staleness=self.llm_max_staleness)
+        elif self.llm_server:
+            self._llm_server = self._model.get_inference_server(self.llm_server_batch_size, self.llm_server_wait_ms)
+
+    def _is_llm_step(self, cur_iter):
+        index = getattr(cur_iter, 'index', cur_iter)
+        return self.llm_inf_step <= 1 or index % self.llm_inf_step == 0
 
     def _get_prediction(self, features, ref_path, cur_iter):
         # predictions, plan = self._model(features)
-        output = self._model.inference(features, ref_path, cur_iter)
+        if self._llm_worker is not None:
+            # plan with the newest finished llm feature, the llm catches up in the background
+            self._llm_worker.submit(features, ref_path, cur_iter)
+            # the llm forward itself runs in the background, only the time blocked on it is on the tick
+            with self._stage_timer.measure('llm_wait'):
+                llm_feature, llm_plan, _ = self._llm_worker.latest(cur_iter)
+            output = self._model.inference_with_llm_feature(features, cur_iter, llm_feature, llm_plan)
+        elif self._llm_feature is not None and not self._is_llm_step(cur_iter):
+            # the model is shared by the planners of the process, the feature of this planner is passed in
+            output = self._model.inference_with_llm_feature(features, cur_iter, self._llm_feature, self._llm_plan)
+        else:
+            if self._llm_server is not None:
+                # batched together with the other scenarios running in this process
+                output = self._llm_server.infer(features, ref_path)
+            else:
+                output = self._model.inference(features, ref_path, cur_iter)
+            self._llm_feature = getattr(output, 'llm_feature', None)
+            self._llm_plan = getattr(output, 'llm_plan', None)
+        for stage, runtime in (getattr(output, 'stage_runtimes', None) or {}).items():
+            self._stage_timer.add(stage, runtime)
         predictions = output.predictions
         if self.llm_plan:
             plan = output.llm_plan
@@ -292,22 +351,10 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
         return trajectory_relative_poses
 
     def _get_multi_refpath(self, ego_state, traffic_light_data, observation):
-        starting_block = None
         min_target_speed = 3
         max_target_speed = 15
-        cur_point = (ego_state.rear_axle.x, ego_state.rear_axle.y)
-        closest_distance = math.inf
-
-        for block in self._route_roadblocks:
-            for edge in block.interior_edges:
-                distance = edge.polygon.distance(Point(cur_point))
-                if distance < closest_distance:
-                    starting_block = block
-                    closest_distance = distance
-
-            if np.isclose(closest_distance, 0):
-                break
-            
+        starting_block, closest_distance = self._get_starting_block(ego_state)
+
         # In case the ego vehicle is not on the route, return None
         if closest_distance > 7:
             return None
@@ -343,26 +390,23 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
 
 
     def _plan(self, ego_state, history, traffic_light_data, observation, cur_iter):
-        # start time
-        start_time = time.perf_counter()
-
         # Construct input features
-        features = observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids,
-                                       self._device)
-        feature_construct_time = time.perf_counter() - start_time
+        with self._stage_timer.measure('observation_adapter'):
+            features = self._observation_adapter(history, traffic_light_data, self._map_api, self._route_roadblock_ids,
+                                                 self._device)
 
         # Get reference path
         if self.enable_pdm_scorer_in_multirefpath:
-            ref_path_set = self._get_multi_refpath(ego_state, traffic_light_data, observation)
+            with self._stage_timer.measure('reference_path'):
+                ref_path_set = self._get_multi_refpath(ego_state, traffic_light_data, observation)
             if ref_path_set is None or len(ref_path_set) == 0:
                 logging.error('No reference path found')
         else:
-            ref_path = self._get_reference_path(ego_state, traffic_light_data, observation)
+            with self._stage_timer.measure('reference_path'):
+                ref_path = self._get_reference_path(ego_state, traffic_light_data, observation)
             if ref_path is None:
                 logging.error('No reference path found')
 
-        find_path_time = time.perf_counter() - start_time
-
         # Infer prediction model
         if self.ins_mode == 'gt':
             ins_path = self.get_ego_agent_future(ego_state)
@@ -386,8 +430,6 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
 
         plan, predictions, pred_scores, ego_state_transformed, neighbors_state_transformed = self._get_prediction(features, ins_path, cur_iter)
 
-        prediction_time = time.perf_counter() - start_time
-
         # if prediction_time > 0.5:
         #     logging.error(f'Prediction time: {prediction_time:.3f} s')
         #     plan = self._ml_planning(plan[0], ref_path)
@@ -407,21 +449,30 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
                 max_score = -1
                 max_traj = None
                 corr_cost = -1
-                for ref_path, cost in ref_path_set:
-                    plan_r = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
-                                                        predictions, plan, pred_scores, ref_path, observation)
+                candidates = []
+                ref_path_set = ref_path_set or []
+                # the speed profiles of all candidate ref paths are solved in one batched optimization
+                with self._stage_timer.measure('speed_planning'):
+                    plans = self._trajectory_planner.plan_batch(ego_state, ego_state_transformed, neighbors_state_transformed,
+                                                                predictions, plan, pred_scores,
+                                                                [ref_path for ref_path, _ in ref_path_set], observation)
+                for plan_r, (ref_path, cost) in zip(plans, ref_path_set):
                     states = transform_predictions_to_states(plan_r, history.ego_states, self._future_horizon, 0.1)
-                    trajectory = InterpolatedTrajectory(states)
-                    _, scores = self.sub_planner.compute_planner_trajectory_just_4_get_score(self.current_input, trajectory)
-                    curr_score = np.mean(scores)
-                    # plans.append((trajectory, cost, curr_score))
-                    if curr_score > max_score or (abs(curr_score - max_score) < 1e-5 and cost < corr_cost):
-                        max_score = curr_score
-                        max_traj = trajectory
-                        corr_cost = cost
+                    candidates.append((InterpolatedTrajectory(states), cost))
+                if len(candidates) > 0:
+                    # all candidates are simulated and scored by the pdm scorer in one pass
+                    with self._stage_timer.measure('pdm_scoring'):
+                        scores = self.sub_planner.compute_scores_for_trajectories(
+                            self.current_input, [trajectory for trajectory, _ in candidates])
+                    for (trajectory, cost), curr_score in zip(candidates, scores):
+                        if curr_score > max_score or (abs(curr_score - max_score) < 1e-5 and cost < corr_cost):
+                            max_score = curr_score
+                            max_traj = trajectory
+                            corr_cost = cost
                 if max_traj is None:
-                    plan = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
-                                                 predictions, plan, pred_scores, None, observation)
+                    with self._stage_timer.measure('speed_planning'):
+                        plan = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
+                                                             predictions, plan, pred_scores, None, observation)
                     states = transform_predictions_to_states(plan, history.ego_states, self._future_horizon, 0.1)
                     trajectory = InterpolatedTrajectory(states)
                 else:
@@ -429,8 +480,9 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
                     trajectory = max_traj
                 
             else:
-                plan = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
-                                                 predictions, plan, pred_scores, ref_path, observation)
+                with self._stage_timer.measure('speed_planning'):
+                    plan = self._trajectory_planner.plan(ego_state, ego_state_transformed, neighbors_state_transformed,
+                                                         predictions, plan, pred_scores, ref_path, observation)
                 states = transform_predictions_to_states(plan, history.ego_states, self._future_horizon, 0.1)
                 trajectory = InterpolatedTrajectory(states)
 
@@ -441,17 +493,7 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
         Corrects the roadblock route and reloads lane-graph dictionaries.
         :param ego_state: state of the ego vehicle.
         """
-        closest_distance = math.inf
-
-        for block in self._route_roadblocks:
-            for edge in block.interior_edges:
-                distance = edge.polygon.distance(Point((ego_state.rear_axle.x, ego_state.rear_axle.y)))
-                if distance < closest_distance:
-                    starting_block = block
-                    closest_distance = distance
-
-            if np.isclose(closest_distance, 0):
-                break
+        _, closest_distance = self._get_starting_block(ego_state)
 
         # In case the ego vehicle is not on the route, return None
         if closest_distance > 7:
@@ -477,7 +519,8 @@ class LLAMA4DrivePlanner(BaseGFPlanner):
             logging.error(f'\n New route roadblocks: {new_ids} \n Old route roadblocks: {old_ids}')
 
         if self.sub_planner:
-            pdm_trajectory = self.sub_planner.compute_planner_trajectory(current_input)
+            with self._stage_timer.measure('pdm_planner'):
+                pdm_trajectory = self.sub_planner.compute_planner_trajectory(current_input)
         cur_iter = current_input.iteration
         trajectory = self._plan(ego_state, history, traffic_light_data, observation, cur_iter)
 
@@ -0,0 +1,72 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class BatchedInferenceServer:
+    """
+    Dynamic batching in front of a model shared by many planners (one per scenario).
+    Requests arriving within max_wait_ms of the first one are grouped, up to max_batch_size,
+    and handed to batch_fn(list_of_requests) -> list_of_results in a single call.
+    batch_fn is any callable, e.g. LLAMA2DriveModel.batch_inference or a light stand-in for testing.
+    """
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5.0):
+        assert max_batch_size >= 1
+        self._batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self._requests = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='llm_inference_server', daemon=True)
+        self._thread.start()
+
+    def submit(self, *request):
+        future = Future()
+        self._requests.put((request, future))
+        return future
+
+    def infer(self, *request):
+        return self.submit(*request).result()
+
+    def close(self):
+        self._requests.put(None)
+
+    def _collect_batch(self):
+        item = self._requests.get()
+        if item is None:
+            return None
+        batch = [item]
+        deadline = time.perf_counter() + self.max_wait_ms / 1000
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                # serve what we already have, then stop
+                self._requests.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect_batch()
+            if batch is None:
+                break
+            requests = [request for request, _ in batch]
+            futures = [future for _, future in batch]
+            try:
+                results = self._batch_fn(requests)
+                assert len(results) == len(futures)
+            except Exception as e:
+                logging.exception(f'Batched inference failed for {len(batch)} requests')
+                for future in futures:
+                    future.set_exception(e)
+                continue
+            for future, result in zip(futures, results):
+                future.set_result(result)
@@ -0,0 +1,71 @@
+import logging
+import queue
+import threading
+
+
+class AsyncLLMWorker:
+    """
+    Runs the LLM part of LLAMA2DriveModel in a background thread.
+    The planner submits the newest features every tick and plans with the most recent finished llm feature,
+    only waiting when that feature is older than max_staleness seconds (simulation time).
+    """
+    def __init__(self, model, max_staleness=1.0, timeout=30.0):
+        self._model = model
+        self.max_staleness = max_staleness
+        self.timeout = timeout
+        # holds at most one pending request, older ones are dropped since only the latest scene matters
+        self._requests = queue.Queue(maxsize=1)
+        self._result_cond = threading.Condition()
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run, name='async_llm_worker', daemon=True)
+        self._thread.start()
+
+    def submit(self, features, ref_path, cur_iter):
+        try:
+            self._requests.get_nowait()
+        except queue.Empty:
+            pass
+        self._requests.put_nowait((features, ref_path, cur_iter))
+
+    def latest(self, cur_iter):
+        """
+        :return: (llm_feature, llm_plan, time_s) of the freshest finished llm step within the staleness budget.
+        """
+        def is_fresh():
+            if self._error is not None:
+                return True
+            return self._result is not None and cur_iter.time_s - self._result[2] <= self.max_staleness
+
+        with self._result_cond:
+            if not self._result_cond.wait_for(is_fresh, timeout=self.timeout):
+                raise TimeoutError(f'No llm feature within {self.max_staleness}s budget after waiting {self.timeout}s')
+            if self._error is not None:
+                error, self._error = self._error, None
+                raise error
+            return self._result
+
+    def close(self):
+        try:
+            self._requests.get_nowait()
+        except queue.Empty:
+            pass
+        self._requests.put(None)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                break
+            features, ref_path, cur_iter = request
+            try:
+                output = self._model.inference_llm(features, ref_path, cur_iter)
+            except Exception as e:
+                logging.exception('Async llm inference failed')
+                with self._result_cond:
+                    self._error = e
+                    self._result_cond.notify_all()
+                continue
+            with self._result_cond:
+                self._result = (output.llm_feature, output.llm_plan, cur_iter.time_s)
+                self._result_cond.notify_all()
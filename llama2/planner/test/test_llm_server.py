@@ -0,0 +1,97 @@
+import threading
+import unittest
+
+from llama2.planner.llm_server import BatchedInferenceServer
+
+
+class StubBatchInference:
+    """batch_inference stand-in recording its batches, the result of a request (features, cur_iter) is its cur_iter"""
+
+    def __init__(self):
+        self.batches = []
+        self.error = None
+
+    def __call__(self, requests):
+        self.batches.append([cur_iter for _, cur_iter in requests])
+        if self.error is not None:
+            raise self.error
+        return [f'plan_{cur_iter}' for _, cur_iter in requests]
+
+
+class TestBatchedInferenceServer(unittest.TestCase):
+    """Test the dynamic batching of the llm inference server"""
+
+    def setUp(self):
+        self.batch_fn = StubBatchInference()
+
+    def _server(self, **kwargs):
+        server = BatchedInferenceServer(self.batch_fn, **kwargs)
+        self.addCleanup(server.close)
+        return server
+
+    def test_batch_grouping(self):
+        """Requests within max_wait_ms are grouped up to max_batch_size"""
+        server = self._server(max_batch_size=3, max_wait_ms=500)
+        futures = [server.submit({}, index) for index in range(5)]
+        self.assertEqual([future.result(timeout=5) for future in futures], [f'plan_{index}' for index in range(5)])
+        self.assertEqual(self.batch_fn.batches, [[0, 1, 2], [3, 4]])
+
+    def test_max_wait(self):
+        """A request arriving after max_wait_ms starts a new batch"""
+        server = self._server(max_batch_size=8, max_wait_ms=1)
+        self.assertEqual(server.infer({}, 0), 'plan_0')
+        self.assertEqual(server.infer({}, 1), 'plan_1')
+        self.assertEqual(self.batch_fn.batches, [[0], [1]])
+
+    def test_own_row_per_caller(self):
+        """Concurrent callers get the result of their own request"""
+        server = self._server(max_batch_size=4, max_wait_ms=20)
+        results = {}
+
+        def run(index):
+            results[index] = server.infer({}, index)
+
+        threads = [threading.Thread(target=run, args=(index,)) for index in range(16)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(results, {index: f'plan_{index}' for index in range(16)})
+        self.assertTrue(all(len(batch) <= 4 for batch in self.batch_fn.batches))
+        self.assertEqual(sorted(index for batch in self.batch_fn.batches for index in batch), list(range(16)))
+
+    def test_exception(self):
+        """A failed batch raises in every caller of the batch, later batches are served"""
+        server = self._server(max_batch_size=2, max_wait_ms=500)
+        self.batch_fn.error = RuntimeError('llm failed')
+        with self.assertLogs(level='ERROR'):
+            futures = [server.submit({}, index) for index in range(2)]
+            for future in futures:
+                with self.assertRaisesRegex(RuntimeError, 'llm failed'):
+                    future.result(timeout=5)
+
+        self.batch_fn.error = None
+        self.assertEqual(server.infer({}, 2), 'plan_2')
+
+    def test_result_count_mismatch(self):
+        """A batch_fn returning a wrong number of results fails its callers instead of mixing up rows"""
+        server = self._server(max_batch_size=2, max_wait_ms=500)
+        server._batch_fn = lambda requests: ['plan']
+        with self.assertLogs(level='ERROR'):
+            futures = [server.submit({}, index) for index in range(2)]
+            for future in futures:
+                with self.assertRaises(AssertionError):
+                    future.result(timeout=5)
+
+    def test_close(self):
+        """close serves the pending requests and stops the server thread"""
+        server = BatchedInferenceServer(self.batch_fn, max_batch_size=8, max_wait_ms=500)
+        future = server.submit({}, 0)
+        server.close()
+        self.assertEqual(future.result(timeout=5), 'plan_0')
+        server._thread.join(5)
+        self.assertFalse(server._thread.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from llama2.planner.llm_worker import AsyncLLMWorker
+
+
+def make_iteration(index, time_s):
+    return SimpleNamespace(index=index, time_s=time_s)
+
+
+class FakeDriveModel:
+    """LLAMA2DriveModel stub whose llm steps run when released, the feature is the iteration index"""
+
+    def __init__(self):
+        self.release = threading.Semaphore(0)
+        self.started = threading.Semaphore(0)
+        self.calls = []
+        self.error = None
+
+    def inference_llm(self, features, ref_path, cur_iter):
+        self.calls.append(cur_iter.index)
+        self.started.release()
+        self.release.acquire()
+        if self.error is not None:
+            raise self.error
+        return SimpleNamespace(llm_feature=f'feature_{cur_iter.index}', llm_plan=f'plan_{cur_iter.index}')
+
+
+class TestAsyncLLMWorker(unittest.TestCase):
+    """Test the background llm worker of the async planner"""
+
+    def setUp(self):
+        self.model = FakeDriveModel()
+        self.worker = AsyncLLMWorker(self.model, max_staleness=1.0, timeout=5.0)
+
+    def tearDown(self):
+        # let a blocked llm step finish so that the worker thread exits
+        for _ in range(4):
+            self.model.release.release()
+        self.worker.close()
+
+    def _latest_in_thread(self, cur_iter):
+        result = {}
+
+        def run():
+            try:
+                result['value'] = self.worker.latest(cur_iter)
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread, result
+
+    def test_first_tick_blocks(self):
+        """Without any llm feature the first tick waits for the first llm step"""
+        cur_iter = make_iteration(0, 0.0)
+        self.worker.submit({}, None, cur_iter)
+        thread, result = self._latest_in_thread(cur_iter)
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+
+        self.model.release.release()
+        thread.join(5.0)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(result['value'], ('feature_0', 'plan_0', 0.0))
+
+    def test_staleness(self):
+        """A feature within max_staleness is returned at once, an older one waits for the next llm step"""
+        self.worker.submit({}, None, make_iteration(0, 0.0))
+        self.model.release.release()
+        self.assertEqual(self.worker.latest(make_iteration(0, 0.0))[2], 0.0)
+
+        # 0.9 s old: fresh enough, the llm step of tick 9 runs in the background
+        self.worker.submit({}, None, make_iteration(9, 0.9))
+        self.assertTrue(self.model.started.acquire(timeout=5.0))
+        start = time.perf_counter()
+        self.assertEqual(self.worker.latest(make_iteration(9, 0.9)), ('feature_0', 'plan_0', 0.0))
+        self.assertLess(time.perf_counter() - start, 1.0)
+
+        # 1.1 s old: waits for the llm step of tick 9
+        thread, result = self._latest_in_thread(make_iteration(11, 1.1))
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        self.model.release.release()
+        thread.join(5.0)
+        self.assertEqual(result['value'], ('feature_9', 'plan_9', 0.9))
+
+    def test_newest_request_only(self):
+        """Requests submitted during an llm step replace each other, only the newest one runs next"""
+        self.worker.max_staleness = 0.0
+        self.worker.submit({}, None, make_iteration(0, 0.0))
+        self.assertTrue(self.model.started.acquire(timeout=5.0))
+        for index in range(1, 4):
+            self.worker.submit({}, None, make_iteration(index, index / 10))
+        self.model.release.release()
+        self.assertTrue(self.model.started.acquire(timeout=5.0))
+        self.model.release.release()
+        self.assertEqual(self.worker.latest(make_iteration(3, 0.3))[2], 0.3)
+        self.assertEqual(self.model.calls, [0, 3])
+
+    def test_error(self):
+        """A failed llm step raises in the planner thread"""
+        self.model.error = RuntimeError('llm failed')
+        self.worker.submit({}, None, make_iteration(0, 0.0))
+        with self.assertLogs(level='ERROR'):
+            self.model.release.release()
+            with self.assertRaisesRegex(RuntimeError, 'llm failed'):
+                self.worker.latest(make_iteration(0, 0.0))
+
+    def test_timeout(self):
+        """latest raises when no fresh feature arrives within timeout"""
+        self.worker.timeout = 0.1
+        self.worker.submit({}, None, make_iteration(0, 0.0))
+        with self.assertRaises(TimeoutError):
+            self.worker.latest(make_iteration(0, 0.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -75,6 +75,8 @@ MODEL_CONFIG_CLASSES = list(MODEL_FOR_CAUSAL_LM_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
 from gameformer.predictor_modules_adapter import CrossTransformer, SelfTransformer, AdaptiveBlock
+from llama2.utils.scene_collator import SceneDataCollator
+from llama2.utils.prompt_tokenizer import PromptTokenizer, split_instruction
 
 
 @dataclass
@@ -87,10 +89,13 @@ class ModelArguments:
     down_sample_type: Optional[str] = field(default='none')
 
     dataset_cache: Optional[str] = field(
-        default='./dataset_cache', metadata={"help": "Path to the dataset cache"}
+        default='./dataset_cache', metadata={"help": "Path to the dataset cache, holding the token ids and the "
+                                                     "map_info reference of each sample"}
     )
     use_all_tokens: Optional[bool] = field(default=False)
     adapter_fusion: Optional[bool] = field(default=False)
+    share_encoder: Optional[bool] = field(default=False,
+                                          metadata={"help": "Use map_encoder as the gameformer encoder as well."})
     gameformer_ckpt: Optional[str] = field(default=None)
     lora_ckpt: Optional[str] = field(default=None)
     ins_wo_stop: Optional[bool] = field(default=False)
@@ -287,6 +292,50 @@ class DataTrainingArguments:
 
 
 
+def merge_navigation_instruction(navigation_instruction):
+    """
+    Drop the stop commands of a navigation instruction and merge the distances of consecutive identical commands.
+    """
+    cmd_ls = []
+    dist_ls = []
+    for nav_inst in navigation_instruction.split('. '):
+        if 'go straight in' in nav_inst:
+            cmd = 'go straight in '
+        elif 'turn left in ' in nav_inst:
+            cmd = 'turn left in '
+        elif 'turn right in ' in nav_inst:
+            cmd = 'turn right in '
+        elif 'stop' in nav_inst or nav_inst == '':
+            continue
+        else:
+            raise ValueError(f'Unknown navigation command {nav_inst}')
+        match = re.search(r'\d+\.\d+', nav_inst)
+        if match is None:
+            raise ValueError(f'No distance in navigation command {nav_inst}')
+        cmd_ls.append(cmd)
+        dist_ls.append(float(match.group(0)))
+
+    if len(cmd_ls) == 0:
+        return navigation_instruction
+    # 合并连续相同的动作
+    cur_c = None
+    cur_d = 0
+    instruction = ''
+    for c, d in zip(cmd_ls, dist_ls):
+        if cur_c is None:
+            cur_c = c
+            cur_d = d
+        elif c == cur_c:
+            cur_d += d
+        else:
+            instruction += (cur_c + str(np.round(cur_d, 2)) + ' meters. ')
+            cur_c = c
+            cur_d = d
+    instruction += (cur_c + str(np.round(cur_d, 2)) + ' meters. ')
+
+    return instruction
+
+
 def main():
     # See all possible arguments in src/transformers/training_args.py
     # or by passing the --help flag to this script.
@@ -390,6 +439,7 @@ def main():
     config.enable_lora = model_args.enable_lora
     config.use_all_tokens = model_args.use_all_tokens
     config.adapter_fusion = model_args.adapter_fusion
+    config.share_encoder = model_args.share_encoder
     config.gameformer_ckpt = model_args.gameformer_ckpt
     config.lora_ckpt = model_args.lora_ckpt
     config.ins_wo_stop = model_args.ins_wo_stop
@@ -512,186 +562,60 @@ def main():
     target_column_name = 'target'
     map_column_name = 'map_info'
 
-    # 把一个字符串 prompt 处理成模型可直接用的数据结构，并可选地在结尾添加 <eos> token，同时生成
-    # 相应的 attention mask 和 labels
-    def tokenize(prompt, cutoff_len=data_args.block_size, padding=False, add_eos_token=True):
-        result = tokenizer(
-            prompt,
-            truncation=True,
-            max_length=cutoff_len,
-            padding=padding,
-            return_tensors=None,
-        )
+    prompt_tokenizer = PromptTokenizer(tokenizer)
+
+    # 把 prompt 的 token id 处理成模型可直接用的数据结构（加特殊 token、截断），并可选地在结尾添加 <eos> token，
+    # 同时生成相应的 attention mask 和 labels
+    def tokenize(input_ids, cutoff_len=data_args.block_size, add_eos_token=True):
+        # 与 tokenizer(prompt, truncation=True, max_length=cutoff_len) 结果一致
+        max_length = cutoff_len if cutoff_len is not None else tokenizer.model_max_length
+        input_ids = input_ids[:max(max_length - tokenizer.num_special_tokens_to_add(), 0)]
+        input_ids = tokenizer.build_inputs_with_special_tokens(input_ids)
         if (
-                result["input_ids"][-1] != tokenizer.eos_token_id
-                and len(result["input_ids"]) < cutoff_len
+                input_ids[-1] != tokenizer.eos_token_id
+                and (cutoff_len is None or len(input_ids) < cutoff_len)
                 and add_eos_token
         ):
-            result["input_ids"].append(tokenizer.eos_token_id)
-            result["attention_mask"].append(1)
-
-        result["labels"] = result["input_ids"].copy()
-
-        return result
-
-    
-    # 返回 map_info prompt 
-    def generate_and_tokenize_prompt(data_point):
-        input_text = data_point[input_column_name]
-        # if 'Final Answer' not in input_text:
-        #     input_text = data_point[input_column_name]
-        # preprocess navigation instruction
-        # 左右方向互换
-        if 'left' in input_text:
-            input_text = input_text.replace('left', 'right')
-        elif 'right' in input_text:
-            input_text = input_text.replace('right', 'left')
-        # 对 ins_wo_stop 进行特殊处理
-        if config.ins_wo_stop:
-            pattern = r'Nevigation instructions:.*?\n\n'
-            match = re.search(pattern, input_text)
-            if match:
-                start_index = match.start()
-                end_index = match.end()
-                pre_text = input_text[:start_index+25] # 提取前缀
-                pro_text = input_text[end_index-2:] # 提取后缀
-                navigation_instruction = input_text[start_index+25:end_index-2].split('. ')
-                cmd_ls = []
-                dist_ls = []
-                for nav_inst in navigation_instruction:
-                    if 'go straight in' in nav_inst:
-                        cmd = 'go straight in '
-                    elif 'turn left in ' in nav_inst:
-                        cmd = 'turn left in '
-                    elif 'turn right in ' in nav_inst:
-                        cmd = 'turn right in '
-                    elif 'stop' in nav_inst:
-                        continue
-                    elif nav_inst=='':
-                        continue
-                    else:
-                        import pdb; pdb.set_trace()
-                    cmd_ls.append(cmd)
-                    pattern = r'\d+\.\d+'
-                    match = re.search(pattern, nav_inst)
-                    if match:
-                        dist = match.group(0)
-                        dist = float(dist)
-                        dist_ls.append(dist)
-                    else:
-                        import pdb; pdb.set_trace()
-
-                # 合并连续相同的动作
-                if not len(cmd_ls)==0:
-                    cur_c = None
-                    cur_d = 0
-                    instruction = ''
-                    for c, d in zip(cmd_ls, dist_ls):
-                        if cur_c is None:
-                            cur_c = c
-                            cur_d = d
-                        elif c==cur_c:
-                            cur_d += d
-                        else:
-                            instruction += (cur_c + str(np.round(cur_d, 2)) + ' meters. ')
-                            cur_c = c
-                            cur_d = d
-                    instruction += (cur_c + str(np.round(cur_d, 2)) + ' meters. ')
-                    # if 'stop' in input_text:
-                    #     import pdb; pdb.set_trace()
-                    input_text = pre_text + instruction + pro_text
-                else:
-                    input_text = input_text
-            else:
-                import pdb; pdb.set_trace()
-
-        # print(input_text)
-        input_text = input_text.replace('<map>','<map></map>')
-        target_text = data_point[target_column_name]
-        full_prompt = input_text + target_text
-        
-        # 判断是否存在 map_info 以及进一步处理
-        try:
-            map_info = data_point[map_column_name]
-        except:
-            map_info = None
-        if map_info is None or map_info == 'null':
-            map_feats = None
-            map_masks = None
-        # 从 map_info 中提取 input_dict 
-        else:
-            map_info = np.load(map_info, allow_pickle=True) # np.load 加载 .npy 或 .npz 格式
-                                                            # allow_pickle 是否允许加载以 Python pickle
-                                                            # 协议序列化的数据，出于安全默认为 False
-            if 'ego_v_a' in [k for k in map_info.keys()]:
-                input_dict = {
-                    'ego_agent_past': map_info['ego_agent_past'], # history
-                    'neighbor_agents_past': map_info['neighbor_agents_past'],
-                    'route_lanes': map_info['route_lanes'], # 规划路线上的车道
-                    'map_lanes': map_info['lanes'], # 全图车道
-                    'map_crosswalks': map_info['crosswalks'],
-                    'ego_future': map_info['ego_agent_future'], # 8s, 80 points -> 10s, 100points
-                    'neighbors_future': map_info['neighbor_agents_future'],
-                    'ego_v_a': map_info['ego_v_a'],
-                    'neighbour_lane': map_info['neighbour_lane'],
-                    'acc_classification': map_info['acc_classification'],
-                    'lane_change': map_info['lane_change'],
-                    'traffic_light': map_info['traffic_light'],
-                    'ego_lane_flag': map_info['ego_lane_flag'],
-                }
-                traffic_light_array = np.array([0,0,0,0]) #red, yellow, green, unknown
-                traffic_light = np.unique(map_info['traffic_light']) # np.unique 找出数组中的唯一值
-                if len(traffic_light) > 1:
-                    traffic_light = np.array(['UNKNOWN'])
-                if traffic_light == 'RED':
-                    traffic_light_array[0] = 1
-                elif traffic_light == 'YELLOW':
-                    traffic_light_array[1] = 1
-                elif traffic_light == 'GREEN':
-                    traffic_light_array[2] = 1
-                elif traffic_light == 'UNKNOWN':
-                    traffic_light_array[3] = 1
-                input_dict['traffic_light'] = traffic_light_array
-            else:
-                input_dict = {
-                    'ego_agent_past': map_info['ego_agent_past'],
-                    'neighbor_agents_past': map_info['neighbor_agents_past'],
-                    'route_lanes': map_info['route_lanes'],
-                    'map_lanes': map_info['lanes'],
-                    'map_crosswalks': map_info['crosswalks'],
-                    'ego_future': map_info['ego_agent_future'],
-                    'neighbors_future': map_info['neighbor_agents_future'],
-                }
-            # 统一格式转换为 tensor
-            for k,v in input_dict.items():
-                input_dict[k] = torch.from_numpy(v).to(torch.float32)
-        
-        if model_args.down_sample_type != 'none':
-            assert model_args.down_sample_type in ['trunk', 'resample']
-            assert model_args.feature_len != input_dict['ego_future'].shape[0]
-            # trunk : 直接裁剪
-            if model_args.down_sample_type == 'trunk':
-                input_dict['ego_future'] = input_dict['ego_future'][:model_args.feature_len, :]
-                input_dict['neighbors_future'] = input_dict['neighbors_future'][:, :model_args.feature_len, :]
-            # resample : 均匀间隔抽取
-            elif model_args.down_sample_type == 'resample':
-                assert input_dict['ego_future'].shape[0] % model_args.feature_len == 0
-                input_dict['ego_future'] = input_dict['ego_future'][
-                                           ::input_dict['ego_future'].shape[0] // model_args.feature_len, :]
-                input_dict['neighbors_future'] = input_dict['neighbors_future'][:,
-                                                 ::input_dict['neighbors_future'].shape[1] // model_args.feature_len, :]
-        tokenized_full_prompt = tokenize(full_prompt, add_eos_token=True)
-        tokenized_input_text = tokenize(input_text, add_eos_token=True)
-
-        # 生成输入-输出对的标签
-        input_text_len = len(tokenized_input_text["input_ids"])
-        # -100 是 PyTorch 的 CrossEntropyLoss 的 ignore_index，告诉损失函数这些位置不算 loss
-        tokenized_full_prompt["labels"] = [-100] * input_text_len + tokenized_full_prompt["labels"][input_text_len:]
-        
-        if map_info is not None:
-            tokenized_full_prompt.update(input_dict)
-
-        return tokenized_full_prompt
+            input_ids = input_ids + [tokenizer.eos_token_id]
+
+        return {"input_ids": input_ids, "attention_mask": [1] * len(input_ids), "labels": list(input_ids)}
+
+    # 批量处理：模板部分的 token 只计算一次，每条样本只对导航指令和 target 分词
+    def generate_and_tokenize_prompts(data_points):
+        results = {"input_ids": [], "attention_mask": [], "labels": [], map_column_name: []}
+        input_texts = data_points[input_column_name]
+        map_infos = data_points.get(map_column_name, [None] * len(input_texts))
+        for input_text, target_text, map_info in zip(input_texts, data_points[target_column_name], map_infos):
+            # preprocess navigation instruction
+            # 左右方向互换
+            if 'left' in input_text:
+                input_text = input_text.replace('left', 'right')
+            elif 'right' in input_text:
+                input_text = input_text.replace('right', 'left')
+            input_text = input_text.replace('<map>','<map></map>')
+
+            # 对 ins_wo_stop 进行特殊处理：合并连续相同的动作
+            if config.ins_wo_stop:
+                parts = split_instruction(input_text)
+                if parts is None:
+                    raise ValueError(f'No navigation instruction in {input_text}')
+                input_text = parts[0] + merge_navigation_instruction(parts[1]) + parts[2]
+            input_ids = prompt_tokenizer.encode(input_text)
+            full_ids = prompt_tokenizer.encode(input_text, target=target_text)
+
+            tokenized_full_prompt = tokenize(full_ids, add_eos_token=True)
+            tokenized_input_text = tokenize(input_ids, add_eos_token=True)
+            # 生成输入-输出对的标签
+            input_text_len = len(tokenized_input_text["input_ids"])
+            # -100 是 PyTorch 的 CrossEntropyLoss 的 ignore_index，告诉损失函数这些位置不算 loss
+            tokenized_full_prompt["labels"] = [-100] * input_text_len + tokenized_full_prompt["labels"][input_text_len:]
+            # 场景张量不存入 dataset，只保留 map_info 引用，由 SceneDataCollator 在组 batch 时读取
+            tokenized_full_prompt[map_column_name] = None if map_info == 'null' else map_info
+
+            for k, v in tokenized_full_prompt.items():
+                results[k].append(v)
+
+        return results
 
     # main_process_first 主要用于解决分布式训练环境中数据处理协调问题，确保先执行主进程，
     # 其他进程暂停并等待
@@ -706,8 +630,8 @@ def main():
             # .map() : HuggingFace datasets 库中数据映射方法，用于对数据集里每一条数据进行
             # 批量处理或转换以生成一个新的数据集
                 tokenized_datasets = raw_datasets.map(
-                    generate_and_tokenize_prompt,
-                    batched=False,  # 每次 map 只处理一条数据
+                    generate_and_tokenize_prompts,
+                    batched=True,  # 每次 map 处理一批数据
                     remove_columns=column_names, # 处理后删除原始多余字段
                     num_proc=32  # 多进程加速处理
                 )
@@ -715,8 +639,8 @@ def main():
                 logging.info(f"Saving dataset to {model_args.dataset_cache}")
         else:
             tokenized_datasets = raw_datasets.map(
-                    generate_and_tokenize_prompt,
-                    batched=False,
+                    generate_and_tokenize_prompts,
+                    batched=True,
                     remove_columns=column_names,
                     num_proc=32
                 )
@@ -777,8 +701,10 @@ def main():
         # Data collator will default to DataCollatorWithPadding, so we change it.
         # Data collator（数据收集器/整理器），用于在 DataLoader 每次生成 batch 时，把一组（通常是不等长的）
         # 样本打包成等长 batch，并自动进行必要的补齐（padding）、mask、格式转换等
-        data_collator=transformers.DataCollatorForSeq2Seq(
-            tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True
+        data_collator=SceneDataCollator(
+            transformers.DataCollatorForSeq2Seq(tokenizer, pad_to_multiple_of=8, return_tensors="pt", padding=True),
+            down_sample_type=model_args.down_sample_type,
+            feature_len=model_args.feature_len,
         ),
         compute_metrics=compute_metrics if training_args.do_eval and not is_torch_tpu_available() else None,
         preprocess_logits_for_metrics=preprocess_logits_for_metrics if training_args.do_eval and not is_torch_tpu_available()else None,
@@ -0,0 +1,130 @@
+import unittest
+
+import torch
+from transformers.models.llama.configuration_llama import LlamaConfig
+
+from llama2.model_llama4drive import LlamaForCausalLM
+
+
+MAP_TOKEN, MAP_END_TOKEN = 98, 99
+TINY_LLAMA_CONFIG = {
+    'vocab_size': 100,
+    'hidden_size': 64,
+    'intermediate_size': 172,
+    'num_hidden_layers': 2,
+    'num_attention_heads': 4,
+    'max_position_embeddings': 512,
+    'rms_norm_eps': 1e-6,
+    'pad_token_id': 0,
+}
+
+
+def build_model():
+    """Randomly initialised model as llama2.planner.llama4drive.get_model configures it"""
+    config = LlamaConfig(**TINY_LLAMA_CONFIG)
+    config.feature_len = 80
+    config.map_former = False
+    config.mapEncoder_pretrain_weight = None
+    config.enable_lora = False
+    config.pool_mode = 'all_mean'
+    config.use_all_tokens = False
+    config.map_insize = 256
+    config.adapter_fusion = False
+    config.share_encoder = False
+    config.llm_inf_step = 1
+    config.use_prefix_cache = True
+    config.lora_r = 8
+    config.special_token_dict = {'<map>': MAP_TOKEN, '</map>': MAP_END_TOKEN}
+
+    return LlamaForCausalLM(config).eval()
+
+
+def make_inputs(suffixes, seed=0):
+    """Prompts sharing their prefix up to <map>, followed by different instructions, and their scenes"""
+    generator = torch.Generator().manual_seed(seed)
+    prefix = [1] + torch.randint(3, MAP_TOKEN, (12,), generator=generator).tolist() + [MAP_TOKEN, MAP_END_TOKEN]
+    input_ids = torch.tensor([prefix + suffix + [2] for suffix in suffixes])
+    batch_size = len(suffixes)
+    shapes = {
+        'ego_agent_past': (batch_size, 21, 7),
+        'neighbor_agents_past': (batch_size, 20, 21, 11),
+        'map_lanes': (batch_size, 40, 50, 7),
+        'map_crosswalks': (batch_size, 5, 30, 3),
+        'route_lanes': (batch_size, 10, 50, 3),
+    }
+    inputs = {key: torch.randn(shape, generator=generator) for key, shape in shapes.items()}
+    inputs['input_ids'] = input_ids
+    inputs['attention_mask'] = input_ids.ne(0)
+
+    return inputs
+
+
+class TestPrefixCache(unittest.TestCase):
+    """Test that the prompt prefix kv cache does not change the outputs of the model"""
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.model = build_model()
+        self.inputs = make_inputs([[10, 11, 12, 13], [20, 21, 22, 23]])
+
+    def _forward(self, use_prefix_cache, inputs=None):
+        self.model.model.use_prefix_cache = use_prefix_cache
+        with torch.no_grad():
+            return self.model(**(inputs or self.inputs), inference=True,
+                              inference_heads=['predictions', 'plan', 'llm_plan', 'logits'])
+
+    def _assert_outputs_close(self, output, reference):
+        for key in ['logits', 'llm_feature', 'llm_plan', 'plan']:
+            torch.testing.assert_close(getattr(output, key), getattr(reference, key), msg=key)
+
+    def test_cache_on_off(self):
+        reference = self._forward(False)
+        self.assertEqual(len(self.model.model.prefix_cache), 0)
+        # cache miss then cache hit
+        self._assert_outputs_close(self._forward(True), reference)
+        self.assertEqual(len(self.model.model.prefix_cache), 1)
+        self._assert_outputs_close(self._forward(True), reference)
+        self.assertEqual(len(self.model.model.prefix_cache), 1)
+
+        # another batch with the same prefix hits the cache
+        inputs = make_inputs([[30, 31]])
+        self._assert_outputs_close(self._forward(True, inputs), self._forward(False, inputs))
+        self.assertEqual(len(self.model.model.prefix_cache), 1)
+
+    def test_hidden_states(self):
+        map_feats = torch.randn(2, 7, self.model.config.hidden_size)
+        map_masks = torch.zeros(2, 7, dtype=torch.bool)
+        kwargs = {'input_ids': self.inputs['input_ids'], 'attention_mask': self.inputs['attention_mask'],
+                  'map_feats': map_feats, 'map_masks': map_masks}
+        outputs = {}
+        for use_prefix_cache in [False, True, True]:
+            self.model.model.use_prefix_cache = use_prefix_cache
+            with torch.no_grad():
+                outputs[use_prefix_cache] = self.model.model(**kwargs)[0].last_hidden_state
+        torch.testing.assert_close(outputs[True], outputs[False])
+
+    def test_load_state_dict(self):
+        """Loading other weights drops the cached prefix"""
+        self._forward(True)
+        torch.manual_seed(1)
+        state_dict = build_model().state_dict()
+        self.model.load_state_dict(state_dict)
+        self.assertEqual(len(self.model.model.prefix_cache), 0)
+        self._forward(True)
+        self.model.load_state_dict(state_dict)
+        self.assertEqual(len(self.model.model.prefix_cache), 0)
+        self._assert_outputs_close(self._forward(True), self._forward(False))
+
+    def test_to_dtype(self):
+        """A cast model computes its own prefix cache"""
+        self._forward(True)
+        self.model.to(torch.bfloat16)
+        output = self._forward(True)
+        self.assertEqual(len(self.model.model.prefix_cache), 2)
+        reference = self._forward(False)
+        for key in ['logits', 'llm_feature']:
+            torch.testing.assert_close(getattr(output, key), getattr(reference, key), atol=0.05, rtol=0.05, msg=key)
+
+
+if __name__ == '__main__':
+    unittest.main()
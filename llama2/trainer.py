@@ -1107,4 +1107,6 @@ class CustomTrainerLLAMA4Drive(CustomTrainer):
                                                  'traffic_light',
                                                  'ego_lane_flag',
                                                  'urban_features',
-                                                 'urban_avails'] + self.label_names))
+                                                 'urban_avails',
+                                                 # scene reference, replaced by the scene tensors in SceneDataCollator
+                                                 'map_info'] + self.label_names))
@@ -0,0 +1,76 @@
+import argparse
+import os
+import shutil
+from collections import OrderedDict
+
+import torch
+
+
+ENCODER_PREFIX = 'encoder.'
+
+
+def split_gameformer_encoder_weights(weights):
+    """
+    Split a gameformer state dict into (encoder weights without the 'encoder.' prefix, the remaining weights).
+    """
+    encoder_weights = OrderedDict()
+    other_weights = OrderedDict()
+    for key, value in weights.items():
+        if key.startswith(ENCODER_PREFIX):
+            encoder_weights[key[len(ENCODER_PREFIX):]] = value
+        else:
+            other_weights[key] = value
+    return encoder_weights, other_weights
+
+
+def convert_to_shared_encoder(ckpt_dir, save_dir, encoder_source='map_encoder'):
+    """
+    Convert a checkpoint dir saved by LlamaForCausalLM.save_pretrained to the shared encoder layout:
+    gameformer.bin without the encoder, map_encoder.bin holding the single encoder.
+    :param encoder_source: 'map_encoder' keeps the encoder fed to the llm, 'gameformer' keeps the one used by the decoder.
+    """
+    assert encoder_source in ['map_encoder', 'gameformer']
+    if os.path.abspath(ckpt_dir) != os.path.abspath(save_dir):
+        shutil.copytree(ckpt_dir, save_dir, dirs_exist_ok=True)
+
+    gameformer_weights = torch.load(os.path.join(ckpt_dir, 'gameformer.bin'), map_location=torch.device('cpu'))
+    gameformer_encoder_weights, decoder_weights = split_gameformer_encoder_weights(gameformer_weights)
+    torch.save(decoder_weights, os.path.join(save_dir, 'gameformer.bin'))
+
+    if encoder_source == 'gameformer':
+        if len(gameformer_encoder_weights) == 0:
+            raise ValueError(f'No gameformer encoder weights found in {ckpt_dir}')
+        torch.save(gameformer_encoder_weights, os.path.join(save_dir, 'map_encoder.bin'))
+    elif not os.path.exists(os.path.join(ckpt_dir, 'map_encoder.bin')):
+        raise ValueError(f'No map_encoder.bin found in {ckpt_dir}')
+    print(f'Converted {ckpt_dir} to shared encoder checkpoint {save_dir} (encoder from {encoder_source})')
+
+
+def convert_to_separate_encoder(ckpt_dir, save_dir):
+    """
+    Inverse of convert_to_shared_encoder: copy the shared encoder back into gameformer.bin.
+    """
+    if os.path.abspath(ckpt_dir) != os.path.abspath(save_dir):
+        shutil.copytree(ckpt_dir, save_dir, dirs_exist_ok=True)
+
+    encoder_weights = torch.load(os.path.join(ckpt_dir, 'map_encoder.bin'), map_location=torch.device('cpu'))
+    gameformer_weights = torch.load(os.path.join(ckpt_dir, 'gameformer.bin'), map_location=torch.device('cpu'))
+    _, decoder_weights = split_gameformer_encoder_weights(gameformer_weights)
+    for key, value in encoder_weights.items():
+        decoder_weights[ENCODER_PREFIX + key] = value
+    torch.save(decoder_weights, os.path.join(save_dir, 'gameformer.bin'))
+    print(f'Converted {ckpt_dir} to separate encoder checkpoint {save_dir}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ckpt_dir', type=str, required=True)
+    parser.add_argument('--save_dir', type=str, required=True)
+    parser.add_argument('--to', type=str, default='shared', choices=['shared', 'separate'])
+    parser.add_argument('--encoder_source', type=str, default='map_encoder', choices=['map_encoder', 'gameformer'])
+    args = parser.parse_args()
+
+    if args.to == 'shared':
+        convert_to_shared_encoder(args.ckpt_dir, args.save_dir, args.encoder_source)
+    else:
+        convert_to_separate_encoder(args.ckpt_dir, args.save_dir)
@@ -0,0 +1,120 @@
+import logging
+
+
+INSTRUCTION_MARKER = 'Nevigation instructions: '
+INSTRUCTION_END = '\n\n'
+# tokenized in front of a segment that does not start the prompt, the tokenizer adds nothing across a line break
+ANCHOR = '\n'
+
+
+def split_instruction(text):
+    """
+    Split a drive prompt around its navigation instruction.
+    :return: (prefix up to and including the instruction marker, instruction, suffix from the line break after it),
+        None when text has no instruction.
+    """
+    start = text.find(INSTRUCTION_MARKER)
+    if start < 0:
+        return None
+    start += len(INSTRUCTION_MARKER)
+    end = text.find(INSTRUCTION_END, start)
+    if end < 0:
+        return None
+    return text[:start], text[start:end], text[end:]
+
+
+def split_prompt(text):
+    """
+    Split a drive prompt into the segments tokenized separately: (prefix, instruction, suffix).
+    SentencePiece tokenizers attach a space to the word after it ('instructions: go' -> ..., ':', '▁go'), so the
+    segments are cut before spaces: the space after the marker starts the instruction, the trailing spaces of the
+    instruction start the suffix.
+    :return: None when text has no instruction.
+    """
+    parts = split_instruction(text)
+    if parts is None:
+        return None
+    prefix, instruction, suffix = parts
+    num_marker_spaces = len(prefix) - len(prefix.rstrip(' '))
+    instruction = prefix[len(prefix) - num_marker_spaces:] + instruction
+    prefix = prefix[:len(prefix) - num_marker_spaces]
+    stripped = instruction.rstrip(' ')
+    return prefix, stripped, instruction[len(stripped):] + suffix
+
+
+class PromptTokenizer:
+    """
+    Tokenizer of the drive prompts, a fixed template around a short navigation instruction (and an optional target).
+    The template segments before and after the instruction are tokenized once and cached, only the instruction and
+    the target are tokenized per prompt, and the token ids are concatenated.
+    Segments are cut before spaces and tokenized after a line break, see split_prompt.
+    The first num_checks prompts of each template are also tokenized whole; a template whose segments do not tokenize
+    to the same ids is tokenized whole from then on.
+    encode returns the ids without special tokens, as tokenizer.encode(text, add_special_tokens=False).
+    """
+    def __init__(self, tokenizer, num_checks=8, max_segments=64):
+        self.tokenizer = tokenizer
+        self.num_checks = num_checks
+        self.max_segments = max_segments
+        self._segments = {}  # (text, continuation) -> ids
+        self._checks = {}  # (prefix, suffix) -> number of prompts checked, None when the segments do not match
+        self._anchor_ids = self._encode(ANCHOR)
+
+    def _encode(self, text):
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+    def _encode_continuation(self, text):
+        # ids of text following other text: tokenized after the anchor, which is then dropped
+        if len(text) == 0:
+            return []
+        ids = self._encode(ANCHOR + text)
+        if ids[:len(self._anchor_ids)] != self._anchor_ids:
+            return None
+        return ids[len(self._anchor_ids):]
+
+    def _encode_segment(self, text, continuation):
+        key = (text, continuation)
+        ids = self._segments.get(key)
+        if ids is None:
+            ids = self._encode_continuation(text) if continuation else self._encode(text)
+            if len(self._segments) < self.max_segments:
+                self._segments[key] = ids
+        return ids
+
+    def encode_segments(self, prefix, instruction, suffix, target=''):
+        """
+        :return: ids of prefix + instruction + suffix + target, prefix and suffix being the constant template segments.
+        """
+        if len(target) > 0:
+            # the trailing spaces of the template belong to the first word of the target
+            stripped = suffix.rstrip(' ')
+            suffix, target = stripped, suffix[len(stripped):] + target
+        template = (prefix, suffix)
+        num_checked = self._checks.get(template, 0)
+        if num_checked is not None:
+            segment_ids = [
+                self._encode_segment(prefix, continuation=False),
+                self._encode_continuation(instruction),
+                self._encode_segment(suffix, continuation=True),
+                self._encode_continuation(target),
+            ]
+            if all(ids is not None for ids in segment_ids):
+                ids = [token for ids in segment_ids for token in ids]
+                if num_checked >= self.num_checks:
+                    return ids
+                if ids == self._encode(prefix + instruction + suffix + target):
+                    self._checks[template] = num_checked + 1
+                    return ids
+            logging.warning('The prompt template does not tokenize by segments, tokenizing the whole prompts')
+            self._checks[template] = None
+
+        return self._encode(prefix + instruction + suffix + target)
+
+    def encode(self, text, target=''):
+        """
+        :return: ids of text + target, text being a prompt with a navigation instruction.
+        """
+        segments = split_prompt(text)
+        if segments is None:
+            return self._encode(text + target)
+        return self.encode_segments(*segments, target=target)
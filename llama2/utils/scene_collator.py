@@ -0,0 +1,98 @@
+from dataclasses import dataclass
+from typing import Any, Optional
+
+import numpy as np
+import torch
+
+from gameformer.sample_store import load_sample
+
+
+MAP_COLUMN_NAME = 'map_info'
+TRAFFIC_LIGHTS = ['RED', 'YELLOW', 'GREEN', 'UNKNOWN']
+
+
+def encode_traffic_light(traffic_light):
+    """
+    One hot of the traffic light status of the ego lanes (red, yellow, green, unknown), unknown when they differ.
+    """
+    traffic_light_array = np.array([0, 0, 0, 0])
+    traffic_light = np.unique(traffic_light)
+    if len(traffic_light) > 1:
+        traffic_light = np.array(['UNKNOWN'])
+    if len(traffic_light) == 1 and traffic_light[0] in TRAFFIC_LIGHTS:
+        traffic_light_array[TRAFFIC_LIGHTS.index(traffic_light[0])] = 1
+    return traffic_light_array
+
+
+def build_scene_inputs(map_info, down_sample_type='none', feature_len=80):
+    """
+    Scene arrays of one sample as fed to LlamaForCausalLM.forward.
+    :param map_info: sample store reference or npz path of the sample.
+    :return: dict of input name -> np.ndarray, None without map_info.
+    """
+    if map_info is None or map_info == 'null':
+        return None
+
+    data = load_sample(map_info)
+    input_dict = {
+        'ego_agent_past': data['ego_agent_past'],
+        'neighbor_agents_past': data['neighbor_agents_past'],
+        'route_lanes': data['route_lanes'],
+        'map_lanes': data['lanes'],
+        'map_crosswalks': data['crosswalks'],
+        'ego_future': data['ego_agent_future'],
+        'neighbors_future': data['neighbor_agents_future'],
+    }
+    if 'ego_v_a' in data.keys():
+        input_dict.update({
+            'ego_v_a': data['ego_v_a'],
+            'neighbour_lane': data['neighbour_lane'],
+            'acc_classification': data['acc_classification'],
+            'lane_change': data['lane_change'],
+            'traffic_light': encode_traffic_light(data['traffic_light']),
+            'ego_lane_flag': data['ego_lane_flag'],
+        })
+
+    if down_sample_type != 'none':
+        assert down_sample_type in ['trunk', 'resample']
+        assert feature_len != input_dict['ego_future'].shape[0]
+        if down_sample_type == 'trunk':
+            input_dict['ego_future'] = input_dict['ego_future'][:feature_len, :]
+            input_dict['neighbors_future'] = input_dict['neighbors_future'][:, :feature_len, :]
+        elif down_sample_type == 'resample':
+            assert input_dict['ego_future'].shape[0] % feature_len == 0
+            input_dict['ego_future'] = input_dict['ego_future'][::input_dict['ego_future'].shape[0] // feature_len, :]
+            input_dict['neighbors_future'] = input_dict['neighbors_future'][:, ::input_dict['neighbors_future'].shape[1] // feature_len, :]
+
+    return input_dict
+
+
+@dataclass
+class SceneDataCollator:
+    """
+    Collator of the tokenized LLaMA4Drive datasets, which keep the map_info reference of each sample instead of
+    its scene tensors. The text features are padded by text_collator (DataCollatorForSeq2Seq), the scene arrays
+    of the batch are read from the sample store (or the npz files) and stacked into float32 tensors.
+    Features that still hold the scene tensors (datasets tokenized before) are passed to text_collator as they are.
+    """
+    text_collator: Any
+    down_sample_type: Optional[str] = 'none'
+    feature_len: Optional[int] = 80
+
+    def __call__(self, features, return_tensors=None):
+        if not any(MAP_COLUMN_NAME in feature for feature in features):
+            return self.text_collator(features, return_tensors)
+
+        map_infos = [feature[MAP_COLUMN_NAME] for feature in features]
+        features = [{k: v for k, v in feature.items() if k != MAP_COLUMN_NAME} for feature in features]
+        batch = self.text_collator(features, return_tensors)
+
+        scene_inputs = [build_scene_inputs(map_info, self.down_sample_type, self.feature_len) for map_info in map_infos]
+        if all(inputs is None for inputs in scene_inputs):
+            return batch
+        if any(inputs is None for inputs in scene_inputs):
+            raise ValueError('Batch mixes samples with and without map_info')
+        for k in scene_inputs[0]:
+            batch[k] = torch.from_numpy(np.stack([inputs[k] for inputs in scene_inputs])).to(torch.float32)
+
+        return batch
@@ -0,0 +1,138 @@
+import contextlib
+import os
+import unittest
+
+from llama2.utils.prompt_tokenizer import PromptTokenizer, split_instruction, split_prompt
+
+
+# the prompts of LLAMA2DriveModel.generate_prompt and of the processed datasets, after '<map>' -> '<map></map>'
+INFERENCE_TEMPLATE = """
+    Role: You are now an autonomous driving driver, and I will provide you with the environment information including Ego Car Information, Agents Information and Map Information.\n\nEnvironment: <map></map>\n\nNevigation instructions: {}. \n\nPlease predict the future waypoints of the ego car based on the given environmental information and nevigation instrucions.\n\nFinal Answer:\n
+    """
+TRAINING_TEMPLATE = "Role: You are now an autonomous driving driver, and I will provide you with the environment information including Ego Car Information, Agents Information and Map Information.\n\nEnvironment: <map></map>\n\nNevigation instructions: {}\n\nYou need to fully understand environmental information, discover important information in the environment, and predict future actions.\n\nFinal Answer:\n\n"
+INSTRUCTIONS = [
+    'go straight in 12.34 meters. ',
+    'turn left in 3.5 meters. go straight in 20.01 meters. ',
+    'stop. ',
+    'turn right in 7.0 meters. stop. go straight in 0.52 meters. ',
+    'Keep going',
+]
+TARGETS = ['', 'The ego car should slow down.', ' It keeps its lane.']
+# llama tokenizer, a local path or a hub name
+TOKENIZER_PATH = os.environ.get('LLAMA_TOKENIZER_PATH', 'hf-internal-testing/llama-tokenizer')
+
+
+class CharTokenizer:
+    """Tokenizer without merges across characters, every segmentation matches"""
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode(self, text, add_special_tokens=False):
+        self.encoded.append(text)
+        return [ord(c) for c in text]
+
+
+class PairTokenizer:
+    """Tokenizer of character pairs, the pairs depend on the segmentation"""
+
+    def encode(self, text, add_special_tokens=False):
+        return [hash(text[i:i + 2]) % 1000 for i in range(0, len(text), 2)]
+
+
+class TestSplitPrompt(unittest.TestCase):
+    """Test the prompt segmentation"""
+
+    def test_split_instruction(self):
+        """The textual split keeps the marker and the trailing spaces of the instruction in place"""
+        prefix, instruction, suffix = split_instruction(TRAINING_TEMPLATE.format(INSTRUCTIONS[1]))
+        self.assertTrue(prefix.endswith('Nevigation instructions: '))
+        self.assertEqual(instruction, INSTRUCTIONS[1])
+        self.assertTrue(suffix.startswith('\n\nYou need'))
+
+    def test_split_prompt(self):
+        """Segments are cut before spaces"""
+        for template in [INFERENCE_TEMPLATE, TRAINING_TEMPLATE]:
+            text = template.format(INSTRUCTIONS[1])
+            prefix, instruction, suffix = split_prompt(text)
+            self.assertEqual(prefix + instruction + suffix, text)
+            self.assertTrue(prefix.endswith('instructions:'))
+            self.assertEqual(instruction, ' ' + split_instruction(text)[1].rstrip(' '))
+            self.assertTrue(suffix.startswith(' '))
+
+    def test_no_instruction(self):
+        """Prompts without a navigation instruction are not split"""
+        self.assertIsNone(split_prompt('What is the speed limit?\n\n'))
+        self.assertIsNone(split_prompt('Nevigation instructions: go straight'))
+
+
+class TestPromptTokenizer(unittest.TestCase):
+    """Test PromptTokenizer against whole prompt tokenization"""
+
+    def test_cached_segments(self):
+        """Segments that match are cached, later prompts only tokenize the instruction and the target"""
+        tokenizer = CharTokenizer()
+        prompt_tokenizer = PromptTokenizer(tokenizer, num_checks=2)
+        for instruction in INSTRUCTIONS:
+            text = TRAINING_TEMPLATE.format(instruction)
+            self.assertEqual(prompt_tokenizer.encode(text), [ord(c) for c in text])
+        # the instructions with and without trailing space
+        self.assertEqual(list(prompt_tokenizer._checks.values()), [2, 1])
+
+        tokenizer.encoded.clear()
+        prompt_tokenizer.encode(TRAINING_TEMPLATE.format(INSTRUCTIONS[0]))
+        self.assertEqual(tokenizer.encoded, ['\n ' + INSTRUCTIONS[0].rstrip(' ')])
+
+    def test_fallback(self):
+        """A template whose segments do not match is tokenized whole"""
+        tokenizer = PairTokenizer()
+        prompt_tokenizer = PromptTokenizer(tokenizer)
+        for instruction in INSTRUCTIONS:
+            text = TRAINING_TEMPLATE.format(instruction)
+            with self.assertLogs(level='WARNING') if instruction is INSTRUCTIONS[0] else contextlib.nullcontext():
+                self.assertEqual(prompt_tokenizer.encode(text), tokenizer.encode(text))
+        self.assertTrue(all(num_checked is None for num_checked in prompt_tokenizer._checks.values()))
+
+
+class TestPromptTokenizerLlama(unittest.TestCase):
+    """Test PromptTokenizer with the llama tokenizer, slow and fast"""
+
+    def _get_tokenizer(self, use_fast):
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(TOKENIZER_PATH, use_fast=use_fast)
+        except Exception as e:
+            self.skipTest(f'llama tokenizer {TOKENIZER_PATH} not available: {e}')
+        # as the finetuned checkpoints
+        tokenizer.add_special_tokens({'additional_special_tokens': ['<map>', '</map>']})
+        return tokenizer
+
+    def _test_templates(self, use_fast):
+        tokenizer = self._get_tokenizer(use_fast)
+        num_checks = 2
+        for template in [INFERENCE_TEMPLATE, TRAINING_TEMPLATE]:
+            prompt_tokenizer = PromptTokenizer(tokenizer, num_checks=num_checks)
+            for _ in range(2):
+                for instruction in INSTRUCTIONS:
+                    text = template.format(instruction)
+                    for target in TARGETS:
+                        self.assertEqual(prompt_tokenizer.encode(text, target=target),
+                                         tokenizer.encode(text + target, add_special_tokens=False),
+                                         (instruction, target))
+            # every template (with and without target) passed its checks and uses the cached segments
+            self.assertTrue(len(prompt_tokenizer._checks) > 0)
+            self.assertTrue(all(num_checked == num_checks for num_checked in prompt_tokenizer._checks.values()),
+                            prompt_tokenizer._checks)
+
+    def test_slow_tokenizer(self):
+        """The slow tokenizer of LLAMA2DriveModel"""
+        self._test_templates(use_fast=False)
+
+    def test_fast_tokenizer(self):
+        """The fast tokenizer of the training script"""
+        self._test_templates(use_fast=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -557,6 +557,105 @@ def get_sampled_ego_states_from_db(
         )
 
 
+def get_ego_poses_around_sensor_tokens_from_db(
+    log_file: str,
+    sensor_source: SensorDataSource,
+    first_token: str,
+    last_token: str,
+    num_past_rows: int,
+    num_future_rows: int,
+) -> Generator[Tuple[str, int, float, float, float, float, float, float, float], None, None]:
+    """
+    Get the ego poses of all sensor data rows from num_past_rows rows before first_token to num_future_rows rows
+        after last_token, with one query.
+    Rows are counted as in get_sampled_ego_states_from_db, so that the past / future windows of every token between
+        first_token and last_token can be sampled from the result.
+
+    For example, given the following table:
+    token | timestamp
+    -----------------
+    0     | 0
+    1     | 1
+    ...
+    10    | 10
+
+    Some sample results:
+    first_token | last_token | num_past_rows | num_future_rows | returned tokens
+    ---------------------------------------------------------------------------
+    3           | 5          | 1             | 2               | [2, 3, 4, 5, 6, 7]
+    1           | 9          | 3             | 3               | [0, 1, ..., 10]
+
+    :param log_file: The db file to query.
+    :param sensor_source: Parameters for querying the correct table.
+    :param first_token: The first token of the range.
+    :param last_token: The last token of the range.
+    :param num_past_rows: The number of rows to return before first_token.
+    :param num_future_rows: The number of rows to return after last_token.
+    :return: A generator of (token, timestamp, x, y, heading, vx, vy, acceleration_x, acceleration_y) tuples
+        sorted by timestamp ascending, timestamps are the sensor data ones as in get_sampled_ego_states_from_db.
+    """
+    sensor_token = get_sensor_token(log_file, sensor_source.sensor_table, sensor_source.channel)
+
+    query = f"""
+        WITH ordered AS
+        (
+            SELECT  lp.token,
+                    lp.ego_pose_token,
+                    lp.timestamp,
+                    ROW_NUMBER() OVER (ORDER BY lp.timestamp ASC) AS row_num
+            FROM {sensor_source.table} AS lp
+            WHERE lp.{sensor_source.sensor_token_column} = ?
+        ),
+        bounds AS
+        (
+            SELECT  MIN(row_num) AS first_row,
+                    MAX(row_num) AS last_row
+            FROM ordered
+            WHERE token IN (?, ?)
+        )
+        SELECT  o.token,
+                o.timestamp,
+                ep.x,
+                ep.y,
+                ep.qw,
+                ep.qx,
+                ep.qy,
+                ep.qz,
+                ep.vx,
+                ep.vy,
+                ep.acceleration_x,
+                ep.acceleration_y
+        FROM ordered AS o
+        CROSS JOIN bounds AS b
+        INNER JOIN ego_pose AS ep
+            ON o.ego_pose_token = ep.token
+        WHERE o.row_num >= b.first_row - ?
+            AND o.row_num <= b.last_row + ?
+        ORDER BY o.timestamp ASC;
+    """
+
+    args = [
+        bytearray.fromhex(sensor_token),
+        bytearray.fromhex(first_token),
+        bytearray.fromhex(last_token),
+        num_past_rows,
+        num_future_rows,
+    ]
+    for row in execute_many(query, args, log_file):
+        q = Quaternion(row["qw"], row["qx"], row["qy"], row["qz"])
+        yield (
+            row["token"].hex(),
+            row["timestamp"],
+            row["x"],
+            row["y"],
+            q.yaw_pitch_roll[0],
+            row["vx"],
+            row["vy"],
+            row["acceleration_x"],
+            row["acceleration_y"],
+        )
+
+
 def get_ego_state_for_lidarpc_token_from_db(log_file: str, token: str) -> EgoState:
     """
     Get the ego state associated with an individual lidar_pc token from the db.
@@ -631,6 +730,40 @@ def get_traffic_light_status_for_lidarpc_token_from_db(
         )
 
 
+def get_traffic_light_status_within_time_interval_from_db(
+    log_file: str, start_timestamp: int, end_timestamp: int
+) -> Generator[TrafficLightStatusData, None, None]:
+    """
+    Get the traffic light information of all lidar_pcs between the provided timestamps, inclusive.
+    :param log_file: The log file to query.
+    :param start_timestamp: The starting timestamp for which to query, in uS.
+    :param end_timestamp: The ending timestamp for which to query, in uS.
+    :return: The traffic light status data, sorted by the timestamp of their lidar_pc.
+    """
+    query = """
+        SELECT  CASE WHEN tl.status == "green" THEN 0
+                     WHEN tl.status == "yellow" THEN 1
+                     WHEN tl.status == "red" THEN 2
+                     ELSE 3
+                END AS status,
+                tl.lane_connector_id,
+                lp.timestamp AS timestamp
+        FROM lidar_pc AS lp
+        INNER JOIN traffic_light_status AS tl
+            ON lp.token = tl.lidar_pc_token
+        WHERE lp.timestamp >= ?
+            AND lp.timestamp <= ?
+        ORDER BY lp.timestamp ASC;
+    """
+
+    for row in execute_many(query, (start_timestamp, end_timestamp), log_file):
+        yield TrafficLightStatusData(
+            status=TrafficLightStatusType(row["status"]),
+            lane_connector_id=row["lane_connector_id"],
+            timestamp=row["timestamp"],
+        )
+
+
 def get_tracked_objects_within_time_interval_from_db(
     log_file: str, start_timestamp: int, end_timestamp: int, filter_track_tokens: Optional[Set[str]] = None
 ) -> Generator[TrackedObject, None, None]:
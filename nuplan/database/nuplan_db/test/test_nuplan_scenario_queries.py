@@ -13,6 +13,7 @@ from nuplan.database.nuplan_db.lidar_pc import LidarPc
 from nuplan.database.nuplan_db.nuplan_db_utils import SensorDataSource
 from nuplan.database.nuplan_db.nuplan_scenario_queries import (
     get_cameras,
+    get_ego_poses_around_sensor_tokens_from_db,
     get_ego_state_for_lidarpc_token_from_db,
     get_end_sensor_time_from_db,
     get_future_waypoints_for_agents_from_db,
@@ -34,6 +35,7 @@ from nuplan.database.nuplan_db.nuplan_scenario_queries import (
     get_tracked_objects_for_lidarpc_token_from_db,
     get_tracked_objects_within_time_interval_from_db,
     get_traffic_light_status_for_lidarpc_token_from_db,
+    get_traffic_light_status_within_time_interval_from_db,
 )
 from nuplan.database.nuplan_db.test.minimal_db_test_utils import (
     DBGenerationParameters,
@@ -329,6 +331,48 @@ class TestNuPlanScenarioQueries(unittest.TestCase):
                     expected_row_indexes[i] * 1e6, actual_returned_ego_states[i].time_point.time_us  # type: ignore
                 )
 
+    def test_get_ego_poses_around_sensor_tokens_from_db(self) -> None:
+        """
+        Test the get_ego_poses_around_sensor_tokens_from_db query.
+        """
+        test_cases = [
+            {"first_token": 3, "last_token": 5, "num_past_rows": 1, "num_future_rows": 2, "expected_row_indexes": [2, 3, 4, 5, 6, 7]},
+            {"first_token": 1, "last_token": 1, "num_past_rows": 3, "num_future_rows": 0, "expected_row_indexes": [0, 1]},
+            {"first_token": 47, "last_token": 48, "num_past_rows": 0, "num_future_rows": 5, "expected_row_indexes": [47, 48, 49]},
+        ]
+
+        for test_case in test_cases:
+            ego_poses = list(
+                get_ego_poses_around_sensor_tokens_from_db(
+                    self.db_file_name,
+                    self.sensor_source,
+                    int_to_str_token(test_case["first_token"]),
+                    int_to_str_token(test_case["last_token"]),
+                    test_case["num_past_rows"],
+                    test_case["num_future_rows"],
+                )
+            )
+
+            expected_row_indexes = test_case["expected_row_indexes"]
+            self.assertEqual(len(expected_row_indexes), len(ego_poses))  # type: ignore
+            for expected_row_index, ego_pose in zip(expected_row_indexes, ego_poses):  # type: ignore
+                self.assertEqual(int_to_str_token(expected_row_index), ego_pose[0])
+                self.assertEqual(expected_row_index * 1e6, ego_pose[1])
+
+        # the poses match the ego states sampled one by one
+        ego_poses = list(
+            get_ego_poses_around_sensor_tokens_from_db(
+                self.db_file_name, self.sensor_source, int_to_str_token(30), int_to_str_token(30), 0, 0
+            )
+        )
+        ego_state = get_ego_state_for_lidarpc_token_from_db(self.db_file_name, int_to_str_token(30))
+        _, _, x, y, heading, vx, vy, _, _ = ego_poses[0]
+        self.assertEqual(ego_state.rear_axle.x, x)
+        self.assertEqual(ego_state.rear_axle.y, y)
+        self.assertAlmostEqual(ego_state.rear_axle.heading, heading)
+        self.assertEqual(ego_state.dynamic_car_state.rear_axle_velocity_2d.x, vx)
+        self.assertEqual(ego_state.dynamic_car_state.rear_axle_velocity_2d.y, vy)
+
     def test_get_ego_state_for_lidarpc_token_from_db(self) -> None:
         """
         Test the get_ego_state_for_lidarpc_token_from_db query.
@@ -353,6 +397,26 @@ class TestNuPlanScenarioQueries(unittest.TestCase):
             for tl_status in traffic_light_statuses:
                 self.assertEqual(sample_token * 1e6, tl_status.timestamp)
 
+    def test_get_traffic_light_status_within_time_interval_from_db(self) -> None:
+        """
+        Test the get_traffic_light_status_within_time_interval_from_db query.
+        """
+        expected_timestamps = {0: [0, 1, 2], 30: [28, 29, 30, 31, 32], 48: [46, 47, 48, 49]}
+
+        for sample_token, timestamps in expected_timestamps.items():
+            start_timestamp = int(1e6 * (sample_token - 2))
+            end_timestamp = int(1e6 * (sample_token + 2))
+
+            traffic_light_statuses = list(
+                get_traffic_light_status_within_time_interval_from_db(self.db_file_name, start_timestamp, end_timestamp)
+            )
+
+            self.assertEqual(5 * len(timestamps), len(traffic_light_statuses))
+            self.assertEqual(
+                [timestamp * 1e6 for timestamp in timestamps for _ in range(5)],
+                [tl_status.timestamp for tl_status in traffic_light_statuses],
+            )
+
     def test_get_tracked_objects_for_lidarpc_token_from_db(self) -> None:
         """
         Test the get_tracked_objects_for_token_from_db query.
@@ -1,9 +1,11 @@
 import logging
 import os
+from collections import defaultdict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import List
+from typing import Dict, List, Tuple
 
+import numpy as np
 import pandas as pd
 from omegaconf import DictConfig
 
@@ -15,6 +17,7 @@ from nuplan.planning.script.builders.main_callback_builder import build_main_mul
 from nuplan.planning.script.builders.utils.utils_config import update_config_for_simulation
 from nuplan.planning.script.builders.worker_pool_builder import build_worker
 from nuplan.planning.simulation.main_callback.multi_main_callback import MultiMainCallback
+from nuplan.planning.simulation.planner.planner_report import STAGE_PERCENTILES, StagedPlannerReport
 from nuplan.planning.simulation.runner.abstract_runner import AbstractRunner
 from nuplan.planning.simulation.runner.executor import execute_runners
 from nuplan.planning.simulation.runner.runner_report import RunnerReport
@@ -59,6 +62,9 @@ def save_runner_reports(reports: List[RunnerReport], output_dir: Path, report_na
     :param output_dir: Output directory to save the report.
     :param report_name: Report name.
     """
+    # The raw stage runtimes are dropped with the planner reports below, aggregate them first
+    stage_latency_df = compute_stage_latency_table(reports)
+
     report_dicts = []
     for report in map(lambda x: x.__dict__, reports):  # type: ignore
         if (planner_report := report["planner_report"]) is not None:
@@ -73,6 +79,40 @@ def save_runner_reports(reports: List[RunnerReport], output_dir: Path, report_na
     df.to_parquet(safe_path_to_string(save_path))
     logger.info(f'Saved runner reports to {save_path}')
 
+    if len(stage_latency_df) > 0:
+        save_path = output_dir / f'stage_latency_{report_name}'
+        stage_latency_df.to_parquet(safe_path_to_string(save_path))
+        logger.info(f'Planner stage latencies [ms]:\n{stage_latency_df.to_string()}')
+        logger.info(f'Saved planner stage latencies to {save_path}')
+
+
+def compute_stage_latency_table(reports: List[RunnerReport]) -> pd.DataFrame:
+    """
+    Pool the per-tick stage runtimes of all runner reports by scenario type and compute their percentiles.
+    Only planners returning a StagedPlannerReport contribute.
+    :param reports: Runner reports returned from each simulation.
+    :return: Dataframe with one row per (scenario_type, stage): number of ticks and p50/p95/p99 latencies [ms].
+    """
+    stage_runtimes: Dict[Tuple[str, str], List[float]] = defaultdict(list)
+    for report in reports:
+        if not isinstance(report.planner_report, StagedPlannerReport):
+            continue
+        scenario_type = report.scenario_type or 'unknown'
+        stage_runtimes[(scenario_type, 'compute_trajectory')] += report.planner_report.compute_trajectory_runtimes
+        for stage, runtimes in report.planner_report.stage_runtimes.items():
+            stage_runtimes[(scenario_type, stage)] += runtimes
+
+    rows = []
+    for (scenario_type, stage), runtimes in sorted(stage_runtimes.items()):
+        if len(runtimes) == 0:
+            continue
+        row = {'scenario_type': scenario_type, 'stage': stage, 'num_ticks': len(runtimes)}
+        for percentile, value in zip(STAGE_PERCENTILES, np.percentile(runtimes, STAGE_PERCENTILES)):
+            row[f'p{percentile}_ms'] = 1000 * value
+        rows.append(row)
+
+    return pd.DataFrame(rows)
+
 
 def set_up_common_builder(cfg: DictConfig, profiler_name: str) -> CommonBuilder:
     """
@@ -161,6 +161,33 @@ class TestTimingCallback(TestCase):
         self.assertFalse(self.tc._step_duration)
         self.assertFalse(self.tc._planner_step_duration)
 
+    @patch.object(TimingCallback, '_get_time', autospec=True)
+    def test_on_simulation_end_with_stage_runtimes(self, get_time: MagicMock) -> None:
+        """
+        Tests if the stage runtimes exposed by the planner are published and stored with the other timings.
+        """
+        get_time.return_value = END_TIME
+        self.writer.add_scalar = Mock()
+        self.tc._tensorboard_global_step = GLOBAL_STEP
+        self.tc._simulation_start = START_TIME
+        self.tc._step_duration = [123, 444, 789]
+        self.tc._planner_step_duration = [456, 555, 1011]
+        self.planner.stage_runtimes = {'reference_path': [1, 2, 6], 'pdm_scoring': []}
+
+        # Code execution
+        self.tc.on_simulation_end(self.setup, self.planner, self.history)
+
+        # Expectations check
+        self.writer.add_scalar.assert_has_calls(
+            [
+                call('mean_reference_path_time', 3, 7),
+                call('max_reference_path_time', 6, 7),
+            ]
+        )
+        self.assertEqual(self.tc._scenarios_captured[TOKEN]["mean_reference_path_time"], 3)
+        self.assertEqual(self.tc._scenarios_captured[TOKEN]["max_reference_path_time"], 6)
+        self.assertNotIn("mean_pdm_scoring_time", self.tc._scenarios_captured[TOKEN])
+
     @patch.object(TimingCallback, '_get_time', autospec=True)
     def test_on_step_start(self, get_time: MagicMock) -> None:
         """
@@ -72,6 +72,12 @@ class TimingCallback(AbstractCallback):
             "max_planner_step_time": np.max(self._planner_step_duration),
             "mean_planner_step_time": np.mean(self._planner_step_duration),
         }
+        # Planners timing their stages expose the per-tick stage runtimes [s] of the current simulation
+        stage_runtimes = getattr(planner, "stage_runtimes", None) or {}
+        for stage, runtimes in stage_runtimes.items():
+            if len(runtimes) > 0:
+                timings[f"mean_{stage}_time"] = np.mean(runtimes)
+                timings[f"max_{stage}_time"] = np.max(runtimes)
 
         # Publish timings
         step = self._tensorboard_global_step
@@ -80,6 +86,10 @@ class TimingCallback(AbstractCallback):
         self._writer.add_scalar("max_step_time", timings["max_step_time"], step)
         self._writer.add_scalar("max_planner_step_time", timings["max_planner_step_time"], step)
         self._writer.add_scalar("mean_planner_step_time", timings["mean_planner_step_time"], step)
+        for stage in stage_runtimes:
+            if f"mean_{stage}_time" in timings:
+                self._writer.add_scalar(f"mean_{stage}_time", timings[f"mean_{stage}_time"], step)
+                self._writer.add_scalar(f"max_{stage}_time", timings[f"max_{stage}_time"], step)
         self._tensorboard_global_step += 1
 
         # Store timings
@@ -3,6 +3,8 @@ from typing import Dict, List
 
 import numpy as np
 
+STAGE_PERCENTILES = [50, 95, 99]  # tail latency percentiles reported per stage
+
 
 @dataclass(frozen=True)
 class PlannerReport:
@@ -34,3 +36,27 @@ class MLPlannerReport(PlannerReport):
 
     feature_building_runtimes: List[float]  # time series of feature building runtimes [s]
     inference_runtimes: List[float]  # time series of model inference runtimes [s]
+
+
+@dataclass(frozen=True)
+class StagedPlannerReport(PlannerReport):
+    """Runtime stats of planners timing the individual stages of compute_trajectory."""
+
+    stage_runtimes: Dict[str, List[float]]  # stage name -> time series of the stage runtimes [s]
+
+    def compute_summary_statistics(self) -> Dict[str, float]:
+        """
+        Compute summary statistics of compute_trajectory_runtimes and of every stage, including tail percentiles.
+        :return: dictionary containing summary statistics of each field and stage.
+        """
+        summary = {}
+        runtimes = {"compute_trajectory_runtimes": self.compute_trajectory_runtimes}
+        runtimes.update({f"{stage}_runtimes": values for stage, values in self.stage_runtimes.items() if len(values) > 0})
+        for name, values in runtimes.items():
+            summary[f"{name}_mean"] = np.mean(values)
+            summary[f"{name}_median"] = np.median(values)
+            summary[f"{name}_std"] = np.std(values)
+            for percentile in STAGE_PERCENTILES:
+                summary[f"{name}_p{percentile}"] = np.percentile(values, percentile)
+
+        return summary
@@ -53,6 +53,7 @@ def run_simulation(sim_runner: AbstractRunner, exit_on_failure: bool = False) ->
             scenario_name=sim_runner.scenario.scenario_name,
             planner_name=sim_runner.planner.name(),
             log_name=sim_runner.scenario.log_name,
+            scenario_type=sim_runner.scenario.scenario_type,
         )
 
         return report
@@ -42,6 +42,7 @@ class MetricRunner(AbstractRunner):
             scenario_name=self._simulation_log.scenario.scenario_name,
             planner_name=self._simulation_log.planner.name(),
             log_name=self._simulation_log.scenario.log_name,
+            scenario_type=self._simulation_log.scenario.scenario_type,
         )
 
         run_metric_engine(
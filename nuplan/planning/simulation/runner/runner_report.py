@@ -24,3 +24,4 @@ class RunnerReport:
     scenario_name: str
     planner_name: str
     log_name: str
+    scenario_type: Optional[str] = None  # type of the simulated scenario
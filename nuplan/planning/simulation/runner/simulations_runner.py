@@ -90,6 +90,7 @@ class SimulationRunner(AbstractRunner):
             scenario_name=self._simulation.scenario.scenario_name,
             planner_name=self.planner.name(),
             log_name=self._simulation.scenario.log_name,
+            scenario_type=self._simulation.scenario.scenario_type,
         )
 
         # Execute specific callback
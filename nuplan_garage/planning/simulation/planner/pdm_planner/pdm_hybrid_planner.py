@@ -98,7 +98,7 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
         model: TorchModuleWrapper,
         correction_horizon: float,
         use_better_anchor: bool,
-        checkpoint_path: str,
+        checkpoint_path: Optional[str],
         leading_agent_update_rate: int = 2,
     ):
         """
@@ -110,7 +110,7 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
         :param map_radius: radius around ego to consider
         :param model: torch model
         :param correction_horizon: time to apply open-loop correction [s]
-        :param checkpoint_path: path to checkpoint for model as string
+        :param checkpoint_path: path to checkpoint for model as string, None keeps the model weights as they are
         """
 
         super(PDMHybridPlanner, self).__init__(
@@ -125,11 +125,14 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
 
         self._device = "cpu"
 
-        self._model = LightningModuleWrapper.load_from_checkpoint(
-            checkpoint_path,
-            model=model,
-            map_location=self._device,
-        ).model
+        if checkpoint_path is None:
+            self._model = model.to(self._device)
+        else:
+            self._model = LightningModuleWrapper.load_from_checkpoint(
+                checkpoint_path,
+                model=model,
+                map_location=self._device,
+            ).model
         self._model.eval()
         torch.set_grad_enabled(False)
 
@@ -408,9 +411,12 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
                     
         return anchor_state, anchor_se2, progress_ls
 
-    def compute_planner_trajectory_just_4_get_score(self, current_input: PlannerInput, llm_trajectory: InterpolatedTrajectory):
-        """Inherited, see superclass."""
-        gc.disable()
+    def _prepare_scoring(self, current_input: PlannerInput) -> EgoState:
+        """
+        Builds the drivable area map, centerline, observation and proposal manager once per iteration.
+        :param current_input: planner input of the current iteration
+        :return: current ego state
+        """
         ego_state, observation = current_input.history.current_state
 
         # Update/Create drivable area polygon map
@@ -432,21 +438,16 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
 
         # 2. Centerline extraction and proposal update
         self._update_proposal_manager(ego_state, self.use_better_anchor)
+        return ego_state
 
-        # 3. Generate/Unroll proposals
-        proposals_array = _convert_trajectory_to_proposal(llm_trajectory, self._proposal_sampling)
-        # proposals_array = self._generator.generate_proposals(
-        #     ego_state, self._observation, self._proposal_manager
-        # )
-
-
+    def _score_proposals_array(self, proposals_array, ego_state: EgoState, independent_progress: bool = False):
         # 4. Simulate proposals
         simulated_proposals_array = self._simulator.simulate_proposals(
             proposals_array, ego_state
         )
 
         # 5. Score proposals
-        proposal_scores = self.score_4_LLM.score_proposals(
+        return self.score_4_LLM.score_proposals(
             simulated_proposals_array,
             ego_state,
             self._observation,
@@ -454,12 +455,41 @@ class PDMHybridPlanner(AbstractPDMClosedPlanner):
             self._route_lane_dict,
             self._drivable_area_map,
             self._map_api,
+            independent_progress=independent_progress,
         )
+
+    def compute_planner_trajectory_just_4_get_score(self, current_input: PlannerInput, llm_trajectory: InterpolatedTrajectory):
+        """Inherited, see superclass."""
+        gc.disable()
+        ego_state = self._prepare_scoring(current_input)
+
+        # 3. Generate/Unroll proposals
+        proposals_array = _convert_trajectory_to_proposal(llm_trajectory, self._proposal_sampling)
+        # proposals_array = self._generator.generate_proposals(
+        #     ego_state, self._observation, self._proposal_manager
+        # )
+
+        proposal_scores = self._score_proposals_array(proposals_array, ego_state)
         
         prompt = self.score_4_LLM.to_error_prompt()
         # print(prompt)
         return prompt, proposal_scores
 
+    def compute_scores_for_trajectories(self, current_input: PlannerInput, trajectories: List[InterpolatedTrajectory]):
+        """
+        Scores several candidate trajectories in one simulation and scoring pass.
+        Each score equals compute_planner_trajectory_just_4_get_score on that trajectory alone.
+        :param current_input: planner input of the current iteration
+        :param trajectories: candidate trajectories
+        :return: array of scores, one per trajectory
+        """
+        gc.disable()
+        ego_state = self._prepare_scoring(current_input)
+        proposals_array = np.concatenate(
+            [_convert_trajectory_to_proposal(trajectory, self._proposal_sampling) for trajectory in trajectories], axis=0
+        )
+        return self._score_proposals_array(proposals_array, ego_state, independent_progress=True)
+
 
     def _apply_trajectory_correction(
         self,
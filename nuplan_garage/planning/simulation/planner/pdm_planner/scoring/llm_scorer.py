@@ -135,6 +135,7 @@ class PDMScorer4LLM:
         route_lane_dict: Dict[str, LaneGraphEdgeMapObject],
         drivable_area_map: PDMOccupancyMap,
         map_api: AbstractMap,
+        independent_progress: bool = False,
     ) -> npt.NDArray[np.float64]:
         """
         Scores proposal similar to nuPlan's closed-loop metrics
@@ -145,6 +146,7 @@ class PDMScorer4LLM:
         :param route_lane_dict: dictionary containing on-route lanes
         :param drivable_area_map: Occupancy map of drivable are polygons
         :param map_api: map object
+        :param independent_progress: normalize progress per proposal, i.e. each score equals scoring it alone
         :return: array containing score of each proposal
         """
 
@@ -181,11 +183,13 @@ class PDMScorer4LLM:
         error_dict['ttc'] = ttc
         error_dict['comfortable'] = comfortable
         
-        self.error_dict = error_dict
+        # the error description is only meaningful for a single proposal
+        self.error_dict = error_dict if self._num_proposals == 1 else None
 
-        return self._aggregate_scores()
+        return self._aggregate_scores(independent_progress)
     
     def to_error_prompt(self):
+        assert self.error_dict is not None, 'error prompt is only available after scoring a single proposal'
         pre_prompt = "After conducting simulation based on the Refined Ego Future Trajectories that you've decided, it was found that the following problems may exist:\n\n"
         
         
@@ -235,9 +239,10 @@ class PDMScorer4LLM:
         #     return None
         return pre_prompt + error_prompt + pro_prompt
 
-    def _aggregate_scores(self) -> npt.NDArray[np.float64]:
+    def _aggregate_scores(self, independent_progress: bool = False) -> npt.NDArray[np.float64]:
         """
         Aggregates metrics with multiplicative and weighted average.
+        :param independent_progress: normalize progress of each proposal by itself instead of by the best proposal
         :return: array containing score of each proposal
         """
 
@@ -247,7 +252,11 @@ class PDMScorer4LLM:
         # normalize and fill progress values
         raw_progress = self._progress_raw * multiplicate_metric_scores
         max_raw_progress = np.max(raw_progress)
-        if max_raw_progress > PROGRESS_DISTANCE_THRESHOLD:
+        if independent_progress:
+            # progress of a single proposal normalized by itself is 1, or 0 if a multiplicative metric failed
+            normalized_progress = np.ones(len(raw_progress), dtype=np.float64)
+            normalized_progress[multiplicate_metric_scores == 0.0] = 0.0
+        elif max_raw_progress > PROGRESS_DISTANCE_THRESHOLD:
             normalized_progress = raw_progress / max_raw_progress
         else:
             normalized_progress = np.ones(len(raw_progress), dtype=np.float64)
@@ -636,31 +645,29 @@ class PDMScorer4LLM:
         
         # calculate raw progress in meter
         progress_in_meter = np.zeros(self._num_proposals, dtype=np.float64)
-        assert self._num_proposals==1, 'more than one trajectories are given'
+
+        # centerline around ego, shared by all proposals
+        centerline = self._centerline._states_se2_array
+        center_states = [StateSE2.deserialize(pose) for pose in centerline]
+        center_states = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle] + center_states)[1:]
+        relative_ego_center = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle, self._initial_ego_state.car_footprint.center])[1:]
+        relative_ego_rear = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle, self._initial_ego_state.car_footprint.rear_axle])[1:]
+        center_states, _, _ = clip_centerline_by_ego_pose(center_states, relative_ego_center, relative_ego_rear)
+        if center_states is not None:
+            # center_states = np.array([[stat.x, stat.y, stat.heading] for stat in center_states])   
+            center_states = np.round(equidistant_interpolation(center_states, 20),2)
+
+        start_points = [Point(*self._ego_coords[proposal_idx, 0, BBCoordsIndex.CENTER]) for proposal_idx in range(self._num_proposals)]
+        end_points = [Point(*self._ego_coords[proposal_idx, -1, BBCoordsIndex.CENTER]) for proposal_idx in range(self._num_proposals)]
+        progress = np.asarray(self._centerline.project(start_points + end_points)).reshape(2, self._num_proposals)
+        center_points = self._ego_coords[:, :, BBCoordsIndex.CENTER]
+        real_progress = np.sum(np.sqrt(np.sum((np.diff(center_points, axis=1))**2, axis=-1)), axis=-1)
+        progress_in_meter[:] = progress[1] - progress[0]
+
         for proposal_idx in range(self._num_proposals):
-            start_point = Point(
-                *self._ego_coords[proposal_idx, 0, BBCoordsIndex.CENTER]
-            )
-            end_point = Point(*self._ego_coords[proposal_idx, -1, BBCoordsIndex.CENTER])
-            center_points = self._ego_coords[proposal_idx, :, BBCoordsIndex.CENTER]
-            real_progress = np.sum(np.sqrt(np.sum((np.diff(center_points, axis=0))**2, axis=1)))
-            
-            centerline = self._centerline._states_se2_array
-            center_states = [StateSE2.deserialize(pose) for pose in centerline]
-            center_states = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle] + center_states)[1:]
-            relative_ego_center = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle, self._initial_ego_state.car_footprint.center])[1:]
-            relative_ego_rear = absolute_to_relative_poses([self._initial_ego_state.car_footprint.rear_axle, self._initial_ego_state.car_footprint.rear_axle])[1:]
-            center_states, _, _ = clip_centerline_by_ego_pose(center_states, relative_ego_center, relative_ego_rear)
-            if center_states is not None:
-                # center_states = np.array([[stat.x, stat.y, stat.heading] for stat in center_states])   
-                center_states = np.round(equidistant_interpolation(center_states, 20),2)
-            
-            progress = self._centerline.project([start_point, end_point])
-            progress_in_meter[proposal_idx] = progress[1] - progress[0]
-            
-            progress_dict['progress'] = progress[1] - progress[0]
-            progress_dict['real_progress'] = real_progress
-            progress_dict['progress_rate'] = (progress[1] - progress[0]) / real_progress 
+            progress_dict['progress'] = progress_in_meter[proposal_idx]
+            progress_dict['real_progress'] = real_progress[proposal_idx]
+            progress_dict['progress_rate'] = progress_in_meter[proposal_idx] / real_progress[proposal_idx]
             progress_dict['center_points_interpolated'] = center_states
             progress_dict['error_bool'] = (progress_dict['progress_rate']<0.9)
 
@@ -680,7 +687,6 @@ class PDMScorer4LLM:
         )
         is_comfortable = ego_is_comfortable(self._states, time_point_s) # [n_proposal, len(comfort_metric)]
         
-        assert len(is_comfortable)==1, 'more than one trajectories are given'
         comfortable_dict['metrics'] = [
             'lon_acceleration',
             'lat_acceleration',
@@ -713,7 +719,6 @@ class PDMScorer4LLM:
         
         drivable_area_compliance_dict['off_road_record'] = []
         off_road_record = self._ego_areas[:, :, EgoAreaIndex.NON_DRIVABLE_AREA]
-        assert len(self._ego_areas)==1, 'more than one trajectories are given'
         for proposal_idx in range(len(self._ego_areas)):
             proposal_off_road_record = off_road_record[proposal_idx]
             if not proposal_off_road_record.all()==True:
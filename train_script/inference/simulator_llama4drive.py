@@ -35,6 +35,14 @@ def parse_args():
     parser.add_argument('--ref', type=str, default=None)
     parser.add_argument('--type', type=int, default=None)
     parser.add_argument('--llm_inf_step', type=int, default=1)
+    parser.add_argument('--async_llm', action='store_true')
+    parser.add_argument('--llm_max_staleness', type=float, default=1.0)
+    parser.add_argument('--llm_server', action='store_true')
+    parser.add_argument('--llm_server_batch_size', type=int, default=8)
+    parser.add_argument('--llm_server_wait_ms', type=float, default=5.0)
+    parser.add_argument('--worker', type=str, default='sequential')
+    parser.add_argument('--lane_store', action='store_true')
+    parser.add_argument('--lane_store_dir', type=str, default=None)
     parser.add_argument('--lora_r', type=int, default=16)
     parser.add_argument('--short_ins', type=int, default=-1)
     parser.add_argument('--disable_refpath', action='store_true')
@@ -77,13 +85,22 @@ DATASET_PARAMS = [
     f'+planner.{PLANNER}.enable_pdm_scorer_in_multirefpath={args.refine}',
     f'+planner.{PLANNER}.lora_r={args.lora_r}',
     f'+planner.{PLANNER}.llm_inf_step={args.llm_inf_step}',
+    f'+planner.{PLANNER}.async_llm={args.async_llm}',
+    f'+planner.{PLANNER}.llm_max_staleness={args.llm_max_staleness}',
+    f'+planner.{PLANNER}.llm_server={args.llm_server}',
+    f'+planner.{PLANNER}.llm_server_batch_size={args.llm_server_batch_size}',
+    f'+planner.{PLANNER}.llm_server_wait_ms={args.llm_server_wait_ms}',
     f'+planner.{PLANNER}.short_ins={args.short_ins}',
+    f'+planner.{PLANNER}.use_lane_store={args.lane_store}',
     f'scenario_filter.scenario_types=[{case_type[args.type]}]',
     'scenario_filter.num_scenarios_per_type=20',
     "hydra.searchpath=[pkg://nuplan.planning.script.config.common, pkg://nuplan.planning.script.experiments]",
     #"hydra.searchpath=[file:///abspath/to/asyncdriver/nuplan/planning/script/config/common, file:///abspath/to/asyncdriver/nuplan/planning/script/experiments]",
 ]
 
+if args.lane_store_dir is not None:
+    DATASET_PARAMS.append(f'+planner.{PLANNER}.lane_store_dir={args.lane_store_dir}')
+
 # Name of the experiment
 EXPERIMENT = 'llama4drive_experiment'
 
@@ -96,7 +113,7 @@ cfg = hydra.compose(config_name=CONFIG_NAME, overrides=[
     f'group={SAVE_DIR}',
     f'planner={PLANNER}',
     f'+simulation={CHALLENGE}',
-    'worker=sequential',
+    f'worker={args.worker}',
     *DATASET_PARAMS,
 ])
 